@@ -0,0 +1,145 @@
+"""
+Encoder Profile Benchmark
+
+デスクトップ画面のトレースを各エンコーダプロファイルでエンコードし、
+1フレームあたりのエンコード時間（ms）とビット数を比較する
+
+使い方:
+    python bench/bench_encoder.py                      # 合成デスクトップトレース
+    python bench/bench_encoder.py --trace frames.npz   # 記録済みトレース（frames: N x H x W x 3）
+    python bench/bench_encoder.py --trace shots/       # PNGスクリーンショットのディレクトリ
+"""
+
+import argparse
+import fractions
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import av
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from aiortc.rtcrtpparameters import RTCRtpCodecParameters
+
+from server.encoder_profiles import PROFILES, create_encoder
+from telemetry import metrics
+
+CODECS = {
+    "VP8": RTCRtpCodecParameters(mimeType="video/VP8", clockRate=90000, payloadType=96),
+    "H264": RTCRtpCodecParameters(mimeType="video/H264", clockRate=90000, payloadType=102),
+}
+
+
+def load_trace(path: Path, limit: int):
+    """記録済みトレースを読み込む"""
+    if path.is_dir():
+        from PIL import Image
+        frames = []
+        for image_path in sorted(path.glob("*.png"))[:limit]:
+            frames.append(np.asarray(Image.open(image_path).convert("RGB")))
+        return frames
+    data = np.load(path)
+    frames = data["frames"] if hasattr(data, "files") else data
+    return [np.ascontiguousarray(f[:, :, :3]) for f in frames[:limit]]
+
+
+def synthetic_desktop_trace(width: int, height: int, count: int):
+    """
+    デスクトップ操作を模した合成トレース
+
+    静止した背景とウィンドウ、スクロールするテキスト行、移動するカーソル
+    """
+    rng = np.random.default_rng(0)
+    base = np.full((height, width, 3), 235, dtype=np.uint8)
+    base[: height // 20] = (40, 40, 48)  # タスクバー
+    win_y0, win_y1 = height // 8, height * 7 // 8
+    win_x0, win_x1 = width // 10, width * 9 // 10
+    base[win_y0:win_y1, win_x0:win_x1] = 255
+
+    # テキスト行（高周波成分の多いパターン）
+    line_h = 16
+    lines = []
+    for _ in range((win_y1 - win_y0) // line_h + count):
+        row = np.full((line_h, win_x1 - win_x0, 3), 255, dtype=np.uint8)
+        glyphs = rng.random((line_h - 6, win_x1 - win_x0)) < 0.35
+        row[3:line_h - 3][glyphs] = 20
+        lines.append(row)
+
+    frames = []
+    for i in range(count):
+        frame = base.copy()
+        # 数フレームに1回スクロール、それ以外はカーソル移動のみ
+        offset = i // 4
+        visible = np.concatenate(lines[offset:offset + (win_y1 - win_y0) // line_h])
+        frame[win_y0:win_y0 + visible.shape[0], win_x0:win_x1] = visible
+        cx = (i * 17) % (width - 16)
+        cy = (i * 11) % (height - 16)
+        frame[cy:cy + 16, cx:cx + 10] = 0
+        frames.append(frame)
+    return frames
+
+
+def run_benchmark(frames, codec_name: str, profile_name: str, fps: int):
+    encoder = create_encoder(CODECS[codec_name], PROFILES[profile_name])
+    time_base = fractions.Fraction(1, 90000)
+    encode_ms = []
+    frame_bits = []
+    for index, data in enumerate(frames):
+        frame = av.VideoFrame.from_ndarray(data, format="rgb24")
+        frame.pts = index * (90000 // fps)
+        frame.time_base = time_base
+        t0 = time.perf_counter()
+        payloads, _ = encoder.encode(frame, index == 0)
+        encode_ms.append((time.perf_counter() - t0) * 1000)
+        frame_bits.append(sum(len(p) for p in payloads) * 8)
+
+    return {
+        "codec": codec_name,
+        "profile": profile_name,
+        "frames": len(frames),
+        "ms_mean": statistics.mean(encode_ms),
+        "ms_p95": metrics.percentile(sorted(encode_ms), 0.95),
+        "bits_mean": statistics.mean(frame_bits),
+        "kbps": statistics.mean(frame_bits) * fps / 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Encoder profile benchmark")
+    parser.add_argument("--trace", type=Path, help=".npz/.npy trace or PNG directory")
+    parser.add_argument("--frames", type=int, default=120)
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--fps", type=int, default=10)
+    parser.add_argument("--codecs", default="VP8,H264")
+    parser.add_argument("--profiles", default=",".join(PROFILES))
+    args = parser.parse_args()
+
+    if args.trace:
+        frames = load_trace(args.trace, args.frames)
+        source = str(args.trace)
+    else:
+        frames = synthetic_desktop_trace(args.width, args.height, args.frames)
+        source = "synthetic"
+    if not frames:
+        print("No frames to encode")
+        return 1
+
+    height, width = frames[0].shape[:2]
+    print(f"Trace: {source}, {len(frames)} frames, {width}x{height}, {args.fps}fps")
+    print(f"{'codec':<6} {'profile':<8} {'ms/frame':>9} {'p95 ms':>8} {'bits/frame':>11} {'kbps':>8}")
+    for codec_name in args.codecs.split(","):
+        for profile_name in args.profiles.split(","):
+            result = run_benchmark(frames, codec_name, profile_name, args.fps)
+            print(
+                f"{result['codec']:<6} {result['profile']:<8} {result['ms_mean']:>9.2f} "
+                f"{result['ms_p95']:>8.2f} {result['bits_mean']:>11.0f} {result['kbps']:>8.1f}"
+            )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
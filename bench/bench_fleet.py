@@ -0,0 +1,245 @@
+"""
+Fleet Overhead Benchmark
+
+同じVM群を、フリートモード（1プロセスでN台）とVMごとの個別プロセスで配信し、
+VMあたりのメモリとCPU使用率を比較する
+
+メモリはPSS（共有ライブラリをプロセス数で按分、取れない場合はRSS）。子プロセスも含む。
+--viewers を付けるとVMごとにaiortcの受信クライアントを1つ接続し、配信中の負荷と
+受信フレームレートを測る。--workers を付けるとフリートモードをワーカープロセスに
+分散した場合（QEMU_WEBRTC_WORKERS）も比較する。
+
+使い方:
+    python bench/bench_fleet.py --socket-dir /run/qemu-webrtc                # ディレクトリの全VM
+    python bench/bench_fleet.py --socket-dir /run/qemu-webrtc --count 8 --viewers --duration 30
+    python bench/bench_fleet.py --socket-dir /run/qemu-webrtc --viewers --workers 4
+"""
+
+import argparse
+import asyncio
+import os
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import aiohttp
+from aiortc import RTCPeerConnection, RTCSessionDescription
+
+ROOT = Path(__file__).parent.parent
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+
+def find_sockets(socket_dir: Path, count: int):
+    """ソケットディレクトリのD-Busソケット（名前順に最大count個）"""
+    sockets = [p for p in sorted(socket_dir.iterdir()) if stat.S_ISSOCK(p.stat().st_mode)]
+    return sockets[:count] if count > 0 else sockets
+
+
+def memory_kb(pid: int) -> int:
+    """プロセスのPSS（なければRSS）をKBで返す"""
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def cpu_seconds(pid: int) -> float:
+    """プロセスのユーザー+システムCPU時間（秒）"""
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+
+def process_tree(pid: int) -> list:
+    """pidと子孫プロセスのpid（ワーカープロセスを含める）"""
+    pids = [pid]
+    try:
+        for tid in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{tid}/children") as f:
+                for child in f.read().split():
+                    pids.extend(process_tree(int(child)))
+    except OSError:
+        pass
+    return pids
+
+
+def start_server(port: int, env_overrides: dict) -> subprocess.Popen:
+    env = dict(os.environ, QEMU_WEBRTC_PORT=str(port), **env_overrides)
+    return subprocess.Popen(
+        [sys.executable, str(ROOT / "server" / "main.py")],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+
+
+async def wait_ready(session: aiohttp.ClientSession, url: str, timeout: float) -> bool:
+    """/readyが200を返すまで待つ"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            async with session.get(url) as response:
+                if response.status == 200:
+                    return True
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.5)
+    return False
+
+
+async def connect_viewer(session: aiohttp.ClientSession, base_url: str) -> RTCPeerConnection:
+    """受信専用のクライアントを接続し、フレームを受け取り続ける（pc.framesに受信数）"""
+    pc = RTCPeerConnection()
+    pc.addTransceiver("video", direction="recvonly")
+    pc.frames = 0
+
+    @pc.on("track")
+    def on_track(track):
+        async def drain():
+            while True:
+                try:
+                    await track.recv()
+                except Exception:
+                    return
+                pc.frames += 1
+        asyncio.ensure_future(drain())
+
+    await pc.setLocalDescription(await pc.createOffer())
+    async with session.post(f"{base_url}/offer", json={
+        "sdp": pc.localDescription.sdp, "type": pc.localDescription.type,
+    }) as response:
+        answer = await response.json()
+    await pc.setRemoteDescription(RTCSessionDescription(sdp=answer["sdp"], type=answer["type"]))
+    return pc
+
+
+async def measure(mode: str, processes, base_urls, args) -> dict:
+    """全サーバーの準備完了を待ち、視聴者を接続してからメモリとCPUを計測"""
+    viewers = []
+    async with aiohttp.ClientSession() as session:
+        for url in base_urls:
+            if not await wait_ready(session, f"{url}/ready", args.ready_timeout):
+                raise RuntimeError(f"{mode}: {url} did not become ready")
+        if args.viewers:
+            viewers = [await connect_viewer(session, url) for url in base_urls]
+        await asyncio.sleep(args.settle)
+
+        pids = [pid for p in processes for pid in process_tree(p.pid)]
+        cpu_start = sum(cpu_seconds(pid) for pid in pids)
+        frames_start = sum(pc.frames for pc in viewers)
+        started = time.monotonic()
+        await asyncio.sleep(args.duration)
+        cpu_used = sum(cpu_seconds(pid) for pid in pids) - cpu_start
+        elapsed = time.monotonic() - started
+        frames = sum(pc.frames for pc in viewers) - frames_start
+        memory = sum(memory_kb(pid) for pid in pids)
+
+        for pc in viewers:
+            await pc.close()
+
+    vm_count = len(base_urls)
+    return {
+        "mode": mode,
+        "processes": len(pids),
+        "vms": vm_count,
+        "memory_mb": memory / 1024,
+        "memory_mb_per_vm": memory / 1024 / vm_count,
+        "cpu_pct": cpu_used / elapsed * 100,
+        "cpu_pct_per_vm": cpu_used / elapsed * 100 / vm_count,
+        "fps_per_vm": frames / elapsed / vm_count if viewers else None,
+    }
+
+
+def stop_all(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+async def run_fleet(sockets, args, workers: int = 0) -> dict:
+    """フリートモード: 選んだソケットだけを置いた一時ディレクトリを1プロセス（＋ワーカー）で配信"""
+    with tempfile.TemporaryDirectory(prefix="bench-fleet-") as fleet_dir:
+        for path in sockets:
+            os.symlink(path.resolve(), Path(fleet_dir) / path.name)
+        process = start_server(args.port, {
+            "QEMU_WEBRTC_FLEET_DIR": fleet_dir,
+            "QEMU_WEBRTC_WORKERS": str(workers),
+        })
+        try:
+            base = f"http://127.0.0.1:{args.port}"
+            vm_urls = [f"{base}/vm/{path.name.split('.', 1)[0]}" for path in sockets]
+            return await measure(f"workers{workers}" if workers else "fleet", [process], vm_urls, args)
+        finally:
+            stop_all([process])
+
+
+async def run_separate(sockets, args) -> dict:
+    """個別プロセス: VMごとにサーバーを起動（ポートは連番）"""
+    processes = []
+    try:
+        for i, path in enumerate(sockets):
+            processes.append(start_server(args.port + 1 + i, {
+                "DBUS_SESSION_BUS_ADDRESS": f"unix:path={path.resolve()}",
+                "QEMU_WEBRTC_FLEET_DIR": "",
+                "QEMU_WEBRTC_WORKERS": "0",
+            }))
+        urls = [f"http://127.0.0.1:{args.port + 1 + i}" for i in range(len(sockets))]
+        return await measure("separate", processes, urls, args)
+    finally:
+        stop_all(processes)
+
+
+async def run(args) -> int:
+    sockets = find_sockets(args.socket_dir, args.count)
+    if not sockets:
+        print(f"No D-Bus sockets in {args.socket_dir}")
+        return 1
+
+    print(f"VMs: {len(sockets)} ({', '.join(p.name for p in sockets)}), "
+          f"viewers: {'yes' if args.viewers else 'no'}, {args.duration}s")
+    print(f"{'mode':<9} {'procs':>5} {'MB total':>9} {'MB/VM':>7} {'CPU%':>7} {'CPU%/VM':>8} {'fps/VM':>7}")
+    runners = [run_fleet, run_separate]
+    if args.workers:
+        runners.append(lambda sockets, args: run_fleet(sockets, args, workers=args.workers))
+    for runner in runners:
+        result = await runner(sockets, args)
+        fps = f"{result['fps_per_vm']:.1f}" if result["fps_per_vm"] is not None else "-"
+        print(
+            f"{result['mode']:<9} {result['processes']:>5} {result['memory_mb']:>9.1f} "
+            f"{result['memory_mb_per_vm']:>7.1f} {result['cpu_pct']:>7.1f} {result['cpu_pct_per_vm']:>8.2f} "
+            f"{fps:>7}"
+        )
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fleet mode vs one process per VM")
+    parser.add_argument("--socket-dir", type=Path, required=True,
+                        help="directory with one D-Bus bus socket per VM")
+    parser.add_argument("--count", type=int, default=0, help="number of VMs (0 = all)")
+    parser.add_argument("--viewers", action="store_true", help="connect one viewer per VM")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="also run fleet mode with this many worker processes")
+    parser.add_argument("--duration", type=float, default=20.0, help="CPU sampling window (s)")
+    parser.add_argument("--settle", type=float, default=5.0, help="wait before sampling (s)")
+    parser.add_argument("--ready-timeout", type=float, default=60.0)
+    parser.add_argument("--port", type=int, default=18081, help="fleet port (separate mode uses port+1..)")
+    args = parser.parse_args()
+    return asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
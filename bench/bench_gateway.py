@@ -0,0 +1,137 @@
+"""
+Gateway Routing Benchmark
+
+1台のマシン上でゲートウェイとN個のノードを起動し、ゲートウェイ経由で視聴者を接続して
+ノードへの振り分けとOffer/Answerの往復時間（直接接続との差）を確認する
+
+ノードはすべて同じD-Busバス（DBUS_SESSION_BUS_ADDRESS）のQEMUに接続し、同じVM IDで
+登録するため、ゲートウェイからは同じVMを配信するノードの組に見える。
+--fleet-dir を付けるとノードをフリートモードで起動する（VM IDはソケット名）。
+
+使い方:
+    python bench/bench_gateway.py --nodes 3 --viewers 9
+    python bench/bench_gateway.py --nodes 2 --fleet-dir /run/qemu-webrtc --vm vm1
+"""
+
+import argparse
+import asyncio
+import secrets
+import statistics
+import sys
+import time
+from collections import Counter
+
+import aiohttp
+from aiortc import RTCPeerConnection, RTCSessionDescription
+
+from bench_fleet import start_server, stop_all, wait_ready
+
+
+async def wait_nodes(session: aiohttp.ClientSession, gateway: str, vm_id: str, count: int,
+                     timeout: float) -> bool:
+    """count個のノードがVMを準備完了で登録するまで待つ"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            async with session.get(f"{gateway}/vms") as response:
+                vms = (await response.json())["vms"]
+            if sum(1 for vm in vms if vm["id"] == vm_id and vm["state"] == "ready") >= count:
+                return True
+        except (aiohttp.ClientError, KeyError):
+            pass
+        await asyncio.sleep(0.5)
+    return False
+
+
+async def offer(session: aiohttp.ClientSession, base_url: str):
+    """受信専用のOfferを送り、Answerまでの時間（ms）と接続を返す"""
+    pc = RTCPeerConnection()
+    pc.addTransceiver("video", direction="recvonly")
+    await pc.setLocalDescription(await pc.createOffer())
+    started = time.perf_counter()
+    async with session.post(f"{base_url}/offer", json={
+        "sdp": pc.localDescription.sdp, "type": pc.localDescription.type,
+    }) as response:
+        answer = await response.json()
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    await pc.setRemoteDescription(RTCSessionDescription(sdp=answer["sdp"], type=answer["type"]))
+    return elapsed_ms, pc
+
+
+async def run(args) -> int:
+    gateway = f"http://127.0.0.1:{args.port}"
+    token = secrets.token_urlsafe(32)
+    processes = [start_server(args.port, {"QEMU_WEBRTC_GATEWAY": "1", "QEMU_WEBRTC_FLEET_DIR": "",
+                                          "QEMU_WEBRTC_GATEWAY_TOKEN": token})]
+    node_ports = [args.port + 1 + i for i in range(args.nodes)]
+    for i, port in enumerate(node_ports):
+        processes.append(start_server(port, {
+            "QEMU_WEBRTC_GATEWAY_URL": gateway,
+            "QEMU_WEBRTC_NODE_ID": f"node{i}",
+            "QEMU_WEBRTC_PUBLIC_URL": f"http://127.0.0.1:{port}",
+            "QEMU_WEBRTC_HEARTBEAT": "1",
+            "QEMU_WEBRTC_GATEWAY_TOKEN": token,
+            "QEMU_WEBRTC_FLEET_DIR": args.fleet_dir or "",
+        }))
+
+    viewers = []
+    try:
+        async with aiohttp.ClientSession() as session:
+            if not await wait_ready(session, f"{gateway}/nodes", args.ready_timeout):
+                print("gateway did not start")
+                return 1
+            if not await wait_nodes(session, gateway, args.vm, args.nodes, args.ready_timeout):
+                print(f"{args.nodes} nodes did not register VM {args.vm}")
+                return 1
+
+            # ゲートウェイ経由（視聴者ごとに最も空いているノードへ）
+            gateway_ms = []
+            for _ in range(args.viewers):
+                elapsed_ms, pc = await offer(session, f"{gateway}/vm/{args.vm}")
+                gateway_ms.append(elapsed_ms)
+                viewers.append(pc)
+                # 次の視聴者の前にハートビートで負荷が反映されるのを待つ
+                await asyncio.sleep(args.spacing)
+
+            # 直接接続（比較用）
+            direct_base = f"http://127.0.0.1:{node_ports[0]}"
+            if args.fleet_dir:
+                direct_base += f"/vm/{args.vm}"
+            direct_ms = []
+            for _ in range(args.viewers):
+                elapsed_ms, pc = await offer(session, direct_base)
+                direct_ms.append(elapsed_ms)
+                await pc.close()
+
+            await asyncio.sleep(1.5)
+            async with session.get(f"{gateway}/vms") as response:
+                vms = (await response.json())["vms"]
+            distribution = Counter({vm["node"]: vm["viewers"] for vm in vms if vm["id"] == args.vm})
+    finally:
+        for pc in viewers:
+            await pc.close()
+        stop_all(processes)
+
+    print(f"nodes: {args.nodes}, viewers: {args.viewers}, VM: {args.vm}")
+    print("viewers per node: " + ", ".join(f"{node}={count}" for node, count in sorted(distribution.items())))
+    print(f"offer via gateway: median {statistics.median(gateway_ms):.1f}ms, max {max(gateway_ms):.1f}ms")
+    print(f"offer direct:      median {statistics.median(direct_ms):.1f}ms, max {max(direct_ms):.1f}ms")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gateway routing across local nodes")
+    parser.add_argument("--nodes", type=int, default=3, help="number of node processes")
+    parser.add_argument("--viewers", type=int, default=6, help="viewers connected through the gateway")
+    parser.add_argument("--vm", default="default", help="VM ID to connect to")
+    parser.add_argument("--fleet-dir", help="run nodes in fleet mode on this socket directory")
+    parser.add_argument("--spacing", type=float, default=1.2,
+                        help="wait between viewers so heartbeats report the new load (s)")
+    parser.add_argument("--ready-timeout", type=float, default=60.0)
+    parser.add_argument("--port", type=int, default=18180, help="gateway port (nodes use port+1..)")
+    args = parser.parse_args()
+    return asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
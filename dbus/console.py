@@ -0,0 +1,493 @@
+"""
+Console Capture
+
+QEMUの1コンソール（マルチヘッドのゲストでは1ヘッド）分の画面取得
+
+コンソールごとにRegisterListenerでP2P接続を張り、フレームバッファ・
+シーケンス番号・解像度の世代を個別に持つ。GLibメインループとEGLレンダラーは
+DisplayCaptureが全コンソールで共有する。
+
+GDBusは全接続のメッセージを1つのワーカースレッドで受け取るため、Listenerの処理
+（画素変換・DMA-BUFの読み出し）はコンソールごとのディスパッチスレッドで行い、
+あるコンソールの大きな更新が他のコンソールを待たせないようにする。
+QEMUへの応答は処理後に返す（DMA-BUFはQEMUが応答まで書き換えを待つ）。
+"""
+
+import asyncio
+import logging
+import queue
+import socket
+import threading
+import time
+import numpy as np
+from typing import Optional
+
+from telemetry import metrics, tracing
+from .listener import DisplayListener
+from .p2p_glib import P2PListenerServer
+from .register_listener_helper import call_register_listener_with_fd
+
+logger = logging.getLogger(__name__)
+
+
+class ConsoleCapture:
+    """
+    1コンソール分のフレームバッファとDisplayListener
+
+    QEMUVideoTrack・SnapshotCache・LatencyTrackerはこのオブジェクト
+    （またはプライマリコンソールに委譲するDisplayCapture）からフレームを読む。
+    """
+
+    def __init__(self, console_id: Optional[int] = None, width: int = 640, height: int = 480):
+        """
+        Args:
+            console_id: QEMUのコンソールID（Noneは接続前の仮コンソール）
+            width, height: 初期サイズ
+        """
+        self.console_id = console_id
+        self.console_path = None
+        if console_id is not None:
+            self.console_path = f"/org/qemu/Display1/Console_{console_id}"
+        self.console_proxy = None
+        self.label = None
+        self.head = None
+        self.console_type = None
+
+        # DisplayListener & P2P Server
+        self.listener = None
+        self.p2p_server = None
+
+        # asyncioループ（メインスレッドの）
+        self.main_loop = None
+
+        # 画面情報
+        self.width = width
+        self.height = height
+
+        # フレーム管理
+        self.current_frame: Optional[np.ndarray] = None
+        self.frame_lock = asyncio.Lock()
+        self.frame_event = asyncio.Event()
+        # ディスパッチスレッド（部分更新・リサイズ）とasyncioループ間のバッファ保護
+        self.buffer_lock = threading.Lock()
+        # フレーム更新ごとに進むシーケンス番号（複数のVideoTrackが個別に追跡）
+        self.frame_seq = 0
+
+        # 解像度変更管理（世代番号が変わったらVideoTrackがキーフレームを要求）
+        self.resolution_generation = 0
+        self.resize_time: Optional[float] = None  # time.monotonic()
+
+        # 部分更新（damage）の通知先 callback(x, y, width, height, frame_seq)
+        # 入力→画面更新の遅延計測に使う。ディスパッチスレッドから呼ばれる
+        self.damage_listeners = []
+
+        # ソケットオブジェクトを保持（GC対策）
+        self.client_socket = None
+        self.server_socket = None
+
+        # Listener呼び出しのキュー（GDBusワーカースレッド → ディスパッチスレッド）
+        self._calls = queue.SimpleQueue()
+        self._dispatch_thread = None
+        self.dispatched = 0
+        self.max_backlog = 0
+
+        # クライアント表示サイズに基づくSetUIInfo（デバウンス）
+        self.ui_info_debounce = 0.5  # 秒
+        self._ui_info_handle = None
+        self._ui_info_pending = None
+        self._ui_info_current = None
+        self._ui_info_sending = False  # executorでSetUIInfoを送信中
+
+    def attach(self, bus):
+        """
+        バス上のConsoleプロキシを取得し、サイズとラベルを読む
+
+        Args:
+            bus: dasbusのメッセージバス（SessionMessageBus / AddressedMessageBus）
+        """
+        self.console_proxy = bus.get_proxy(
+            "org.qemu",
+            self.console_path,
+            "org.qemu.Display1.Console"
+        )
+        self.width = self.console_proxy.Width
+        self.height = self.console_proxy.Height
+        # Label/Head/TypeはQEMUのバージョンによってはないため省略可
+        for attr, name in (("label", "Label"), ("head", "Head"), ("console_type", "Type")):
+            try:
+                setattr(self, attr, getattr(self.console_proxy, name))
+            except Exception:
+                pass
+        logger.info(f"Console {self.console_id}: {self.width}x{self.height} "
+                    f"label={self.label!r} head={self.head} type={self.console_type}")
+
+    def describe(self) -> dict:
+        """クライアントのコンソール選択用の情報"""
+        return {
+            "id": self.console_id,
+            "label": self.label,
+            "head": self.head,
+            "type": self.console_type,
+            "width": self.width,
+            "height": self.height,
+        }
+
+    def setup_listener(self, main_loop, bus_address: Optional[str] = None) -> bool:
+        """
+        RegisterListenerを呼び出し、このコンソール用のDisplayListenerを登録
+
+        GLibメインループはDisplayCaptureが起動する（全コンソール共有）
+
+        Args:
+            main_loop: フレームを受け取るasyncioループ
+            bus_address: QEMUが接続しているバスのアドレス（Noneでセッションバス）
+
+        Returns:
+            成功時True
+        """
+        self.main_loop = main_loop
+
+        # 1. DisplayListenerインスタンス作成
+        self.listener = DisplayListener(self)
+
+        # 2. UNIXソケットペア作成
+        self.client_socket, self.server_socket = socket.socketpair(
+            socket.AF_UNIX,
+            socket.SOCK_STREAM
+        )
+
+        # ソケットバッファサイズを増やす（大きなUpdateメッセージ用）
+        for sock in (self.client_socket, self.server_socket):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 16*1024*1024)  # 16MB
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 16*1024*1024)  # 16MB
+        logger.info(f"✓ Socket pair created for console {self.console_id}: "
+                    f"client_fd={self.client_socket.fileno()}, server_fd={self.server_socket.fileno()}")
+
+        # 3. ディスパッチスレッドを先に起動（QEMUはRegisterListener直後からScanoutを送る）
+        self._dispatch_thread = threading.Thread(
+            target=self._dispatch_loop, name=f"console-{self.console_id}", daemon=True
+        )
+        self._dispatch_thread.start()
+
+        # 4. 先にQEMUにRegisterListenerを呼び出す（QEMU側がサーバーになる）
+        if not call_register_listener_with_fd(self.console_path, self.server_socket.fileno(), bus_address):
+            logger.error(f"RegisterListener call failed for {self.console_path}")
+            return False
+
+        # 5. P2P D-Busクライアント接続（client_socketでQEMUに接続）
+        self.p2p_server = P2PListenerServer(self.listener, dispatch=self.dispatch)
+        if not self.p2p_server.setup(self.client_socket):
+            logger.error(f"✗ P2P client connection failed for {self.console_path}")
+            return False
+
+        logger.info(f"✓ P2P client connected to QEMU ({self.console_path})")
+        return True
+
+    def dispatch(self, method, args: tuple, reply, received: Optional[float] = None):
+        """
+        Listenerのメソッド呼び出しをディスパッチスレッドに渡す（GDBusワーカースレッドから呼ばれる）
+
+        Args:
+            method: DisplayListenerのメソッド
+            args: 引数
+            reply: 処理後に呼ぶ関数（QEMUへのメソッドリターン送信）
+            received: メッセージを受け取った時刻（time.perf_counter()、dbus_receiveの計測用）
+        """
+        self._calls.put((method, args, reply, received))
+        backlog = self._calls.qsize()
+        if backlog > self.max_backlog:
+            self.max_backlog = backlog
+
+    def _dispatch_loop(self):
+        while True:
+            item = self._calls.get()
+            if item is None:
+                return
+            method, args, reply, received = item
+            started = time.perf_counter()
+            if received is not None:
+                metrics.DBUS_RECEIVE.observe(started - received)
+            try:
+                method(*args)
+            except Exception as e:
+                logger.error(f"Console {self.console_id} dispatch error: {e}")
+            finally:
+                reply()
+            self.dispatched += 1
+            if received is not None and tracing.TRACER.enabled:
+                tracing.TRACER.span(f"listener.{method.__name__}", started, cat="dbus",
+                                    flow_in=(tracing.FLOW_MESSAGE, tracing.flow_id(received)),
+                                    console=self.console_id)
+
+    def set_ui_info(self, width: int, height: int, width_mm: int = 0, height_mm: int = 0) -> bool:
+        """
+        SetUIInfoを呼び出す
+
+        Args:
+            width, height: 表示サイズ（ピクセル）
+            width_mm, height_mm: 物理サイズ（0 = 指定なし）
+
+        Returns:
+            成功時True
+        """
+        try:
+            self.console_proxy.SetUIInfo(
+                width_mm,
+                height_mm,
+                0,  # xoff
+                0,  # yoff
+                width,   # width (pixels)
+                height   # height (pixels)
+            )
+            self._ui_info_current = (width, height, width_mm, height_mm)
+            logger.info(f"✓ SetUIInfo called on console {self.console_id}: "
+                        f"{width}x{height} ({width_mm}x{height_mm}mm)")
+            return True
+        except Exception as e:
+            logger.warning(f"SetUIInfo failed (may still work): {e}")
+            return False
+
+    def request_ui_info(self, width: int, height: int, dpr: float = 1.0):
+        """
+        クライアントの表示サイズをゲストに通知（デバウンス付き）
+
+        ウィンドウのリサイズ中に連続で呼ばれるため、最後の要求から
+        ui_info_debounce秒経過した時点で1回だけSetUIInfoを呼ぶ。
+        リサイズ対応ドライバのゲストはこのサイズで描画し直す。
+
+        Args:
+            width, height: 表示サイズ（デバイスピクセル）
+            dpr: devicePixelRatio（物理サイズの算出に使用）
+        """
+        if self.console_proxy is None or self.main_loop is None:
+            return
+
+        # ゲストドライバが扱いやすいよう8の倍数に丸める
+        width = max(640, min(7680, int(width) // 8 * 8))
+        height = max(480, min(4320, int(height) // 8 * 8))
+        # CSSピクセル = 1/96インチとして物理サイズを算出（HiDPIでのスケーリング判定用）
+        width_mm = int(width / max(dpr, 0.5) * 25.4 / 96)
+        height_mm = int(height / max(dpr, 0.5) * 25.4 / 96)
+
+        self._ui_info_pending = (width, height, width_mm, height_mm)
+        if self._ui_info_handle is not None:
+            self._ui_info_handle.cancel()
+        self._ui_info_handle = self.main_loop.call_later(
+            self.ui_info_debounce, self._flush_ui_info
+        )
+
+    def _flush_ui_info(self):
+        """
+        保留中のSetUIInfo要求をexecutorで送信
+
+        一時停止中のQEMUはD-Busのタイムアウトまで応答しないため、asyncioループ
+        （フリートでは全VMのシグナリング・RTP・入力）では呼ばない。
+        送信は1件ずつ行い、送信中に届いた要求は完了後に最新のものだけを送る。
+        """
+        self._ui_info_handle = None
+        if self._ui_info_sending:
+            return
+        pending = self._ui_info_pending
+        self._ui_info_pending = None
+        if pending is None or pending == self._ui_info_current:
+            return
+        self._ui_info_sending = True
+        future = self.main_loop.run_in_executor(None, self.set_ui_info, *pending)
+        future.add_done_callback(self._ui_info_sent)
+
+    def _ui_info_sent(self, future):
+        """SetUIInfoの送信完了（ループ上で呼ばれる）"""
+        self._ui_info_sending = False
+        # デバウンス待ちの要求はタイマーで送られる
+        if self._ui_info_pending is not None and self._ui_info_handle is None:
+            self._flush_ui_info()
+
+    def update_frame_from_listener(self, rgb_frame: np.ndarray):
+        """
+        DisplayListenerからのフレーム更新（同期コールバック）
+
+        ディスパッチスレッドから呼ばれるため、メインスレッドのループを使う
+
+        Args:
+            rgb_frame: RGB形式のNumPy配列 (H, W, 3)
+        """
+        try:
+            if self.main_loop is None:
+                logger.error("Main asyncio loop not available")
+                return
+
+            # メインスレッドのループで実行
+            published = time.perf_counter()
+            asyncio.run_coroutine_threadsafe(
+                self._async_update_frame(rgb_frame, published),
+                self.main_loop
+            )
+            # ループ側のframe_publishへのフロー（ディスパッチスレッドのlistener.*区間から出る）
+            if tracing.TRACER.enabled:
+                tracing.TRACER.span("publish", published, cat="dbus",
+                                    flow_out=(tracing.FLOW_MESSAGE, tracing.flow_id(published)))
+        except Exception as e:
+            logger.error(f"Frame update error: {e}")
+
+    async def _async_update_frame(self, rgb_frame: np.ndarray, published: float):
+        """
+        非同期フレーム更新
+
+        Args:
+            rgb_frame: RGB形式のNumPy配列
+            published: ディスパッチスレッドが渡した時刻（time.perf_counter()）
+        """
+        started = time.perf_counter()
+        async with self.frame_lock:
+            with self.buffer_lock:
+                # リサイズ前にキューされた旧サイズのフレームは破棄
+                if rgb_frame.shape[:2] != (self.height, self.width):
+                    logger.debug(f"Dropping stale frame: {rgb_frame.shape}")
+                    metrics.DROPPED_STALE.inc()
+                    if tracing.TRACER.enabled:
+                        tracing.TRACER.span("frame_dropped", started, reason="stale", console=self.console_id,
+                                            flow_in=(tracing.FLOW_MESSAGE, tracing.flow_id(published)))
+                    return
+                self.current_frame = rgb_frame
+                self.frame_seq += 1
+                seq = self.frame_seq
+            self.frame_event.set()  # 待機中のget_frame()に通知
+        ended = metrics.FRAME_PUBLISH.observe_since(published)
+        if tracing.TRACER.enabled:
+            # 同じconsole_idのコンソールが複数のVMにあるため、フローはこのオブジェクトで区別する
+            tracing.TRACER.span("frame_publish", started, ended, console=self.console_id, seq=seq,
+                                flow_in=(tracing.FLOW_MESSAGE, tracing.flow_id(published)),
+                                flow_out=(tracing.FLOW_FRAME, tracing.flow_id(id(self), seq)))
+
+    def handle_resize(self, width: int, height: int):
+        """
+        解像度変更（Scanout系コールバックからディスパッチスレッドで呼ばれる）
+
+        フレームバッファを新サイズのものに差し替え、世代番号を進める。
+        PeerConnectionはそのままで、VideoTrackが新サイズでエンコーダを
+        再構成しキーフレームを要求する。
+
+        Args:
+            width, height: 新しい画面サイズ
+        """
+        if width == self.width and height == self.height:
+            return
+        with self.buffer_lock:
+            old_width, old_height = self.width, self.height
+            self.width = width
+            self.height = height
+            self.current_frame = np.zeros((height, width, 3), dtype=np.uint8)
+            self.frame_seq += 1
+            self.resize_time = time.monotonic()
+            self.resolution_generation += 1
+        logger.info(f"Console {self.console_id} resolution changed: "
+                    f"{old_width}x{old_height} -> {width}x{height} "
+                    f"(generation {self.resolution_generation})")
+
+    def notify_damage(self, x: int, y: int, width: int, height: int):
+        """
+        部分更新の通知（Listenerが画素データの処理前に呼ぶ）
+
+        通知時点のframe_seqより後のフレームにこの更新が含まれる。
+        """
+        seq = self.frame_seq
+        for listener in list(self.damage_listeners):
+            try:
+                listener(x, y, width, height, seq)
+            except Exception as e:
+                logger.error(f"Damage listener error: {e}")
+
+    def update_frame_region(self, x: int, y: int, rgb_patch: np.ndarray):
+        """
+        フレームの部分更新
+
+        Args:
+            x, y: 更新位置
+            rgb_patch: RGB部分データ
+        """
+        started = time.perf_counter()
+        try:
+            with self.buffer_lock:
+                # 初期フレームがない場合は黒画面を作成
+                if self.current_frame is None:
+                    logger.info(f"Creating initial frame from first Update: {self.width}x{self.height}")
+                    self.current_frame = np.zeros((self.height, self.width, 3), dtype=np.uint8)
+
+                # リサイズ直後の範囲外パッチはクリップ
+                h = min(rgb_patch.shape[0], self.height - y)
+                w = min(rgb_patch.shape[1], self.width - x)
+                if h <= 0 or w <= 0:
+                    return
+                self.current_frame[y:y+h, x:x+w] = rgb_patch[:h, :w]
+                self.frame_seq += 1
+                seq = self.frame_seq
+            self.frame_event.set()
+            ended = metrics.FRAME_PUBLISH.observe_since(started)
+            if tracing.TRACER.enabled:
+                tracing.TRACER.span("frame_publish", started, ended, console=self.console_id, seq=seq,
+                                    flow_out=(tracing.FLOW_FRAME, tracing.flow_id(id(self), seq)))
+        except Exception as e:
+            logger.error(f"Frame region update error: {e}")
+
+    async def get_frame(self) -> Optional[np.ndarray]:
+        """
+        新しいフレームが来た場合のみコピーを返す（更新がなければNone）
+        """
+        if self.frame_event.is_set():
+            async with self.frame_lock:
+                self.frame_event.clear()
+                with self.buffer_lock:
+                    if self.current_frame is not None:
+                        return self.current_frame.copy()
+        return None
+
+    def read_frame_into(self, acquire, since_seq: int):
+        """
+        最新フレームを呼び出し側のバッファに直接コピー
+
+        中間のndarray.copy()を作らず、VideoTrackのフレームプールへ書き込む。
+
+        Args:
+            acquire: (width, height) -> (frame, ndarrayビュー) を返す関数
+            since_seq: 呼び出し側が最後に取得したframe_seq
+
+        Returns:
+            (frame, frame_seq)、since_seq以降に更新がなければ (None, since_seq)
+        """
+        with self.buffer_lock:
+            if self.current_frame is None or self.frame_seq == since_seq:
+                return None, since_seq
+            height, width = self.current_frame.shape[:2]
+            frame, view = acquire(width, height)
+            np.copyto(view, self.current_frame)
+            return frame, self.frame_seq
+
+    async def get_latest_frame_copy(self) -> Optional[np.ndarray]:
+        """最新フレームのコピーを返す（イベント待ちなし）"""
+        async with self.frame_lock:
+            with self.buffer_lock:
+                if self.current_frame is not None:
+                    return self.current_frame.copy()
+        return None
+
+    def stats(self) -> dict:
+        """ディスパッチの統計（/consoles用）"""
+        return {
+            "frameSeq": self.frame_seq,
+            "dispatched": self.dispatched,
+            "backlog": self._calls.qsize(),
+            "maxBacklog": self.max_backlog,
+        }
+
+    def close(self):
+        """ディスパッチスレッド停止・P2P接続と共有メモリのクリーンアップ"""
+        if self._dispatch_thread is not None:
+            self._calls.put(None)
+            self._dispatch_thread.join(timeout=1.0)
+            self._dispatch_thread = None
+
+        if self.p2p_server:
+            self.p2p_server.cleanup()
+
+        if self.listener and self.listener.shared_memory:
+            self.listener.shared_memory.close()
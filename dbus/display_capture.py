@@ -2,20 +2,26 @@
 Display Capture - D-Bus Complete Version
 
 QEMUのD-Bus DisplayインターフェースからRegisterListener経由で画面を取得
+
+マルチヘッドのゲストでは全コンソール（QEMU_WEBRTC_CONSOLESで絞り込み可）に
+ConsoleCaptureでListenerを登録する。GLibメインループとEGLレンダラーは共有し、
+フレームバッファと画素変換はコンソールごとに独立している。
+フレーム関連の属性・メソッドはプライマリコンソール（最初のコンソール）に委譲する。
 """
 
 import asyncio
 import logging
-import socket
+import os
 import numpy as np
 from typing import Optional
-from dasbus.connection import SessionMessageBus
+from dasbus.connection import AddressedMessageBus, SessionMessageBus
 from dasbus.error import DBusError
 
-from .listener import DisplayListener
-from .p2p_glib import P2PListenerServer
-from .register_listener_helper import call_register_listener_with_fd
+from .console import ConsoleCapture
+from .dmabuf_gl import get_renderer
 from .glib_asyncio import GLibAsyncioIntegration
+from .input_connection import InputConnection
+from .input_sender import InputSender, InputTiming
 
 logger = logging.getLogger(__name__)
 
@@ -25,54 +31,160 @@ class DisplayCapture:
     D-Bus経由でQEMU画面をキャプチャし、入力イベントを送信
     """
     
-    def __init__(self):
-        """初期化"""
+    def __init__(self, bus_address: Optional[str] = None, glib_integration=None):
+        """
+        Args:
+            bus_address: QEMUが接続しているD-Busのアドレス（Noneでセッションバス）。
+                         フリートモードではVMごとのバスを指定する
+            glib_integration: 共有するGLibAsyncioIntegration（Noneなら自前で起動）
+        """
+        self.bus_address = bus_address
         self.bus = None
         self.vm_proxy = None
-        self.console_proxy = None
-        self.console_path = None
         
-        # DisplayListener & P2P Server
-        self.listener = None
-        self.p2p_server = None
+        # コンソールID -> ConsoleCapture（接続前は仮のプライマリのみ）
+        self.primary = ConsoleCapture()
+        self.consoles = {}
+        # 配信するコンソール（QEMU_WEBRTC_CONSOLES="all" または "0,1" のようなID一覧）
+        self.console_filter = os.environ.get("QEMU_WEBRTC_CONSOLES", "all").strip() or "all"
         
-        # GLibメインループ統合
-        self.glib_integration = None
+        # GLibメインループ統合（全コンソール共有、フリートモードでは全VM共有）
+        self.glib_integration = glib_integration
+        self._owns_glib_loop = glib_integration is None
         
         # asyncioループ（メインスレッドの）
         self.main_loop = None
         
-        # 画面情報
-        self.width = 640
-        self.height = 480
-        
-        # フレーム管理
-        self.current_frame: Optional[np.ndarray] = None
-        self.frame_lock = asyncio.Lock()
-        self.frame_event = asyncio.Event()
-        
         # プロキシキャッシュ（入力用）
         self.mouse_proxy = None
         self.keyboard_proxy = None
         
-        # ソケットオブジェクトを保持（GC対策）
-        self.client_socket = None
-        self.server_socket = None
+        # no-reply-expectedでの非同期入力送信（QEMU_WEBRTC_ASYNC_INPUT=0 で同期呼び出し）
+        self.async_input = os.environ.get("QEMU_WEBRTC_ASYNC_INPUT", "1") != "0"
+        self.input_sender = None  # InputConnection または InputSender
+        self.input_timing = InputTiming()
+        # 入力専用の接続と送信スレッド（QEMU_WEBRTC_INPUT_CONNECTION=shared で表示と共有）
+        self.input_connection_mode = os.environ.get("QEMU_WEBRTC_INPUT_CONNECTION", "dedicated")
+        
+        # executorで実行中のD-Bus呼び出し（完了前にdisconnect()された場合は完了後に切断）
+        self._pending_setup = None
         
         logger.info("DisplayCapture initialized")
     
+    # ========== プライマリコンソールへの委譲（単一コンソール時と同じAPI） ==========
+    
+    @property
+    def console_path(self):
+        return self.primary.console_path
+    
+    @property
+    def console_proxy(self):
+        return self.primary.console_proxy
+    
+    @property
+    def width(self) -> int:
+        return self.primary.width
+    
+    @property
+    def height(self) -> int:
+        return self.primary.height
+    
+    @property
+    def frame_seq(self) -> int:
+        return self.primary.frame_seq
+    
+    @property
+    def resolution_generation(self) -> int:
+        return self.primary.resolution_generation
+    
+    @property
+    def resize_time(self) -> Optional[float]:
+        return self.primary.resize_time
+    
+    @property
+    def current_frame(self) -> Optional[np.ndarray]:
+        return self.primary.current_frame
+    
+    @property
+    def damage_listeners(self) -> list:
+        return self.primary.damage_listeners
+    
+    def read_frame_into(self, acquire, since_seq: int):
+        return self.primary.read_frame_into(acquire, since_seq)
+    
+    async def get_frame(self) -> Optional[np.ndarray]:
+        return await self.primary.get_frame()
+    
+    async def get_latest_frame_copy(self) -> Optional[np.ndarray]:
+        return await self.primary.get_latest_frame_copy()
+    
+    def request_ui_info(self, width: int, height: int, dpr: float = 1.0):
+        self.primary.request_ui_info(width, height, dpr)
+    
+    def console(self, console_id=None) -> ConsoleCapture:
+        """
+        コンソールを取得
+        
+        Args:
+            console_id: コンソールID（Noneでプライマリ）
+        
+        Raises:
+            KeyError: 配信対象にないコンソールID
+        """
+        if console_id is None:
+            return self.primary
+        return self.consoles[int(console_id)]
+    
+    def _select_consoles(self, console_ids: list) -> list:
+        """QEMU_WEBRTC_CONSOLESで配信するコンソールを絞り込む（指定順、存在しないIDは無視）"""
+        if self.console_filter == "all":
+            return list(console_ids)
+        wanted = []
+        for value in self.console_filter.split(","):
+            try:
+                console_id = int(value)
+            except ValueError:
+                logger.warning(f"Ignoring invalid console ID in QEMU_WEBRTC_CONSOLES: {value!r}")
+                continue
+            if console_id in console_ids and console_id not in wanted:
+                wanted.append(console_id)
+        return wanted
+    
+    async def _run_blocking(self, func):
+        """
+        同期のD-Bus呼び出しをexecutorで実行
+        
+        応答しないQEMU（一時停止中など）はD-Busのタイムアウトまで呼び出しをブロックするため、
+        asyncioループ（全VMのシグナリング・RTP・入力）を止めないようにする。
+        呼び出し側がキャンセル（asyncio.wait_forのタイムアウト）してもスレッドの処理は続き、
+        その間のdisconnect()は処理の完了後に行う。
+        """
+        future = asyncio.get_running_loop().run_in_executor(None, func)
+        self._pending_setup = future
+        try:
+            return await asyncio.shield(future)
+        finally:
+            if future.done():
+                self._pending_setup = None
+    
     async def connect(self) -> bool:
         """
-        QEMU D-Busに接続
+        QEMU D-Busに接続（プロキシ作成・プロパティ読み取り・入力接続はexecutorで実行）
         
         Returns:
             成功時True
         """
+        return await self._run_blocking(self._connect_sync)
+    
+    def _connect_sync(self) -> bool:
         try:
             logger.info("Connecting to D-Bus session bus...")
             
-            # セッションバス接続
-            self.bus = SessionMessageBus()
+            # バス接続（既定はセッションバス）
+            if self.bus_address:
+                self.bus = AddressedMessageBus(self.bus_address)
+            else:
+                self.bus = SessionMessageBus()
             
             # VM proxy取得
             logger.info("Getting VM proxy...")
@@ -90,23 +202,20 @@ class DisplayCapture:
             
             logger.info(f"Available consoles: {console_ids}")
             
-            # 最初のコンソールを使用
-            console_id = console_ids[0]
-            self.console_path = f"/org/qemu/Display1/Console_{console_id}"
-            
-            logger.info(f"Using console: {self.console_path}")
-            
-            # Console proxy取得
-            self.console_proxy = self.bus.get_proxy(
-                "org.qemu",
-                self.console_path,
-                "org.qemu.Display1.Console"
-            )
+            selected = self._select_consoles(console_ids)
+            if not selected:
+                logger.error(f"No consoles match QEMU_WEBRTC_CONSOLES={self.console_filter}")
+                return False
             
-            # 画面サイズ取得
-            self.width = self.console_proxy.Width
-            self.height = self.console_proxy.Height
+            # 全コンソールのプロキシ取得（最初のコンソールがプライマリ、入力もこのコンソールへ送る）
+            self.consoles = {}
+            for console_id in selected:
+                console = ConsoleCapture(console_id)
+                console.attach(self.bus)
+                self.consoles[console_id] = console
+            self.primary = self.consoles[selected[0]]
             
+            logger.info(f"Using consoles: {selected} (primary {self.console_path})")
             logger.info(f"✓ D-Bus connected: {self.width}x{self.height}")
             
             # 入力プロキシを初期化
@@ -140,18 +249,56 @@ class DisplayCapture:
             )
             logger.info("✓ Keyboard proxy initialized")
             
+            if self.async_input:
+                self.input_sender = self._create_input_sender()
+            
         except Exception as e:
             logger.error(f"Failed to initialize input proxies: {e}")
     
+    def _create_input_sender(self):
+        """
+        入力の送信経路を作成
+        
+        dedicated: 表示（GDBusのワーカースレッド）と独立したソケットと送信スレッド
+        shared: セッションバスの接続を共有（GDBusのワーカースレッド経由）
+        """
+        if self.input_connection_mode == "dedicated":
+            address = self.bus_address or os.environ.get("DBUS_SESSION_BUS_ADDRESS", "")
+            try:
+                return InputConnection(address, self.console_path)
+            except Exception as e:
+                logger.warning(f"Dedicated input connection unavailable, sharing session bus: {e}")
+        return InputSender(self.bus.connection, self.console_path)
+    
+    def input_connection_stats(self) -> dict:
+        """入力の送信経路と統計"""
+        sender = self.input_sender
+        if isinstance(sender, InputConnection):
+            return {"mode": "dedicated", **sender.stats()}
+        if sender is not None:
+            return {"mode": "shared", "sent": sender.sent}
+        return {"mode": "sync"}
+    
+    def start_glib_loop(self):
+        """
+        GLibメインループを先に起動（ウォームスタート用）
+        
+        setup_listener()より前に呼ぶと、P2P接続の準備と並行してループが立ち上がる
+        """
+        if self.glib_integration is None:
+            self.glib_integration = GLibAsyncioIntegration()
+        self.glib_integration.start()
+    
     async def setup_listener(self) -> bool:
         """
-        RegisterListenerを呼び出し、DisplayListenerを登録
+        全コンソールでRegisterListenerを呼び出し、DisplayListenerを登録
         
         GLib/Gioを使ったP2P D-Bus接続実装
         参考: qemu-display (Rust実装)
         
         Returns:
-            成功時True
+            プライマリコンソールの登録に成功した場合True
+            （他のコンソールは失敗しても配信対象から外すだけ）
         """
         try:
             logger.info("=== Setting up RegisterListener (GLib/Gio implementation) ===")
@@ -159,72 +306,27 @@ class DisplayCapture:
             # メインスレッドのasyncioループを保存
             self.main_loop = asyncio.get_event_loop()
             
-            # 1. DisplayListenerインスタンス作成
-            self.listener = DisplayListener(self)
-            logger.info("✓ DisplayListener instance created")
+            # 複数のディスパッチスレッドがEGLコンテキストを共有する
+            if len(self.consoles) > 1:
+                get_renderer().shared = True
             
-            # 2. UNIXソケットペア作成
-            logger.info("Creating socket pair...")
-            self.client_socket, self.server_socket = socket.socketpair(
-                socket.AF_UNIX,
-                socket.SOCK_STREAM
-            )
-            
-            # ソケットバッファサイズを増やす（大きなUpdateメッセージ用）
-            self.client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 16*1024*1024)  # 16MB
-            self.client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 16*1024*1024)  # 16MB
-            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 16*1024*1024)  # 16MB
-            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 16*1024*1024)  # 16MB
-            logger.info(f"✓ Socket pair created: client_fd={self.client_socket.fileno()}, server_fd={self.server_socket.fileno()}")
-            
-            # 3. 先にQEMUにRegisterListenerを呼び出す（QEMU側がサーバーになる）
-            logger.info("Calling RegisterListener...")
-            
-            if not call_register_listener_with_fd(self.console_path, self.server_socket.fileno()):
-                logger.error("RegisterListener call failed")
+            # RegisterListenerとP2P接続のハンドシェイクはexecutorで実行
+            if not await self._run_blocking(self._register_listeners):
                 return False
             
-            logger.info("✓ RegisterListener called - QEMU is now waiting for connection")
-            
-            # 4. P2P D-Busクライアント接続（client_socketでQEMUに接続）
-            logger.info("Creating P2P D-Bus client connection...")
-            self.p2p_server = P2PListenerServer(self.listener)
-            
-            if not self.p2p_server.setup(self.client_socket):
-                logger.error("✗ P2P client connection failed")
-                return False
-            
-            logger.info("✓ P2P client connected to QEMU")
-            
-            # 5. GLibメインループを開始（D-Busコールバック受信のため）
+            # GLibメインループを開始（D-Busコールバック受信のため）
             logger.info("Starting GLib main loop for D-Bus callbacks...")
-            self.glib_integration = GLibAsyncioIntegration()
-            
-            # バックグラウンドタスクとして起動
-            asyncio.create_task(self.glib_integration.run_glib_loop())
+            self.start_glib_loop()
             
-            # GLibループが起動するまで少し待つ
-            await asyncio.sleep(0.5)
+            # GLibループが起動するまで待つ（起動済みなら即座に戻る）
+            await self.glib_integration.wait_started()
             
-            logger.info("=== RegisterListener setup complete ===")
+            logger.info(f"=== RegisterListener setup complete ({len(self.consoles)} consoles) ===")
             logger.info("Waiting for frames from QEMU...")
             
             # SetUIInfo呼び出し - リフレッシュレート設定（Update/UpdateMapを有効化）
             logger.info("\nCalling SetUIInfo to enable screen updates...")
-            try:
-                # QEMUに60Hz更新を要求
-                self.console_proxy.SetUIInfo(
-                    0,  # width_mm (0 = not specified)
-                    0,  # height_mm (0 = not specified)
-                    0,  # xoff
-                    0,  # yoff
-                    self.width,   # width (pixels)
-                    self.height   # height (pixels)
-                )
-                logger.info(f"✓ SetUIInfo called: {self.width}x{self.height}")
-                logger.info("  This should trigger Update/UpdateMap callbacks")
-            except Exception as e:
-                logger.warning(f"SetUIInfo failed (may still work): {e}")
+            await self._run_blocking(self._enable_updates)
             
             return True
             
@@ -238,149 +340,118 @@ class DisplayCapture:
             logger.error(traceback.format_exc())
             return False
     
-    def update_frame_from_listener(self, rgb_frame: np.ndarray):
-        """
-        DisplayListenerからのフレーム更新（同期コールバック）
-        
-        GLibスレッドから呼ばれるため、メインスレッドのループを使う
-        
-        Args:
-            rgb_frame: RGB形式のNumPy配列 (H, W, 3)
-        """
-        try:
-            if self.main_loop is None:
-                logger.error("Main asyncio loop not available")
-                return
-            
-            # メインスレッドのループで実行
-            asyncio.run_coroutine_threadsafe(
-                self._async_update_frame(rgb_frame),
-                self.main_loop
-            )
-        except Exception as e:
-            logger.error(f"Frame update error: {e}")
-    
-    async def _async_update_frame(self, rgb_frame: np.ndarray):
-        """非同期フレーム更新"""
-        async with self.frame_lock:
-            self.current_frame = rgb_frame
-            self.frame_event.set()  # 待機中のget_frame()に通知
-            # ログなし（頻繁すぎるため）
+    def _register_listeners(self) -> bool:
+        """全コンソールにDisplayListenerを登録（プライマリの失敗のみFalse）"""
+        for console_id, console in list(self.consoles.items()):
+            logger.info(f"Registering listener on {console.console_path}...")
+            if console.setup_listener(self.main_loop, self.bus_address):
+                continue
+            if console is self.primary:
+                return False
+            logger.warning(f"Console {console_id} disabled (listener registration failed)")
+            console.close()
+            del self.consoles[console_id]
+        return True
     
-    def update_frame_region(self, x: int, y: int, rgb_patch: np.ndarray):
-        """
-        フレームの部分更新
-        
-        Args:
-            x, y: 更新位置
-            rgb_patch: RGB部分データ
-        """
-        try:
-            # 初期フレームがない場合は黒画面を作成
-            if self.current_frame is None:
-                logger.info(f"Creating initial frame from first Update: {self.width}x{self.height}")
-                self.current_frame = np.zeros((self.height, self.width, 3), dtype=np.uint8)
-            
-            h, w = rgb_patch.shape[:2]
-            self.current_frame[y:y+h, x:x+w] = rgb_patch
-            self.frame_event.set()
-            # ログなし（頻繁すぎるため）
-        except Exception as e:
-            logger.error(f"Frame region update error: {e}")
+    def _enable_updates(self):
+        for console in list(self.consoles.values()):
+            console.set_ui_info(console.width, console.height)
     
-    async def get_frame(self) -> Optional[np.ndarray]:
-        """
-        VideoTrackへのフレーム提供
-        
-        新しいフレームが来た場合のみ返す。
-        フレーム更新がない場合はNoneを返し、VideoTrackが前フレームを再送する。
-        
-        Returns:
-            RGB NumPy配列、またはNone
-        """
-        # フレーム更新があったかチェック
-        if self.frame_event.is_set():
-            async with self.frame_lock:
-                self.frame_event.clear()  # イベントをクリア
-                if self.current_frame is not None:
-                    return self.current_frame.copy()
-        
-        # 更新なし → Noneを返す（VideoTrackが前フレームを再送）
-        return None
-
-    async def get_latest_frame_copy(self) -> Optional[np.ndarray]:
-        """最新フレームのコピーを返す（イベント待ちなし）"""
-        async with self.frame_lock:
-            if self.current_frame is not None:
-                return self.current_frame.copy()
-        return None
+    def consoles_info(self) -> list:
+        """配信中のコンソール一覧（/consoles用）"""
+        return [
+            {**console.describe(), "primary": console is self.primary, **console.stats()}
+            for console in self.consoles.values()
+        ]
     
     # ========== 入力メソッド（ステップ3から継承） ==========
     
     def send_mouse_move(self, x: int, y: int):
         """マウス移動"""
         try:
-            if self.mouse_proxy:
-                self.mouse_proxy.SetAbsPosition(x, y)
-                # ログなし（頻繁すぎるため）
+            with self.input_timing.measure():
+                if self.input_sender:
+                    self.input_sender.mouse_move(x, y)
+                elif self.mouse_proxy:
+                    self.mouse_proxy.SetAbsPosition(x, y)
         except Exception as e:
             logger.error(f"Mouse move error: {e}")
-
+    
     def send_mouse_rel(self, dx: int, dy: int):
         """マウス相対移動"""
         try:
-            if self.mouse_proxy:
-                self.mouse_proxy.RelMotion(dx, dy)
+            with self.input_timing.measure():
+                if self.input_sender:
+                    self.input_sender.mouse_rel(dx, dy)
+                elif self.mouse_proxy:
+                    self.mouse_proxy.RelMotion(dx, dy)
         except Exception as e:
             logger.error(f"Mouse rel motion error: {e}")
     
     def send_mouse_press(self, button: int):
         """マウスボタン押下"""
         try:
-            if self.mouse_proxy:
-                self.mouse_proxy.Press(button)
+            with self.input_timing.measure():
+                if self.input_sender:
+                    self.input_sender.mouse_press(button)
+                elif self.mouse_proxy:
+                    self.mouse_proxy.Press(button)
         except Exception as e:
             logger.error(f"Mouse press error: {e}")
     
     def send_mouse_release(self, button: int):
         """マウスボタン解放"""
         try:
-            if self.mouse_proxy:
-                self.mouse_proxy.Release(button)
+            with self.input_timing.measure():
+                if self.input_sender:
+                    self.input_sender.mouse_release(button)
+                elif self.mouse_proxy:
+                    self.mouse_proxy.Release(button)
         except Exception as e:
             logger.error(f"Mouse release error: {e}")
     
     def send_key_press(self, keycode: int):
         """キー押下"""
         try:
-            if self.keyboard_proxy:
-                self.keyboard_proxy.Press(keycode)
+            with self.input_timing.measure():
+                if self.input_sender:
+                    self.input_sender.key_press(keycode)
+                elif self.keyboard_proxy:
+                    self.keyboard_proxy.Press(keycode)
         except Exception as e:
             logger.error(f"Key press error: {e}")
     
     def send_key_release(self, keycode: int):
         """キー解放"""
         try:
-            if self.keyboard_proxy:
-                self.keyboard_proxy.Release(keycode)
+            with self.input_timing.measure():
+                if self.input_sender:
+                    self.input_sender.key_release(keycode)
+                elif self.keyboard_proxy:
+                    self.keyboard_proxy.Release(keycode)
         except Exception as e:
             logger.error(f"Key release error: {e}")
     
     def disconnect(self):
         """接続解除"""
+        pending = self._pending_setup
+        if pending is not None and not pending.done():
+            # executorのD-Bus呼び出しが応答待ち（作りかけの接続・Listenerは完了後に閉じる）
+            logger.info("Disconnect deferred until pending D-Bus setup returns")
+            pending.add_done_callback(lambda _: self.disconnect())
+            return
         logger.info("Disconnecting...")
         
-        # GLibループ停止
-        if self.glib_integration:
+        # GLibループ停止（共有ループは所有者が止める）
+        if self.glib_integration and self._owns_glib_loop:
             self.glib_integration.stop()
         
-        # P2Pサーバークリーンアップ
-        if self.p2p_server:
-            self.p2p_server.cleanup()
+        # 入力専用接続を切断
+        if isinstance(self.input_sender, InputConnection):
+            self.input_sender.close()
         
-        # Listener共有メモリクリーンアップ
-        if self.listener and hasattr(self.listener, 'shared_memory'):
-            if self.listener.shared_memory:
-                self.listener.shared_memory.close()
+        # コンソールごとのP2P接続・共有メモリをクリーンアップ
+        for console in self.consoles.values():
+            console.close()
         
         logger.info("✓ Disconnected")
@@ -10,6 +10,7 @@ import numpy as np
 from OpenGL import GL
 import os
 import ctypes
+import threading
 from ctypes import c_int, c_void_p, c_uint, POINTER, c_int32
 
 logger = logging.getLogger(__name__)
@@ -94,6 +95,9 @@ if egl_lib:
     eglGetCurrentDisplay = egl_lib.eglGetCurrentDisplay
     eglGetCurrentDisplay.restype = c_void_p
 
+    eglGetCurrentContext = egl_lib.eglGetCurrentContext
+    eglGetCurrentContext.restype = c_void_p
+
     eglGetError = egl_lib.eglGetError
     eglGetError.restype = c_int
 
@@ -172,9 +176,27 @@ class EGLDMABUFRenderer:
         self.surface = None
         self.initialized = False
         self.egl_extensions = ""
+        # Serializes initialize() between the warm-up thread and the D-Bus thread
+        self._init_lock = threading.Lock()
+        # Set when several console threads render; the context is then bound per
+        # render and released afterwards instead of staying on one thread
+        self.shared = False
+        self._render_lock = threading.Lock()
+        self._bound_threads = set()
+
+    def initialize(self, make_current=True):
+        """
+        Initialize EGL display and OpenGL context for headless rendering.
+
+        With make_current=False the context is created but left unbound, so it can
+        be prepared on a warm-up thread and bound later by the rendering thread.
+        """
+        with self._init_lock:
+            if self.initialized:
+                return True
+            return self._initialize(make_current)
 
-    def initialize(self):
-        """Initialize EGL display and OpenGL context for headless rendering."""
+    def _initialize(self, make_current):
         try:
             logger.info("Initializing direct EGL OpenGL renderer...")
 
@@ -247,12 +269,8 @@ class EGLDMABUFRenderer:
             else:
                 self.egl_extensions = ""
 
-            # Make context current (surfaceless if supported, otherwise PBuffer)
-            if "EGL_KHR_surfaceless_context" in self.egl_extensions:
-                if not eglMakeCurrent(self.display, EGL_NO_SURFACE, EGL_NO_SURFACE, self.context):
-                    raise RuntimeError("Failed to make EGL context current (surfaceless)")
-                logger.info("✓ EGL context made current (surfaceless)")
-            else:
+            # Surfaceless if supported, otherwise a 1x1 PBuffer
+            if "EGL_KHR_surfaceless_context" not in self.egl_extensions:
                 pbuffer_attribs = [
                     EGL_WIDTH, 1,
                     EGL_HEIGHT, 1,
@@ -265,9 +283,9 @@ class EGLDMABUFRenderer:
                 )
                 if not self.surface:
                     raise RuntimeError("Failed to create PBuffer surface")
-                if not eglMakeCurrent(self.display, self.surface, self.surface, self.context):
-                    raise RuntimeError("Failed to make EGL context current (PBuffer)")
-                logger.info("✓ EGL context made current (PBuffer)")
+
+            if make_current and not self.make_current():
+                raise RuntimeError("Failed to make EGL context current")
 
             self.initialized = True
             return True
@@ -278,7 +296,41 @@ class EGLDMABUFRenderer:
             logger.error(traceback.format_exc())
             return False
 
+    def make_current(self):
+        """Bind the context to the calling thread (EGL contexts are per-thread)."""
+        if eglGetCurrentContext() == self.context:
+            return True
+        surface = self.surface or EGL_NO_SURFACE
+        if not eglMakeCurrent(self.display, surface, surface, self.context):
+            logger.error(f"eglMakeCurrent failed (err=0x{eglGetError():04x})")
+            return False
+        thread = threading.current_thread()
+        if thread.ident not in self._bound_threads:
+            self._bound_threads.add(thread.ident)
+            kind = "PBuffer" if self.surface else "surfaceless"
+            logger.info(f"✓ EGL context made current ({kind}) on thread {thread.name}")
+        return True
+
+    def release_current(self):
+        """Unbind the context from the calling thread so another thread can bind it."""
+        if self.display and eglGetCurrentContext() == self.context:
+            eglMakeCurrent(self.display, EGL_NO_SURFACE, EGL_NO_SURFACE, EGL_NO_CONTEXT)
+
     def render_from_dmabuf(self, dmabuf_fd, width, height, stride, fourcc, modifier):
+        """
+        Render DMA-BUF to RGB, serialized across console threads.
+
+        Returns:
+            RGB NumPy array or None
+        """
+        with self._render_lock:
+            try:
+                return self._render_from_dmabuf(dmabuf_fd, width, height, stride, fourcc, modifier)
+            finally:
+                if self.shared:
+                    self.release_current()
+
+    def _render_from_dmabuf(self, dmabuf_fd, width, height, stride, fourcc, modifier):
         """
         Render DMA-BUF to RGB using direct EGL OpenGL with extensions.
 
@@ -301,13 +353,16 @@ class EGLDMABUFRenderer:
             return None
 
         try:
-            # Context is already current from initialization
             # Use the stored EGL display
             egl_display = self.display
             if not egl_display:
                 logger.error("No EGL display available")
                 return None
 
+            # The context may have been created on the warm-up thread
+            if not self.make_current():
+                return None
+
             # Validate required extensions for DMA-BUF import
             if "EGL_EXT_image_dma_buf_import" not in self.egl_extensions:
                 logger.error("EGL_EXT_image_dma_buf_import not supported")
@@ -444,10 +499,12 @@ class EGLDMABUFRenderer:
 
 # Global renderer instance
 _renderer = None
+_renderer_lock = threading.Lock()
 
 def get_renderer():
     """Get or create global renderer instance."""
     global _renderer
-    if _renderer is None:
-        _renderer = EGLDMABUFRenderer()
+    with _renderer_lock:
+        if _renderer is None:
+            _renderer = EGLDMABUFRenderer()
     return _renderer
@@ -6,6 +6,7 @@ GLibのメインループをasyncioと統合して、D-Busコールバックを
 
 import asyncio
 import logging
+import threading
 from gi.repository import GLib
 
 logger = logging.getLogger(__name__)
@@ -22,27 +23,46 @@ class GLibAsyncioIntegration:
     def __init__(self):
         self.main_loop = GLib.MainLoop()
         self.running = False
-        
-    async def run_glib_loop(self):
-        """
-        GLibメインループをasyncioタスクとして実行
-        """
+        # ループが実際にイベントを処理し始めたらセット
+        self.started = threading.Event()
+        self.thread = None
+    
+    def start(self):
+        """GLibメインループを別スレッドで開始（起動済みなら何もしない）"""
+        if self.thread is not None:
+            return
         logger.info("Starting GLib main loop in background...")
-        
         self.running = True
         
-        # GLibメインループを別スレッドで実行
-        import threading
+        def on_started():
+            self.started.set()
+            return False  # 1回だけ
         
         def run_loop():
             logger.info("GLib main loop thread started")
+            GLib.idle_add(on_started)
             self.main_loop.run()
             logger.info("GLib main loop thread stopped")
         
-        thread = threading.Thread(target=run_loop, daemon=True)
-        thread.start()
-        
-        logger.info("✓ GLib main loop running in background")
+        self.thread = threading.Thread(target=run_loop, name="glib-main-loop", daemon=True)
+        self.thread.start()
+    
+    async def wait_started(self, timeout: float = 5.0) -> bool:
+        """ループの起動を待つ（固定時間のsleepの代わり）"""
+        loop = asyncio.get_running_loop()
+        started = await loop.run_in_executor(None, self.started.wait, timeout)
+        if started:
+            logger.info("✓ GLib main loop running in background")
+        else:
+            logger.warning(f"GLib main loop did not start within {timeout}s")
+        return started
+    
+    async def run_glib_loop(self):
+        """
+        GLibメインループをasyncioタスクとして実行
+        """
+        self.start()
+        await self.wait_started()
         
         # asyncioで待機し続ける（終了まで）
         while self.running:
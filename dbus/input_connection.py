@@ -0,0 +1,343 @@
+"""
+Dedicated Input D-Bus Connection
+
+入力専用のD-Bus接続と送信スレッド
+
+GDBusはプロセス内のすべての接続のI/Oを1つのワーカースレッドで処理し、
+P2P接続のメッセージフィルター（Scanout/Updateの画素変換）もそのスレッドで動く。
+共有接続（InputSender）では画面更新が多いと入力の送信がその後ろで待たされるため、
+ここではセッションバスへ独自のソケットで接続し、専用スレッドから
+no-reply-expectedのメソッド呼び出しを直接書き込む。
+
+扱う引数はu/iのみなので、D-Busのメッセージ形式を最小限ここで組み立てる
+（GLibに依存しない）。
+"""
+
+import logging
+import os
+import queue
+import socket
+import struct
+import threading
+import time
+from collections import deque
+from typing import Optional
+
+from telemetry import metrics
+
+logger = logging.getLogger(__name__)
+
+MOUSE_INTERFACE = "org.qemu.Display1.Mouse"
+KEYBOARD_INTERFACE = "org.qemu.Display1.Keyboard"
+
+# D-Busメッセージ定数
+_METHOD_CALL = 1
+_NO_REPLY_EXPECTED = 0x1
+_FIELD_PATH = 1
+_FIELD_INTERFACE = 2
+_FIELD_MEMBER = 3
+_FIELD_DESTINATION = 6
+_FIELD_SIGNATURE = 8
+
+
+class _Writer:
+    """リトルエンディアンのD-Bus marshaller（メッセージ先頭基準のアラインメント）"""
+
+    def __init__(self):
+        self.buf = bytearray()
+
+    def align(self, n: int):
+        self.buf += b"\0" * (-len(self.buf) % n)
+
+    def byte(self, value: int):
+        self.buf.append(value)
+
+    def uint32(self, value: int):
+        self.align(4)
+        self.buf += struct.pack("<I", value)
+
+    def int32(self, value: int):
+        self.align(4)
+        self.buf += struct.pack("<i", value)
+
+    def string(self, value: str):
+        data = value.encode()
+        self.uint32(len(data))
+        self.buf += data + b"\0"
+
+    def signature(self, value: str):
+        data = value.encode()
+        self.byte(len(data))
+        self.buf += data + b"\0"
+
+
+def marshal_method_call(serial: int, destination: Optional[str], path: str, interface: str,
+                        member: str, signature: str = "", args: tuple = (),
+                        flags: int = _NO_REPLY_EXPECTED) -> bytes:
+    """
+    メソッド呼び出しメッセージを組み立てる
+
+    Args:
+        serial: 接続内で一意な0以外の番号
+        signature: 引数の型（"u" / "i" の並びのみ対応）
+    """
+    body = _Writer()
+    for code, value in zip(signature, args):
+        if code == "u":
+            body.uint32(value)
+        elif code == "i":
+            body.int32(value)
+        else:
+            raise ValueError(f"Unsupported D-Bus type: {code}")
+
+    fields = [
+        (_FIELD_PATH, "o", path),
+        (_FIELD_INTERFACE, "s", interface),
+        (_FIELD_MEMBER, "s", member),
+    ]
+    if destination:
+        fields.append((_FIELD_DESTINATION, "s", destination))
+    if signature:
+        fields.append((_FIELD_SIGNATURE, "g", signature))
+
+    header = _Writer()
+    header.buf += struct.pack("<cBBBII", b"l", _METHOD_CALL, flags, 1, len(body.buf), serial)
+    header.uint32(0)  # ヘッダーフィールド配列の長さ（後で埋める）
+    header.align(8)
+    array_start = len(header.buf)
+    for code, type_code, value in fields:
+        header.align(8)
+        header.byte(code)
+        header.signature(type_code)
+        if type_code == "g":
+            header.signature(value)
+        else:
+            header.string(value)
+    struct.pack_into("<I", header.buf, 12, len(header.buf) - array_start)
+    header.align(8)
+    return bytes(header.buf + body.buf)
+
+
+def parse_unix_address(address: str) -> Optional[str]:
+    """
+    D-Busアドレスからソケットアドレスを取得
+
+    Returns:
+        パス（abstractの場合は先頭が\\0）、unixでない場合None
+    """
+    for entry in address.split(";"):
+        transport, _, params = entry.partition(":")
+        if transport != "unix":
+            continue
+        values = dict(p.split("=", 1) for p in params.split(",") if "=" in p)
+        if "path" in values:
+            return values["path"]
+        if "abstract" in values:
+            return "\0" + values["abstract"]
+    return None
+
+
+def coalesce_moves(items: list) -> list:
+    """
+    送信スレッドがまとめて取り出したメソッド呼び出しのうち、連続するマウス移動を結合する
+
+    InputSchedulerと同じ規則（SetAbsPositionは最新の座標だけ、RelMotionは移動量を合算）。
+    ボタン・キーイベントは結合の境界になるため、移動との前後関係は保たれる。
+    結合した呼び出しのキュー投入時刻は最初のものを残す。
+
+    Args:
+        items: [(キュー投入時刻, interface, member, signature, args)]
+
+    Returns:
+        結合後のリスト
+    """
+    merged = []
+    for item in items:
+        enqueued, interface, member, signature, args = item
+        tail = merged[-1] if merged else None
+        if (tail is not None and interface == MOUSE_INTERFACE and tail[1] == MOUSE_INTERFACE
+                and member == tail[2] and member in ("SetAbsPosition", "RelMotion")):
+            if member == "RelMotion":
+                args = (tail[4][0] + args[0], tail[4][1] + args[1])
+            merged[-1] = (tail[0], interface, member, signature, args)
+        else:
+            merged.append(item)
+    # 打ち消し合った相対移動は送らない
+    return [item for item in merged if not (item[2] == "RelMotion" and item[4] == (0, 0))]
+
+
+class InputConnection:
+    """
+    入力専用のセッションバス接続
+
+    InputSenderと同じインターフェース。呼び出し元（asyncioループ）はキューに積むだけで、
+    送信スレッドが溜まった分をまとめて1回のsendallで書き込む。
+    """
+
+    def __init__(self, address: str, console_path: str, bus_name: str = "org.qemu"):
+        """
+        Args:
+            address: D-Busアドレス（DBUS_SESSION_BUS_ADDRESS）
+            console_path: コンソールのオブジェクトパス
+            bus_name: QEMUのバス名
+        """
+        self.console_path = console_path
+        self.bus_name = bus_name
+        self.sock = self._connect(address)
+        self._serial = 0
+        self._queue = queue.SimpleQueue()
+        self._closed = False
+
+        # 統計（キュー投入からソケット書き込みまで）
+        self.sent = 0
+        self.batches = 0
+        self.errors = 0
+        self.coalesced = 0
+        self.queue_delay = deque(maxlen=1000)
+
+        # Helloは最初のメッセージである必要がある（応答は読み捨て）
+        self.sock.sendall(marshal_method_call(
+            self._next_serial(), "org.freedesktop.DBus", "/org/freedesktop/DBus",
+            "org.freedesktop.DBus", "Hello", flags=0,
+        ))
+
+        self._reader = threading.Thread(target=self._read_loop, name="dbus-input-reader", daemon=True)
+        self._writer = threading.Thread(target=self._write_loop, name="dbus-input", daemon=True)
+        self._reader.start()
+        self._writer.start()
+        logger.info(f"InputConnection initialized: {console_path} (dedicated connection)")
+
+    @staticmethod
+    def _connect(address: str) -> socket.socket:
+        """ソケット接続とSASL EXTERNAL認証"""
+        path = parse_unix_address(address)
+        if path is None:
+            raise ValueError(f"Unsupported D-Bus address for input connection: {address}")
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        uid_hex = str(os.getuid()).encode().hex()
+        sock.sendall(b"\0AUTH EXTERNAL " + uid_hex.encode() + b"\r\n")
+        response = b""
+        while not response.endswith(b"\r\n"):
+            chunk = sock.recv(256)
+            if not chunk:
+                raise ConnectionError("D-Bus connection closed during authentication")
+            response += chunk
+        if not response.startswith(b"OK"):
+            raise ConnectionError(f"D-Bus authentication failed: {response!r}")
+        sock.sendall(b"BEGIN\r\n")
+        return sock
+
+    def _next_serial(self) -> int:
+        self._serial = self._serial % 0xFFFFFFFF + 1
+        return self._serial
+
+    def _read_loop(self):
+        """受信データ（Hello応答・NameAcquired）を読み捨てる"""
+        try:
+            while self.sock.recv(65536):
+                pass
+        except OSError:
+            pass
+        if not self._closed:
+            logger.warning("Input D-Bus connection closed by peer")
+            self._closed = True
+
+    def _set_priority(self):
+        """送信スレッドの優先度を上げる（権限がなければ既定のまま）"""
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), -5)
+            logger.info("Input thread priority raised (nice -5)")
+        except (OSError, AttributeError) as e:
+            logger.info(f"Input thread runs at default priority: {e}")
+
+    def _write_loop(self):
+        self._set_priority()
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            items = [item]
+            # 溜まっている分をまとめて書き込む
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                items.append(item)
+
+            # 書き込みが詰まっている間に溜まった移動は1件にまとめる
+            if len(items) > 1:
+                count = len(items)
+                items = coalesce_moves(items)
+                self.coalesced += count - len(items)
+                if not items:
+                    continue
+
+            blob = bytearray()
+            for enqueued, interface, member, signature, args in items:
+                blob += marshal_method_call(
+                    self._next_serial(), self.bus_name, self.console_path,
+                    interface, member, signature, args,
+                )
+            try:
+                self.sock.sendall(blob)
+            except OSError as e:
+                self.errors += len(items)
+                logger.error(f"Input send error: {e}")
+                continue
+            now = time.perf_counter()
+            for enqueued, *_ in items:
+                metrics.INPUT_QUEUE.observe(now - enqueued)
+                self.queue_delay.append((now - enqueued) * 1000)
+            self.sent += len(items)
+            self.batches += 1
+
+    def _send(self, interface: str, member: str, signature: str, args: tuple):
+        if self._closed:
+            raise ConnectionError("Input D-Bus connection is closed")
+        self._queue.put((time.perf_counter(), interface, member, signature, args))
+
+    def mouse_move(self, x: int, y: int):
+        self._send(MOUSE_INTERFACE, "SetAbsPosition", "uu", (max(0, x), max(0, y)))
+
+    def mouse_rel(self, dx: int, dy: int):
+        self._send(MOUSE_INTERFACE, "RelMotion", "ii", (dx, dy))
+
+    def mouse_press(self, button: int):
+        self._send(MOUSE_INTERFACE, "Press", "u", (button,))
+
+    def mouse_release(self, button: int):
+        self._send(MOUSE_INTERFACE, "Release", "u", (button,))
+
+    def key_press(self, keycode: int):
+        self._send(KEYBOARD_INTERFACE, "Press", "u", (keycode,))
+
+    def key_release(self, keycode: int):
+        self._send(KEYBOARD_INTERFACE, "Release", "u", (keycode,))
+
+    def close(self):
+        """送信スレッドを止めて切断"""
+        self._closed = True
+        self._queue.put(None)
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+    def stats(self) -> dict:
+        """キュー投入からソケット書き込みまでの時間（ms）"""
+        delays = sorted(self.queue_delay)
+        return {
+            "queued": self._queue.qsize(),
+            "sent": self.sent,
+            "batches": self.batches,
+            "coalesced": self.coalesced,
+            "errors": self.errors,
+            "queueDelayP50Ms": round(metrics.percentile(delays, 0.5), 3) if delays else None,
+            "queueDelayP99Ms": round(metrics.percentile(delays, 0.99), 3) if delays else None,
+        }
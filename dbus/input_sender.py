@@ -0,0 +1,120 @@
+"""
+Non-blocking Input Sender
+
+QEMUのMouse/KeyboardインターフェースをGDBusのno-reply-expectedメッセージで呼び出す
+
+dasbusのプロキシ呼び出しは応答を待つ同期呼び出しのため、入力1件ごとに
+asyncioループ全体（WebRTC送信を含む）がD-Busの往復時間だけ止まる。
+Gio.DBusConnection.send_message()はGDBusのワーカースレッドに送信を
+キューイングするだけなので、呼び出し元は待たされない。
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from gi.repository import Gio, GLib
+
+from telemetry import metrics
+
+logger = logging.getLogger(__name__)
+
+MOUSE_INTERFACE = "org.qemu.Display1.Mouse"
+KEYBOARD_INTERFACE = "org.qemu.Display1.Keyboard"
+
+
+class InputTiming:
+    """入力送信にかかった時間（呼び出し元のブロック時間）の統計"""
+
+    def __init__(self, window: int = 1000):
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.errors = 0
+        self.recent = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def measure(self):
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            with self._lock:
+                self.errors += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            metrics.INPUT_DISPATCH.observe(elapsed)
+            elapsed_ms = elapsed * 1000
+            with self._lock:
+                self.count += 1
+                self.total_ms += elapsed_ms
+                self.max_ms = max(self.max_ms, elapsed_ms)
+                self.recent.append(elapsed_ms)
+
+    def stats(self) -> dict:
+        with self._lock:
+            recent = sorted(self.recent)
+            count = self.count
+            total_ms = self.total_ms
+            max_ms = self.max_ms
+            errors = self.errors
+        return {
+            "count": count,
+            "errors": errors,
+            "meanMs": round(total_ms / count, 3) if count else None,
+            "p99Ms": round(metrics.percentile(recent, 0.99), 3) if len(recent) >= 100 else None,
+            "maxMs": round(max_ms, 3),
+        }
+
+
+class InputSender:
+    """
+    no-reply-expectedのメソッド呼び出しで入力を送る
+
+    QEMU側（gdbus-codegen）はフラグを見て応答を返さない。エラー応答も返らないため、
+    絶対座標が無効なマウスへのSetAbsPositionなどの失敗は検出できない
+    （その場合はQEMU_WEBRTC_ASYNC_INPUT=0で同期呼び出しに戻す）。
+    """
+
+    def __init__(self, connection, console_path: str, bus_name: str = "org.qemu"):
+        """
+        Args:
+            connection: Gio.DBusConnection（dasbusのbus.connection）
+            console_path: コンソールのオブジェクトパス
+            bus_name: QEMUのバス名（P2P接続の場合はNone）
+        """
+        self.connection = connection
+        self.console_path = console_path
+        self.bus_name = bus_name
+        self.sent = 0
+        logger.info(f"InputSender initialized: {console_path} (no-reply-expected)")
+
+    def _send(self, interface: str, method: str, signature: str, args: tuple):
+        message = Gio.DBusMessage.new_method_call(self.bus_name, self.console_path, interface, method)
+        message.set_body(GLib.Variant(signature, args))
+        message.set_flags(Gio.DBusMessageFlags.NO_REPLY_EXPECTED)
+        # GDBusのワーカースレッドにキューイングするだけで戻る（スレッドセーフ）
+        self.connection.send_message(message, Gio.DBusSendMessageFlags.NONE)
+        self.sent += 1
+
+    def mouse_move(self, x: int, y: int):
+        self._send(MOUSE_INTERFACE, "SetAbsPosition", "(uu)", (max(0, x), max(0, y)))
+
+    def mouse_rel(self, dx: int, dy: int):
+        self._send(MOUSE_INTERFACE, "RelMotion", "(ii)", (dx, dy))
+
+    def mouse_press(self, button: int):
+        self._send(MOUSE_INTERFACE, "Press", "(u)", (button,))
+
+    def mouse_release(self, button: int):
+        self._send(MOUSE_INTERFACE, "Release", "(u)", (button,))
+
+    def key_press(self, keycode: int):
+        self._send(KEYBOARD_INTERFACE, "Press", "(u)", (keycode,))
+
+    def key_release(self, keycode: int):
+        self._send(KEYBOARD_INTERFACE, "Release", "(u)", (keycode,))
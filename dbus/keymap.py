@@ -140,3 +140,92 @@ def js_code_to_qemu(js_code: str) -> int:
     """
     return JS_TO_QEMU.get(js_code)
 
+
+
+# Character → (KeyboardEvent.code, shift) per guest keyboard layout
+# Used for typing text (the guest's layout decides which key produces a character)
+_US_SYMBOLS = {
+    '`': ('Backquote', False), '~': ('Backquote', True),
+    '1': ('Digit1', False), '!': ('Digit1', True),
+    '2': ('Digit2', False), '@': ('Digit2', True),
+    '3': ('Digit3', False), '#': ('Digit3', True),
+    '4': ('Digit4', False), '$': ('Digit4', True),
+    '5': ('Digit5', False), '%': ('Digit5', True),
+    '6': ('Digit6', False), '^': ('Digit6', True),
+    '7': ('Digit7', False), '&': ('Digit7', True),
+    '8': ('Digit8', False), '*': ('Digit8', True),
+    '9': ('Digit9', False), '(': ('Digit9', True),
+    '0': ('Digit0', False), ')': ('Digit0', True),
+    '-': ('Minus', False), '_': ('Minus', True),
+    '=': ('Equal', False), '+': ('Equal', True),
+    '[': ('BracketLeft', False), '{': ('BracketLeft', True),
+    ']': ('BracketRight', False), '}': ('BracketRight', True),
+    '\\': ('Backslash', False), '|': ('Backslash', True),
+    ';': ('Semicolon', False), ':': ('Semicolon', True),
+    "'": ('Quote', False), '"': ('Quote', True),
+    ',': ('Comma', False), '<': ('Comma', True),
+    '.': ('Period', False), '>': ('Period', True),
+    '/': ('Slash', False), '?': ('Slash', True),
+}
+
+# JIS (jp106)
+_JP_SYMBOLS = {
+    '1': ('Digit1', False), '!': ('Digit1', True),
+    '2': ('Digit2', False), '"': ('Digit2', True),
+    '3': ('Digit3', False), '#': ('Digit3', True),
+    '4': ('Digit4', False), '$': ('Digit4', True),
+    '5': ('Digit5', False), '%': ('Digit5', True),
+    '6': ('Digit6', False), '&': ('Digit6', True),
+    '7': ('Digit7', False), "'": ('Digit7', True),
+    '8': ('Digit8', False), '(': ('Digit8', True),
+    '9': ('Digit9', False), ')': ('Digit9', True),
+    '0': ('Digit0', False),
+    '-': ('Minus', False), '=': ('Minus', True),
+    '^': ('Equal', False), '~': ('Equal', True),
+    '¥': ('IntlYen', False), '|': ('IntlYen', True),
+    '@': ('BracketLeft', False), '`': ('BracketLeft', True),
+    '[': ('BracketRight', False), '{': ('BracketRight', True),
+    ';': ('Semicolon', False), '+': ('Semicolon', True),
+    ':': ('Quote', False), '*': ('Quote', True),
+    ']': ('Backslash', False), '}': ('Backslash', True),
+    ',': ('Comma', False), '<': ('Comma', True),
+    '.': ('Period', False), '>': ('Period', True),
+    '/': ('Slash', False), '?': ('Slash', True),
+    '\\': ('IntlRo', False), '_': ('IntlRo', True),
+}
+
+_COMMON_CHARS = {
+    ' ': ('Space', False),
+    '\n': ('Enter', False),
+    '\t': ('Tab', False),
+    '\b': ('Backspace', False),
+    **{c: (f'Key{c.upper()}', False) for c in 'abcdefghijklmnopqrstuvwxyz'},
+    **{c: (f'Key{c}', True) for c in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'},
+}
+
+CHAR_LAYOUTS = {
+    'us': {**_COMMON_CHARS, **_US_SYMBOLS},
+    'jp': {**_COMMON_CHARS, **_JP_SYMBOLS},
+}
+
+SHIFT_KEYCODE = JS_TO_QEMU['ShiftLeft']
+
+
+def char_to_qemu(char: str, layout: str = 'us'):
+    """
+    Convert a character to the QEMU keycode that types it on the guest layout
+    
+    Args:
+        char: Single character ("\\r" is treated as Enter)
+        layout: Guest keyboard layout ("us" or "jp")
+        
+    Returns:
+        (QEMU keycode, needs shift), or None if the layout cannot type it
+    """
+    if char == '\r':
+        char = '\n'
+    entry = CHAR_LAYOUTS[layout].get(char)
+    if entry is None:
+        return None
+    code, shift = entry
+    return JS_TO_QEMU[code], shift
@@ -9,6 +9,7 @@ import mmap
 import numpy as np
 import os
 import time
+from telemetry import metrics, tracing
 from .dmabuf_gl import get_renderer
 
 logger = logging.getLogger(__name__)
@@ -18,8 +19,8 @@ class DisplayListener:
     """
     QEMU Display Listener実装
     
-    QEMUから画面更新を受信する
-    GLib/Gioのmethod_call_handlerから呼ばれる
+    QEMUから画面更新を受信する（1コンソールにつき1インスタンス）
+    P2P接続のメッセージフィルターからコンソールのディスパッチスレッド経由で呼ばれる
     """
     
     def __init__(self, capture_object):
@@ -56,34 +57,22 @@ class DisplayListener:
             data: 画像データ（バイト列）
         """
         try:
-            # === Phase 2: 測定開始 ===
-            t_receive = time.time()
-            
             logger.info(f"Scanout: {width}x{height}, stride={stride}, format=0x{pixman_format:08x}")
-            logger.debug(f"[PERF] Scanout受信時刻: {t_receive:.6f}")
             
             self.current_width = width
             self.current_height = height
             self.current_stride = stride
             self.current_format = pixman_format
+            self.capture.handle_resize(width, height)
             
-            # Pixman → RGB変換
-            t1 = time.time()
+            # Pixman → RGB変換（所要時間は/metricsのconversion）
             rgb_frame = self._convert_pixman_to_rgb(data, width, height, stride, pixman_format)
-            t2 = time.time()
-            
-            logger.debug(f"[PERF] RGB変換時間: {(t2-t1)*1000:.1f}ms")
             
             if rgb_frame is not None:
                 logger.info(f"✓ RGB conversion successful: {rgb_frame.shape}")
                 
-                # キャプチャオブジェクトに画像を渡す
-                t3 = time.time()
+                # キャプチャオブジェクトに画像を渡す（反映までの時間は/metricsのframe_publish）
                 self.capture.update_frame_from_listener(rgb_frame)
-                t4 = time.time()
-                
-                logger.debug(f"[PERF] update_frame時間: {(t4-t3)*1000:.1f}ms")
-                logger.debug(f"[PERF] Scanout総処理時間: {(t4-t_receive)*1000:.1f}ms")
                 logger.info(f"✓ Frame sent to capture: {width}x{height}")
             else:
                 logger.error("✗ RGB conversion returned None")
@@ -105,27 +94,14 @@ class DisplayListener:
             data: 更新データ
         """
         try:
-            # === Phase 2: 測定 ===
-            t_receive = time.time()
+            self.capture.notify_damage(x, y, width, height)
             
             # 部分更新データを変換
-            t1 = time.time()
             rgb_patch = self._convert_pixman_to_rgb(data, width, height, stride, pixman_format)
-            t2 = time.time()
             
             if rgb_patch is not None:
                 # 既存フレームの該当領域を更新
-                t3 = time.time()
                 self.capture.update_frame_region(x, y, rgb_patch)
-                t4 = time.time()
-                
-                # 100回に1回だけログ（頻繁すぎるため）
-                if not hasattr(self, '_update_count'):
-                    self._update_count = 0
-                self._update_count += 1
-                
-                if self._update_count % 100 == 0:
-                    logger.debug(f"[PERF] Update #{self._update_count}: RGB変換={( t2-t1)*1000:.1f}ms, フレーム更新={(t4-t3)*1000:.1f}ms, 総時間={(t4-t_receive)*1000:.1f}ms")
             else:
                 logger.error(f"Update RGB conversion returned None")
                 
@@ -156,6 +132,7 @@ class DisplayListener:
             self.current_width = width
             self.current_height = height
             self.current_stride = stride
+            self.capture.handle_resize(width, height)
             # Replace previous DMA-BUF fd to avoid leaking fds
             if self.current_dmabuf_fd is not None and self.current_dmabuf_fd != fd:
                 self._close_fd(self.current_dmabuf_fd, "dmabuf(previous)")
@@ -199,6 +176,7 @@ class DisplayListener:
             width, height: 更新サイズ
         """
         try:
+            self.capture.notify_damage(x, y, width, height)
             if self.shared_memory is not None:
                 # 保存されたy0_topを使用（デフォルトはTrue）
                 y0_top = getattr(self, 'current_y0_top', True)
@@ -225,6 +203,7 @@ class DisplayListener:
             self.current_height = height
             self.current_stride = stride
             self.current_format = pixman_format
+            self.capture.handle_resize(width, height)
             
             # 既存のマップをクリーンアップ
             if self.shared_memory is not None:
@@ -251,6 +230,7 @@ class DisplayListener:
         共有メモリマップの部分更新
         """
         try:
+            self.capture.notify_damage(x, y, width, height)
             if self.shared_memory is not None:
                 self._update_from_shared_memory()
                 
@@ -293,7 +273,7 @@ class DisplayListener:
             RGB NumPy配列 (height, width, 3)
         """
         try:
-            t_start = time.time()
+            t_start = time.perf_counter()
             
             # Pixmanフォーマット判定
             # 0x20020888 = PIXMAN_X8R8G8B8 = BGRX (little-endian)
@@ -308,9 +288,8 @@ class DisplayListener:
                 # BGRX/BGRA → RGB 変換
                 rgb = pixels[:, :, [2, 1, 0]].copy()
                 
-                t_end = time.time()
-                logger.debug(f"[PERF-RGB] RGB変換合計: {(t_end-t_start)*1000:.1f}ms")
-                
+                t_end = metrics.CONVERSION.observe_since(t_start)
+                tracing.TRACER.span("conversion", t_start, t_end, width=width, height=height)
                 return rgb
                 
             else:
@@ -357,10 +336,12 @@ class DisplayListener:
             logger.info(f"Reading from DMA-BUF: fourcc=0x{fourcc:08x}, size={self.current_stride * self.current_height}, y0_top={y0_top}")
             
             # Try EGL-based OpenGL rendering first
+            # レンダラーは全コンソール共有（コンテキストは描画時にこのスレッドにバインド）
             renderer = get_renderer()
             if not renderer.initialized:
-                renderer.initialize()
+                renderer.initialize(make_current=False)
             
+            t_start = time.perf_counter()
             rgb_frame = renderer.render_from_dmabuf(
                 self.current_dmabuf_fd,
                 self.current_width,
@@ -369,6 +350,9 @@ class DisplayListener:
                 fourcc,
                 self.current_modifier
             )
+            t_end = metrics.EGL_READBACK.observe_since(t_start)
+            tracing.TRACER.span("egl_readback", t_start, t_end,
+                                width=self.current_width, height=self.current_height)
             
             if rgb_frame is not None:
                 logger.info("✓ EGL OpenGL rendering successful")
@@ -420,7 +404,7 @@ class DisplayListener:
             RGB NumPy配列 (height, width, 3)
         """
         try:
-            t_start = time.time()
+            t_start = time.perf_counter()
             
             # Fourcc: 0x34324258 = "XB24" = BGRX (little-endian)
             # Fourcc: 0x34324241 = "AB24" = BGRA
@@ -440,7 +424,8 @@ class DisplayListener:
                         rgb[y, x, 1] = data_array[pixel_offset + 1]  # G
                         rgb[y, x, 2] = data_array[pixel_offset + 0]  # B
                 
-                t_end = time.time()
+                t_end = metrics.CONVERSION.observe_since(t_start)
+                tracing.TRACER.span("conversion", t_start, t_end, width=width, height=height)
                 logger.info(f"✓ Fourcc conversion complete: {(t_end-t_start)*1000:.1f}ms")
                 return rgb
                 
@@ -7,9 +7,12 @@ Key fix: CLIENT側ではGUID=Noneが必須
 import logging
 import socket
 import sys
+import time
 from typing import Optional
 from gi.repository import Gio, GLib
 
+from telemetry import metrics, tracing
+
 logger = logging.getLogger(__name__)
 
 
@@ -102,8 +105,15 @@ class P2PListenerServer:
     </node>
     """
     
-    def __init__(self, listener_object):
+    def __init__(self, listener_object, dispatch=None):
+        """
+        Args:
+            listener_object: DisplayListener
+            dispatch: dispatch(method, args, reply, received) でListenerの呼び出しを別スレッドに渡す関数
+                      （Noneの場合はGDBusのワーカースレッドで直接処理）
+        """
         self.listener = listener_object
+        self.dispatch = dispatch
         self.connection: Optional[Gio.DBusConnection] = None
         self.registration_ids = []  # 複数のインターフェースを登録
         
@@ -141,57 +151,69 @@ class P2PListenerServer:
                     
                 # メッセージフィルター内で全メソッドを処理（PyGObject register_objectの回避策）
                 try:
+                    received = time.perf_counter()
                     body = message.get_body()
-                    handled = False
+                    call = None  # (メソッド, 引数)
                     
                     if member == "ScanoutDMABUF":
                         logger.debug("📥 ScanoutDMABUF")
                         if unix_fd_list and unix_fd_list.get_length() > 0 and body:
                             fd_index, width, height, stride, fourcc, modifier, y0_top = body.unpack()
                             actual_fd = unix_fd_list.get(fd_index)
-                            self.listener.ScanoutDMABUF(actual_fd, width, height, stride, fourcc, modifier, y0_top)
-                            handled = True
+                            call = (self.listener.ScanoutDMABUF,
+                                    (actual_fd, width, height, stride, fourcc, modifier, y0_top))
                     
                     elif member == "UpdateDMABUF":
                         if body:
                             x, y, width, height = body.unpack()
-                            self.listener.UpdateDMABUF(x, y, width, height)
-                            handled = True
+                            call = (self.listener.UpdateDMABUF, (x, y, width, height))
                     
                     elif member == "CursorDefine":
                         logger.debug("📥 CursorDefine")
                         if body:
                             width, height, hot_x, hot_y, data = body.unpack()
-                            self.listener.CursorDefine(width, height, hot_x, hot_y, bytes(data))
-                            handled = True
+                            call = (self.listener.CursorDefine, (width, height, hot_x, hot_y, bytes(data)))
                     
                     elif member == "MouseSet":
                         if body:
                             x, y, on = body.unpack()
-                            self.listener.MouseSet(x, y, on)
-                            handled = True
+                            call = (self.listener.MouseSet, (x, y, on))
                     
                     elif member == "Scanout":
                         logger.info("📥 Scanout")
                         if body:
                             width, height, stride, pixman_format, data = body.unpack()
-                            self.listener.Scanout(width, height, stride, pixman_format, bytes(data))
-                            handled = True
+                            call = (self.listener.Scanout, (width, height, stride, pixman_format, bytes(data)))
                     
                     elif member == "Update":
                         if body:
                             x, y, width, height, stride, pixman_format, data = body.unpack()
-                            self.listener.Update(x, y, width, height, stride, pixman_format, bytes(data))
-                            handled = True
+                            call = (self.listener.Update,
+                                    (x, y, width, height, stride, pixman_format, bytes(data)))
                     
                     elif member == "Disable":
-                        self.listener.Disable()
-                        handled = True
+                        call = (self.listener.Disable, ())
                     
-                    if handled:
-                        # メソッドリターンを送信
+                    if call is not None:
+                        # メソッドリターンは処理後に送信（DMA-BUFはQEMUが応答まで書き換えを待つ）
                         reply = Gio.DBusMessage.new_method_reply(message)
-                        connection.send_message(reply, Gio.DBusSendMessageFlags.NONE)
+                        
+                        def send_reply():
+                            connection.send_message(reply, Gio.DBusSendMessageFlags.NONE)
+                        
+                        method, args = call
+                        if self.dispatch is not None:
+                            self.dispatch(method, args, send_reply, received)
+                            if tracing.TRACER.enabled:
+                                tracing.TRACER.span(f"dbus.{member}", received, cat="dbus",
+                                                    flow_out=(tracing.FLOW_MESSAGE, tracing.flow_id(received)))
+                        else:
+                            started = metrics.DBUS_RECEIVE.observe_since(received)
+                            try:
+                                method(*args)
+                            finally:
+                                send_reply()
+                            tracing.TRACER.span(f"listener.{member}", started, cat="dbus")
                         # メッセージを消費（ハンドラーに渡さない）
                         return None
                         
@@ -414,9 +436,10 @@ class P2PListenerServer:
     def cleanup(self):
         """接続とリソースのクリーンアップ"""
         try:
-            if self.registration_id and self.connection:
-                self.connection.unregister_object(self.registration_id)
-                self.registration_id = None
+            if self.connection:
+                for registration_id in self.registration_ids:
+                    self.connection.unregister_object(registration_id)
+                self.registration_ids = []
             if self.connection:
                 self.connection.close_sync(None)
                 self.connection = None
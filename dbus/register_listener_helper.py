@@ -9,14 +9,39 @@ from gi.repository import Gio, GLib
 
 logger = logging.getLogger(__name__)
 
+# バスアドレス -> Gio.DBusConnection（複数VMのバスに接続する場合）
+_address_connections = {}
 
-def call_register_listener_with_fd(console_proxy_path, fd):
+
+def get_bus_connection(bus_address=None):
+    """
+    GDBusのバス接続を取得
+    
+    Args:
+        bus_address: D-Busアドレス（Noneでセッションバス）
+    """
+    if bus_address is None:
+        return Gio.bus_get_sync(Gio.BusType.SESSION, None)
+    connection = _address_connections.get(bus_address)
+    if connection is None or connection.is_closed():
+        connection = Gio.DBusConnection.new_for_address_sync(
+            bus_address,
+            Gio.DBusConnectionFlags.AUTHENTICATION_CLIENT | Gio.DBusConnectionFlags.MESSAGE_BUS_CONNECTION,
+            None,
+            None
+        )
+        _address_connections[bus_address] = connection
+    return connection
+
+
+def call_register_listener_with_fd(console_proxy_path, fd, bus_address=None):
     """
     RegisterListenerをUnixFDで呼び出す
     
     Args:
         console_proxy_path: コンソールのD-Busパス（例: "/org/qemu/Display1/Console_0"）
         fd: ファイルディスクリプタ（int）
+        bus_address: QEMUが接続しているバスのアドレス（Noneでセッションバス）
         
     Returns:
         成功時True
@@ -24,8 +49,8 @@ def call_register_listener_with_fd(console_proxy_path, fd):
     try:
         logger.info(f"Calling RegisterListener with FD={fd}")
         
-        # セッションバス接続取得
-        bus = Gio.bus_get_sync(Gio.BusType.SESSION, None)
+        # バス接続取得
+        bus = get_bus_connection(bus_address)
         
         # UnixFDListを作成
         fd_list = Gio.UnixFDList.new()
@@ -0,0 +1,324 @@
+"""
+Encoder Profiles
+
+コーデック優先順位と画面コンテンツ向け低遅延エンコーダ設定
+
+aiortcのエンコーダはコーデックオプションが固定のため、
+サブクラスでCodecContextを先に生成してプロファイルを反映する。
+"""
+
+import fractions
+import logging
+import multiprocessing
+import os
+import time
+from dataclasses import dataclass, replace
+from typing import Optional
+
+import av
+from aiortc import RTCRtpSender
+from aiortc import rtcrtpsender
+from aiortc.codecs import get_encoder
+from aiortc.codecs.h264 import H264Encoder
+from aiortc.codecs.vpx import Vp8Encoder, number_of_threads
+
+from telemetry import metrics, tracing
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class EncoderProfile:
+    """エンコーダプロファイル"""
+    name: str
+    min_bitrate: int  # bps
+    max_bitrate: int  # bps
+    start_bitrate: int  # bps
+    keyframe_interval: int  # フレーム数（GOP長）
+    # VP8 (libvpx)
+    vp8_cpu_used: int = -6  # 負値: realtimeでの速度（絶対値が大きいほど高速）
+    vp8_static_thresh: int = 1  # 静止ブロック判定（画面コンテンツでは大きめ）
+    vp8_noise_sensitivity: int = 4  # ノイズ除去（画面コンテンツでは不要）
+    # H.264 (libx264)
+    h264_preset: str = "medium"
+    h264_tune: str = "zerolatency"
+    h264_level: str = "31"
+
+
+PROFILES = {
+    # aiortc既定値相当
+    "default": EncoderProfile(
+        name="default",
+        min_bitrate=250_000,
+        max_bitrate=1_500_000,
+        start_bitrate=500_000,
+        keyframe_interval=3000,
+    ),
+    # デスクトップ画面向け低遅延（静止領域が多く、文字の鮮明さを優先）
+    "screen": EncoderProfile(
+        name="screen",
+        min_bitrate=150_000,
+        max_bitrate=4_000_000,
+        start_bitrate=1_000_000,
+        keyframe_interval=300,
+        vp8_cpu_used=-8,
+        vp8_static_thresh=100,
+        vp8_noise_sensitivity=0,
+        h264_preset="ultrafast",
+        h264_tune="zerolatency",
+        h264_level="41",
+    ),
+    # 低速CPU向け（エンコード速度優先）
+    "fast": EncoderProfile(
+        name="fast",
+        min_bitrate=150_000,
+        max_bitrate=2_000_000,
+        start_bitrate=600_000,
+        keyframe_interval=600,
+        vp8_cpu_used=-16,
+        vp8_static_thresh=500,
+        vp8_noise_sensitivity=0,
+        h264_preset="ultrafast",
+        h264_tune="zerolatency",
+        h264_level="41",
+    ),
+}
+
+CODEC_MIME_TYPES = {
+    "vp8": "video/VP8",
+    "h264": "video/H264",
+}
+
+
+def load_encoder_profile() -> EncoderProfile:
+    """
+    環境変数からエンコーダプロファイルを読み込む
+
+    QEMU_WEBRTC_ENCODER_PROFILE: default / screen / fast
+    QEMU_WEBRTC_MAX_BITRATE: 上限ビットレート（bps）で上書き
+    QEMU_WEBRTC_KEYFRAME_INTERVAL: キーフレーム間隔（フレーム数）で上書き
+    """
+    name = os.environ.get("QEMU_WEBRTC_ENCODER_PROFILE", "screen").strip().lower()
+    profile = PROFILES.get(name)
+    if profile is None:
+        logger.warning(f"Unknown encoder profile '{name}', using 'screen'")
+        profile = PROFILES["screen"]
+
+    max_bitrate = os.environ.get("QEMU_WEBRTC_MAX_BITRATE", "").strip()
+    if max_bitrate:
+        try:
+            value = int(max_bitrate)
+            profile = replace(
+                profile,
+                max_bitrate=value,
+                start_bitrate=min(profile.start_bitrate, value),
+                min_bitrate=min(profile.min_bitrate, value),
+            )
+        except ValueError:
+            logger.warning(f"Invalid QEMU_WEBRTC_MAX_BITRATE: {max_bitrate}")
+
+    keyframe_interval = os.environ.get("QEMU_WEBRTC_KEYFRAME_INTERVAL", "").strip()
+    if keyframe_interval:
+        try:
+            profile = replace(profile, keyframe_interval=max(1, int(keyframe_interval)))
+        except ValueError:
+            logger.warning(f"Invalid QEMU_WEBRTC_KEYFRAME_INTERVAL: {keyframe_interval}")
+
+    return profile
+
+
+def load_codec_preference() -> Optional[str]:
+    """
+    QEMU_WEBRTC_CODEC から優先コーデックを読み込む（vp8 / h264 / auto）
+
+    Returns:
+        MIMEタイプ、autoの場合None
+    """
+    name = os.environ.get("QEMU_WEBRTC_CODEC", "auto").strip().lower()
+    if name in ("", "auto"):
+        return None
+    mime_type = CODEC_MIME_TYPES.get(name)
+    if mime_type is None:
+        logger.warning(f"Unknown codec '{name}', using aiortc default order")
+    return mime_type
+
+
+def apply_codec_preference(transceiver, mime_type: Optional[str]):
+    """
+    トランシーバーのコーデック優先順位を設定
+
+    優先コーデックを先頭に置き、残りはフォールバックとして残す
+    （ブラウザが優先コーデックに対応していなくても接続できるように）。
+    """
+    if mime_type is None:
+        return
+    codecs = RTCRtpSender.getCapabilities("video").codecs
+    preferred = [c for c in codecs if c.mimeType.lower() == mime_type.lower()]
+    if not preferred:
+        logger.warning(f"Codec {mime_type} is not supported by aiortc")
+        return
+    others = [c for c in codecs if c not in preferred]
+    transceiver.setCodecPreferences(preferred + others)
+    logger.info(f"Codec preference: {mime_type}")
+
+
+class _ProfiledBitrateMixin:
+    """プロファイルの範囲でtarget_bitrateを管理"""
+
+    def _init_profile(self, profile: EncoderProfile):
+        self.profile = profile
+        self._profile_bitrate = profile.start_bitrate
+        # 最後のエンコード完了時刻（time.perf_counter()、ConnectionTrackが送信時間の計測に使う）
+        self.encoded_at: Optional[float] = None
+
+    @property
+    def target_bitrate(self) -> int:
+        return self._profile_bitrate
+
+    @target_bitrate.setter
+    def target_bitrate(self, bitrate: int) -> None:
+        self._profile_bitrate = max(self.profile.min_bitrate, min(int(bitrate), self.profile.max_bitrate))
+
+    def _needs_reset(self, frame) -> bool:
+        # aiortcと同じ条件（サイズ変更 / ビットレート10%超の変化）
+        return bool(self.codec) and (
+            frame.width != self.codec.width
+            or frame.height != self.codec.height
+            or abs(self.target_bitrate - self.codec.bit_rate) / self.codec.bit_rate > 0.1
+        )
+
+
+class ProfiledVp8Encoder(_ProfiledBitrateMixin, Vp8Encoder):
+    """プロファイル適用済みVP8エンコーダ"""
+
+    def __init__(self, profile: EncoderProfile):
+        super().__init__()
+        self._init_profile(profile)
+
+    def encode(self, frame, force_keyframe: bool = False):
+        started = time.perf_counter()
+        flow = None
+        if tracing.TRACER.enabled:
+            # reformat前のフレーム（track.recvが返したもの）から求める
+            flow = (tracing.FLOW_ENCODE, tracing.flow_id(id(frame), frame.pts))
+        if frame.format.name != "yuv420p":
+            frame = frame.reformat(format="yuv420p")
+        if self._needs_reset(frame):
+            self.codec = None
+        if self.codec is None:
+            self.codec = self._create_codec(frame)
+        try:
+            return super().encode(frame, force_keyframe)
+        finally:
+            self.encoded_at = metrics.ENCODE.observe_since(started)
+            if flow is not None:
+                tracing.TRACER.span("encode", started, self.encoded_at, flow_in=flow,
+                                    codec="vp8", pts=frame.pts, keyframe=force_keyframe)
+
+    def _create_codec(self, frame):
+        profile = self.profile
+        bitrate = self.target_bitrate
+        codec = av.CodecContext.create("libvpx", "w")
+        codec.width = frame.width
+        codec.height = frame.height
+        codec.bit_rate = bitrate
+        codec.pix_fmt = "yuv420p"
+        codec.gop_size = profile.keyframe_interval
+        codec.qmin = 2
+        codec.qmax = 56
+        codec.options = {
+            "bufsize": str(bitrate),
+            "cpu-used": str(profile.vp8_cpu_used),
+            "deadline": "realtime",
+            "lag-in-frames": "0",
+            "minrate": str(bitrate),
+            "maxrate": str(bitrate),
+            "noise-sensitivity": str(profile.vp8_noise_sensitivity),
+            "overshoot-pct": "15",
+            "partitions": "0",
+            "static-thresh": str(profile.vp8_static_thresh),
+            "undershoot-pct": "100",
+        }
+        codec.thread_count = number_of_threads(
+            frame.width * frame.height, multiprocessing.cpu_count()
+        )
+        return codec
+
+
+class ProfiledH264Encoder(_ProfiledBitrateMixin, H264Encoder):
+    """プロファイル適用済みH.264エンコーダ"""
+
+    def __init__(self, profile: EncoderProfile):
+        super().__init__()
+        self._init_profile(profile)
+
+    def encode(self, frame, force_keyframe: bool = False):
+        started = time.perf_counter()
+        try:
+            return super().encode(frame, force_keyframe)
+        finally:
+            self.encoded_at = metrics.ENCODE.observe_since(started)
+            if tracing.TRACER.enabled:
+                tracing.TRACER.span("encode", started, self.encoded_at,
+                                    flow_in=(tracing.FLOW_ENCODE, tracing.flow_id(id(frame), frame.pts)),
+                                    codec="h264", pts=frame.pts, keyframe=force_keyframe)
+
+    def _encode_frame(self, frame, force_keyframe: bool):
+        if self._needs_reset(frame):
+            self.buffer_data = b""
+            self.buffer_pts = None
+            self.codec = None
+        if self.codec is None:
+            self.codec = self._create_codec(frame)
+        yield from super()._encode_frame(frame, force_keyframe)
+
+    def _create_codec(self, frame):
+        profile = self.profile
+        bitrate = self.target_bitrate
+        codec = av.CodecContext.create("libx264", "w")
+        codec.width = frame.width
+        codec.height = frame.height
+        codec.bit_rate = bitrate
+        codec.pix_fmt = "yuv420p"
+        codec.framerate = fractions.Fraction(30, 1)
+        codec.time_base = fractions.Fraction(1, 30)
+        codec.gop_size = profile.keyframe_interval
+        codec.options = {
+            "level": profile.h264_level,
+            "preset": profile.h264_preset,
+            "tune": profile.h264_tune,
+            "maxrate": str(bitrate),
+            "bufsize": str(bitrate),
+            "x264-params": f"keyint={profile.keyframe_interval}:scenecut=0",
+        }
+        codec.profile = "Baseline"
+        return codec
+
+
+def create_encoder(codec, profile: EncoderProfile):
+    """RTCRtpCodecParametersに対応するエンコーダを生成"""
+    mime_type = codec.mimeType.lower()
+    if mime_type == "video/vp8":
+        return ProfiledVp8Encoder(profile)
+    if mime_type == "video/h264":
+        return ProfiledH264Encoder(profile)
+    return get_encoder(codec)
+
+
+_installed_profile: Optional[EncoderProfile] = None
+
+
+def install_encoder_profile(profile: EncoderProfile):
+    """
+    aiortcのRTCRtpSenderが使うエンコーダ生成関数を差し替える
+
+    プロセス全体で1つのプロファイルを使う（デプロイ単位の設定）。
+    """
+    global _installed_profile
+    _installed_profile = profile
+    rtcrtpsender.get_encoder = lambda codec: create_encoder(codec, _installed_profile)
+    logger.info(
+        f"Encoder profile installed: {profile.name} "
+        f"(bitrate {profile.min_bitrate}-{profile.max_bitrate}bps, "
+        f"keyframe every {profile.keyframe_interval} frames)"
+    )
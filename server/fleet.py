@@ -0,0 +1,350 @@
+"""
+Fleet Mode
+
+1プロセスで複数のVMを配信する
+
+QEMU_WEBRTC_FLEET_DIR のUnixソケット（VMごとのD-Busバス、ファイル名の拡張子を除いた
+部分がVM ID）を定期的に走査し、VMごとにDisplayCapture・SignalingServer・InputHandlerを
+作成する。エンドポイントは /vm/{vm_id}/offer のようにVM IDの下に置き、
+ブラウザUIは /vm/{vm_id}/ で開く。
+
+VM間で共有するもの:
+- GLibメインループ（全VMのP2P接続を1スレッドで受ける）
+- EGLレンダラー（描画ごとにコンテキストを付け替える）
+- asyncioのデフォルトexecutor（エンコード・証明書生成、QEMU_WEBRTC_FLEET_THREADS）
+- DTLS証明書プールとICE収集済みRTCPeerConnectionのプール
+
+QEMU_WEBRTC_WORKERSを指定するとキャプチャとエンコードをワーカープロセスに分散し
+（shard.py）、このプロセスはシグナリング・RTP送信・入力だけを受け持つ。
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import os
+import re
+import stat
+import time
+from pathlib import Path
+from typing import Optional
+
+from aiohttp import web
+
+from dbus.display_capture import DisplayCapture
+from dbus.dmabuf_gl import get_renderer
+from dbus.glib_asyncio import GLibAsyncioIntegration
+from telemetry import metrics, tracing
+from .signaling import SignalingServer, build_rtc_configuration
+from .input_handler import InputHandler
+from .pc_pool import CertificatePool, PeerConnectionPool
+from .shard import RemoteDisplay, WorkerSupervisor
+from .warmup import WarmStartup
+
+logger = logging.getLogger(__name__)
+
+# VM IDに使える文字（URLのパスにそのまま入れる）
+VM_ID_PATTERN = re.compile(r"^[A-Za-z0-9_.-]+$")
+
+# VMごとのエンドポイント: (メソッド, パス, VMInstance -> ハンドラ)
+VM_ROUTES = [
+    ("GET", "ready", lambda vm: vm.warmup.handle_ready),
+    ("POST", "offer", lambda vm: vm.signaling.handle_offer),
+    ("GET", "ws", lambda vm: vm.signaling.handle_websocket),
+    ("POST", "client-metrics", lambda vm: vm.signaling.handle_client_metrics),
+    ("POST", "viewport", lambda vm: vm.signaling.handle_viewport),
+    ("GET", "sessions", lambda vm: vm.signaling.handle_sessions),
+    ("GET", "consoles", lambda vm: vm.signaling.handle_consoles),
+    ("GET", "latency", lambda vm: vm.signaling.handle_latency),
+    ("POST", "mouse", lambda vm: vm.input_handler.handle_mouse),
+    ("POST", "keyboard", lambda vm: vm.input_handler.handle_keyboard),
+    ("POST", "type", lambda vm: vm.input_handler.handle_type),
+    ("GET", "keymap", lambda vm: vm.input_handler.handle_keymap),
+    ("GET", "input-stats", lambda vm: vm.input_handler.handle_input_stats),
+]
+
+
+class VMInstance:
+    """1台のVM（D-Busバス1本）分のキャプチャ・シグナリング・入力"""
+
+    def __init__(self, vm_id: str, bus_address: str, fleet: "Fleet"):
+        """
+        Args:
+            vm_id: VM ID（URLのパス）
+            bus_address: VMのD-Busアドレス（unix:path=...）
+            fleet: 共有リソースを持つFleet
+        """
+        self.vm_id = vm_id
+        self.bus_address = bus_address
+        self.connect_timeout = fleet.connect_timeout
+        self.warmup = WarmStartup()
+        if fleet.supervisor is not None:
+            self.display_capture = RemoteDisplay(fleet.supervisor, vm_id, bus_address)
+            self.display_capture.on_lost = self._on_worker_lost
+        else:
+            self.display_capture = DisplayCapture(bus_address, glib_integration=fleet.glib_integration)
+        self.signaling = SignalingServer(
+            self.display_capture, fleet.webrtc_config_payload,
+            certificates=fleet.certificates, pc_pool=fleet.pc_pool,
+        )
+        self.signaling.warmup = self.warmup
+        self.input_handler = InputHandler(self.display_capture)
+        self.input_handler.loop_monitor = fleet.loop_monitor
+        self.signaling.input_handler = self.input_handler
+        self.state = "starting"  # starting / ready / failed / stopped
+        self.failed_at: Optional[float] = None
+        self._snapshot_task = None
+
+    async def _with_timeout(self, awaitable):
+        """応答しないQEMU（一時停止中など）の接続処理を打ち切る"""
+        try:
+            return await asyncio.wait_for(awaitable, self.connect_timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"no reply from QEMU within {self.connect_timeout}s") from None
+
+    async def start(self) -> bool:
+        """
+        QEMUに接続してListenerを登録（失敗・タイムアウトした場合はstate="failed"）
+
+        D-Busの呼び出しはexecutorで行われ、QEMUが応答しなくてもループは止まらない。
+        失敗したVMはFleetが再試行間隔の後に作り直す。
+        """
+        try:
+            if not await self.warmup.step("discovery", self._with_timeout(self.display_capture.connect())):
+                raise RuntimeError("failed to connect to QEMU D-Bus")
+            if not await self.warmup.step("listener", self._with_timeout(self.display_capture.setup_listener())):
+                raise RuntimeError("failed to setup DisplayListener")
+        except Exception as e:
+            logger.error(f"VM {self.vm_id}: {e}")
+            self.state = "failed"
+            self.failed_at = time.monotonic()
+            self.display_capture.disconnect()
+            return False
+
+        self.warmup.mark_ready()
+        self.state = "ready"
+        self._snapshot_task = asyncio.create_task(self.signaling.run_snapshots())
+        logger.info(f"✓ VM {self.vm_id} ready: {self.display_capture.width}x{self.display_capture.height} "
+                    f"({len(self.display_capture.consoles)} consoles, {self.bus_address})")
+        return True
+
+    def _on_worker_lost(self):
+        """担当ワーカーが終了した（Fleetの再試行で別のワーカーに割り当て直す）"""
+        if self.state != "ready":
+            return
+        self.state = "failed"
+        self.failed_at = time.monotonic()
+        if self._snapshot_task is not None:
+            self._snapshot_task.cancel()
+        asyncio.ensure_future(self.signaling.cleanup_all())
+        self.display_capture.disconnect()
+
+    async def stop(self):
+        """セッションを閉じてQEMUから切断"""
+        if self.state in ("stopped", "failed"):
+            # 失敗時はstart()で切断済み
+            self.state = "stopped"
+            return
+        self.state = "stopped"
+        if self._snapshot_task is not None:
+            self._snapshot_task.cancel()
+        await self.signaling.cleanup_all()
+        self.display_capture.disconnect()
+        logger.info(f"VM {self.vm_id} stopped")
+
+    def stats(self) -> dict:
+        """/vms用"""
+        return {
+            "id": self.vm_id,
+            "address": self.bus_address,
+            "state": self.state,
+            "readyMs": self.warmup.ready_ms,
+            "errors": dict(self.warmup.errors),
+            "consoles": len(self.display_capture.consoles),
+            "sessions": len(self.signaling.sessions),
+            "viewers": sum(1 for s in self.signaling.sessions.values() if s.detached_at is None),
+            "worker": getattr(getattr(self.display_capture, "worker", None), "index", None),
+        }
+
+
+class Fleet:
+    """ソケットディレクトリから見つけたVM群"""
+
+    def __init__(self, socket_dir: str, webrtc_config_payload: dict, loop_monitor=None):
+        """
+        Args:
+            socket_dir: VMごとのD-Busバスのソケットを置くディレクトリ
+            webrtc_config_payload: /webrtc-configの設定ペイロード（全VM共通）
+            loop_monitor: LoopLagMonitor（全VM共有）
+        """
+        self.socket_dir = Path(socket_dir)
+        self.webrtc_config_payload = webrtc_config_payload
+        self.loop_monitor = loop_monitor
+        self.rescan_interval = float(os.environ.get("QEMU_WEBRTC_FLEET_RESCAN", "5"))
+        # 接続に失敗したVMを再試行するまでの時間（秒）
+        self.retry_interval = float(os.environ.get("QEMU_WEBRTC_FLEET_RETRY", "30"))
+        # VMの接続・Listener登録のそれぞれを打ち切るまでの時間（秒）
+        self.connect_timeout = float(os.environ.get("QEMU_WEBRTC_FLEET_CONNECT_TIMEOUT", "10"))
+        # エンコード・証明書生成などに使うスレッド数（全VM共有）
+        self.threads = int(os.environ.get("QEMU_WEBRTC_FLEET_THREADS", str(os.cpu_count() or 4)))
+        self.vms = {}  # vm_id -> VMInstance
+        self._skipped = set()  # 警告済みのソケット名
+        # キャプチャ・エンコードを分散するワーカープロセス数（0でこのプロセス内）
+        workers = int(os.environ.get("QEMU_WEBRTC_WORKERS", "0"))
+        self.supervisor = WorkerSupervisor(workers) if workers > 0 else None
+
+        # VM間で共有するリソース
+        self.glib_integration = GLibAsyncioIntegration()
+        self.certificates = CertificatePool(int(os.environ.get("QEMU_WEBRTC_CERT_POOL", "4")))
+        self.certificates.install()
+        self.pc_pool = PeerConnectionPool(
+            build_rtc_configuration(webrtc_config_payload),
+            size=int(os.environ.get("QEMU_WEBRTC_PC_POOL", "1")),
+            max_age=float(os.environ.get("QEMU_WEBRTC_PC_POOL_MAX_AGE", "30")),
+        )
+        # 複数VMのディスパッチスレッドが1つのEGLコンテキストを使う
+        get_renderer().shared = True
+        self._task = None
+        logger.info(f"Fleet initialized: {self.socket_dir} (rescan every {self.rescan_interval}s)")
+
+    def discover(self) -> dict:
+        """
+        ソケットディレクトリを走査
+
+        Returns:
+            {vm_id: D-Busアドレス}
+        """
+        found = {}
+        try:
+            entries = sorted(self.socket_dir.iterdir())
+        except OSError as e:
+            logger.error(f"Cannot scan fleet directory {self.socket_dir}: {e}")
+            return found
+        for path in entries:
+            try:
+                if not stat.S_ISSOCK(path.stat().st_mode):
+                    continue
+            except OSError:
+                continue
+            vm_id = path.name.split(".", 1)[0]
+            if not VM_ID_PATTERN.match(vm_id):
+                if path.name not in self._skipped:
+                    self._skipped.add(path.name)
+                    logger.warning(f"Skipping socket with unusable VM ID: {path.name}")
+                continue
+            found[vm_id] = f"unix:path={path.resolve()}"
+        return found
+
+    async def rescan(self):
+        """新しいソケットのVMを開始し、消えたソケットのVMを停止する"""
+        found = self.discover()
+        now = time.monotonic()
+
+        for vm_id, vm in list(self.vms.items()):
+            if found.get(vm_id) != vm.bus_address:
+                del self.vms[vm_id]
+                await vm.stop()
+            elif vm.state == "failed" and now - vm.failed_at >= self.retry_interval:
+                del self.vms[vm_id]
+
+        started = []
+        for vm_id, address in found.items():
+            if vm_id not in self.vms:
+                vm = VMInstance(vm_id, address, self)
+                self.vms[vm_id] = vm
+                started.append(vm.start())
+        if started:
+            await asyncio.gather(*started)
+
+    def start(self):
+        """共有executor・GLibループ・接続プールを起動し、定期走査を開始"""
+        asyncio.get_running_loop().set_default_executor(
+            concurrent.futures.ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="fleet")
+        )
+        if self.supervisor is not None:
+            self.supervisor.start()
+        else:
+            self.glib_integration.start()
+        self.pc_pool.start()
+        metrics.REGISTRY.add_collector(self.metric_samples)
+        if self.supervisor is not None:
+            metrics.REGISTRY.add_remote(self.supervisor.metric_snapshots)
+        self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        try:
+            while True:
+                try:
+                    await self.rescan()
+                except Exception as e:
+                    logger.error(f"Fleet rescan failed: {e}")
+                await asyncio.sleep(self.rescan_interval)
+        except asyncio.CancelledError:
+            pass
+
+    async def close(self):
+        """全VMを停止"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.pc_pool.close()
+        await asyncio.gather(*(vm.stop() for vm in self.vms.values()), return_exceptions=True)
+        self.vms.clear()
+        if self.supervisor is not None:
+            await self.supervisor.close()
+        self.glib_integration.stop()
+
+    def metric_samples(self):
+        """VMごとのセッションfps・キューの深さ（vmラベル付き）とワーカーのリング使用量"""
+        for vm_id, vm in list(self.vms.items()):
+            if vm.state != "ready":
+                continue
+            yield from vm.signaling.metric_samples(vm=vm_id)
+            yield from vm.input_handler.metric_samples(vm=vm_id)
+        if self.supervisor is not None:
+            yield from self.supervisor.metric_samples()
+
+    def _vm_handler(self, get_handler):
+        """URLのvm_idでVMを選んでハンドラに渡す"""
+        async def handler(request: web.Request):
+            vm = self.vms.get(request.match_info["vm_id"])
+            if vm is None or vm.state == "stopped":
+                return web.json_response({"error": "unknown vm"}, status=404)
+            return await get_handler(vm)(request)
+        return handler
+
+    def add_routes(self, app: web.Application, index, webrtc_config):
+        """
+        VMごとのエンドポイントを /vm/{vm_id}/ 以下に登録
+
+        Args:
+            app: aiohttp Application
+            index: ブラウザUIを返すハンドラ
+            webrtc_config: /webrtc-configのハンドラ（全VM共通）
+        """
+        async def vm_root(request: web.Request):
+            # 相対パスのfetchが /vm/{vm_id}/ 以下を指すように末尾のスラッシュを付ける
+            raise web.HTTPFound(f"/vm/{request.match_info['vm_id']}/")
+
+        app.router.add_get("/vms", self.handle_vms)
+        app.router.add_get("/metrics", metrics.handle_metrics)
+        app.router.add_get("/trace", tracing.handle_trace)
+        if self.supervisor is not None:
+            app.router.add_get("/workers", self.supervisor.handle_workers)
+        app.router.add_get("/vm/{vm_id}", vm_root)
+        app.router.add_get("/vm/{vm_id}/", self._vm_handler(lambda vm: index))
+        app.router.add_get("/vm/{vm_id}/webrtc-config", self._vm_handler(lambda vm: webrtc_config))
+        for method, path, get_handler in VM_ROUTES:
+            app.router.add_route(method, f"/vm/{{vm_id}}/{path}", self._vm_handler(get_handler))
+
+    async def handle_vms(self, request: web.Request) -> web.Response:
+        """
+        VM一覧と状態
+
+        Returns:
+            {"vms": [...], "pcPool", "certificatePool"}
+        """
+        return web.json_response({
+            "vms": [vm.stats() for vm in self.vms.values()],
+            "pcPool": self.pc_pool.stats(),
+            "certificatePool": self.certificates.stats(),
+        })
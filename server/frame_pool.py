@@ -0,0 +1,99 @@
+"""
+Frame Pool
+
+エンコーダ入力用のav.VideoFrameを事前確保して再利用する
+
+DisplayCaptureのフレームバッファから直接プレーンへコピーすることで、
+フレームごとの大きなメモリ確保（ndarray.copy / VideoFrame.from_ndarray）と
+それに伴うページフォールトをなくす。
+"""
+
+import logging
+from typing import Optional, Tuple
+
+import numpy as np
+from av import VideoFrame
+
+logger = logging.getLogger(__name__)
+
+
+def plane_view(frame: VideoFrame) -> np.ndarray:
+    """
+    rgb24フレームのプレーンを (height, width, 3) のndarrayビューとして返す
+
+    プレーンの行はアラインメントのためwidth*3より長い場合がある（line_size）。
+    """
+    plane = frame.planes[0]
+    rows = np.frombuffer(plane, dtype=np.uint8).reshape(frame.height, plane.line_size)
+    return rows[:, :frame.width * 3].reshape(frame.height, frame.width, 3)
+
+
+class FramePool:
+    """
+    解像度ごとのrgb24フレームのリングバッファ
+
+    acquire()は次のスロットを返す。直前に書き込んだスロット（再送用）は
+    次のacquire()まで上書きされない。
+    """
+
+    def __init__(self, size: int = 2):
+        """
+        Args:
+            size: スロット数（2以上）
+        """
+        self.size = max(2, size)
+        self.frames = []
+        self.views = []
+        self.frame_size: Optional[Tuple[int, int]] = None
+        self.index = 0
+        self._black: Optional[VideoFrame] = None
+
+        # 検証用カウンター
+        self.allocations = 0
+        self.reuses = 0
+
+    def _allocate(self, width: int, height: int):
+        self.frames = []
+        self.views = []
+        for _ in range(self.size):
+            frame = VideoFrame(width, height, "rgb24")
+            self.frames.append(frame)
+            self.views.append(plane_view(frame))
+        self.allocations += self.size
+        self.frame_size = (width, height)
+        self.index = 0
+        logger.info(f"FramePool allocated: {self.size} x {width}x{height}")
+
+    def acquire(self, width: int, height: int) -> Tuple[VideoFrame, np.ndarray]:
+        """
+        書き込み用のフレームを取得
+
+        Args:
+            width, height: フレームサイズ（変わった場合は再確保）
+
+        Returns:
+            (VideoFrame, 書き込み可能なndarrayビュー)
+        """
+        if self.frame_size != (width, height):
+            self._allocate(width, height)
+        else:
+            self.reuses += 1
+        self.index = (self.index + 1) % self.size
+        return self.frames[self.index], self.views[self.index]
+
+    def black_frame(self, width: int, height: int) -> VideoFrame:
+        """黒画面フレーム（サイズごとに1回だけ確保）"""
+        if self._black is None or (self._black.width, self._black.height) != (width, height):
+            self._black = VideoFrame(width, height, "rgb24")
+            plane_view(self._black)[:] = 0
+            self.allocations += 1
+        return self._black
+
+    def stats(self) -> dict:
+        """確保・再利用回数"""
+        return {
+            "allocations": self.allocations,
+            "reuses": self.reuses,
+            "size": self.size,
+            "frameSize": self.frame_size,
+        }
@@ -0,0 +1,446 @@
+"""
+Offer Routing Gateway
+
+複数のサーバーノード（単一VMまたはフリートモードのserver/main.py）の前に置き、
+VMごとのエンドポイントを担当ノードへ中継する（QEMU_WEBRTC_GATEWAY=1）
+
+ノードはQEMU_WEBRTC_GATEWAY_URLを指定すると、配信中のVMと負荷（視聴者数・CPU・
+ループ停止時間）を定期的にPOST /nodes/heartbeatで送る。一定時間届かないノードは外す。
+
+ルーティング:
+- /vm/{vm_id}/... はそのVMを配信しているノードへ中継する。同じVM IDを複数のノードが
+  配信している場合（同じQEMUに複数ノードが接続しているなど）は最も負荷の低いノードを選ぶ。
+  session_id・再接続トークンを含むリクエストはOfferを処理したノードへ送る
+- / は最も負荷の低いVMの /vm/{vm_id}/ へリダイレクトする
+- /vm/{vm_id}/ws はWebSocketのまま中継する
+
+ゲートウェイが中継するのはシグナリングとHTTP入力だけで、映像とDataChannelの入力は
+ブラウザとノードの間で直接流れる（ノードのICE候補はブラウザから到達できる必要がある）。
+
+ハートビートはQEMU_WEBRTC_GATEWAY_TOKENのBearerトークンで認証する（登録したノードが
+VMのOffer・入力の中継先になるため）。トークンなしで起動するには --insecure-heartbeat が必要。
+ノードのURLはスキーム・ホスト・ポートのみ、VMのパスは / か /vm/{vm_id}/ のみ受け付ける。
+"""
+
+import asyncio
+import hmac
+import json
+import logging
+import os
+import re
+import socket
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+from urllib.parse import urlsplit
+
+import aiohttp
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# VM IDに使える文字（fleet.VM_ID_PATTERNと同じ、リダイレクト先のパスに入れる）
+VM_ID_PATTERN = re.compile(r"^[A-Za-z0-9_.-]+$")
+# ノード上のVMのベースパス（単一VMは "/"、フリートモードは "/vm/{vm_id}/"）
+VM_PATH_PATTERN = re.compile(r"^/(vm/[A-Za-z0-9_.-]+/)?$")
+# 中継するリクエストヘッダー（hop-by-hopヘッダーは転送しない）
+FORWARD_HEADERS = ("Content-Type", "Accept", "User-Agent")
+# Offerを処理したノードを覚えておく時間（秒、再接続の猶予より長く）
+SESSION_TTL = 3600.0
+
+
+@dataclass
+class NodeInfo:
+    """ハートビートで届いたノードの状態"""
+    node_id: str
+    url: str  # ノードのベースURL（http://host:port）
+    vms: dict  # vm_id -> {"path", "state", "viewers", "sessions"}
+    load: dict  # {"viewers", "sessions", "cpuPct", "loadAvg", "loopLag"}
+    last_seen: float = field(default_factory=time.monotonic)
+    heartbeats: int = 0
+
+    def score(self) -> tuple:
+        """小さいほど空いている（視聴者数、CPU使用率）"""
+        return (self.load.get("viewers", 0), self.load.get("cpuPct", 0.0))
+
+    def stats(self) -> dict:
+        return {
+            "id": self.node_id,
+            "url": self.url,
+            "vms": self.vms,
+            "load": self.load,
+            "lastSeenSec": round(time.monotonic() - self.last_seen, 1),
+            "heartbeats": self.heartbeats,
+        }
+
+
+def parse_node_url(url: str) -> str:
+    """
+    ハートビートのノードURLを検証
+
+    Returns:
+        末尾のスラッシュを除いたURL（http(s)://host[:port]）
+
+    Raises:
+        ValueError: スキームがhttp(s)でない、ホストがない、パス・クエリ等を含む
+    """
+    parts = urlsplit(url)
+    port = parts.port  # 数字以外・範囲外のポートはValueError
+    if (parts.scheme not in ("http", "https") or not parts.hostname or parts.username is not None
+            or parts.path not in ("", "/") or parts.query or parts.fragment
+            or port == 0):
+        raise ValueError(f"invalid node url: {url!r}")
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+class Gateway:
+    """ノードの登録とVMごとのリクエスト中継"""
+
+    def __init__(self, insecure_heartbeat: bool = False):
+        """
+        Args:
+            insecure_heartbeat: トークンなしのハートビートを受け付ける（--insecure-heartbeat）
+
+        Raises:
+            RuntimeError: QEMU_WEBRTC_GATEWAY_TOKENが未設定でinsecure_heartbeatも指定していない
+        """
+        # ハートビートがこの秒数届かないノードは外す
+        self.timeout = float(os.environ.get("QEMU_WEBRTC_GATEWAY_TIMEOUT", "15"))
+        # ハートビートに "Authorization: Bearer <token>" を要求する
+        self.token = os.environ.get("QEMU_WEBRTC_GATEWAY_TOKEN", "")
+        if not self.token and not insecure_heartbeat:
+            raise RuntimeError("QEMU_WEBRTC_GATEWAY_TOKEN is required "
+                               "(use --insecure-heartbeat to accept unauthenticated nodes)")
+        if not self.token:
+            logger.warning("Accepting unauthenticated heartbeats (--insecure-heartbeat)")
+        self.nodes = {}  # node_id -> NodeInfo
+        self.session_nodes = {}  # session_id -> (node_id, 記録時刻)
+        self.proxied = 0
+        self.proxy_errors = 0
+        self._session: Optional[aiohttp.ClientSession] = None
+        logger.info(f"Gateway initialized (node timeout {self.timeout}s)")
+
+    async def start(self):
+        self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    # ========== レジストリ ==========
+
+    def _expire(self):
+        now = time.monotonic()
+        for node_id, node in list(self.nodes.items()):
+            if now - node.last_seen > self.timeout:
+                logger.warning(f"Node {node_id} timed out ({node.url})")
+                del self.nodes[node_id]
+        for session_id, (_, recorded) in list(self.session_nodes.items()):
+            if now - recorded > SESSION_TTL:
+                del self.session_nodes[session_id]
+
+    def candidates(self, vm_id: str) -> list:
+        """VMを配信している準備完了のノード（空いている順）"""
+        self._expire()
+        nodes = [node for node in self.nodes.values()
+                 if node.vms.get(vm_id, {}).get("state") == "ready"]
+        return sorted(nodes, key=lambda node: (node.vms[vm_id].get("viewers", 0), node.score()))
+
+    def least_loaded_vm(self) -> Optional[str]:
+        """視聴者が最も少ないVM（同数ならノードの負荷が低い方）"""
+        self._expire()
+        best = None
+        for node in self.nodes.values():
+            for vm_id, vm in node.vms.items():
+                if vm.get("state") != "ready":
+                    continue
+                key = (vm.get("viewers", 0), node.score(), vm_id)
+                if best is None or key < best[0]:
+                    best = (key, vm_id)
+        return best[1] if best is not None else None
+
+    async def handle_heartbeat(self, request: web.Request) -> web.Response:
+        """
+        ノードからのハートビート
+
+        Args:
+            request: {"node", "url", "vms": {vm_id: {...}}, "load": {...}} を含むPOSTリクエスト
+        """
+        if self.token and not hmac.compare_digest(
+                request.headers.get("Authorization", "").encode(), f"Bearer {self.token}".encode()):
+            return web.json_response({"error": "unauthorized"}, status=401)
+        try:
+            data = await request.json()
+            node_id = str(data["node"])
+            url = parse_node_url(str(data["url"]))
+            vms = data.get("vms", {})
+            load = data.get("load", {})
+            if not isinstance(vms, dict) or not isinstance(load, dict):
+                raise ValueError("invalid node description")
+            vms = {vm_id: {**vm, "path": vm.get("path", "/")} for vm_id, vm in vms.items()
+                   if VM_ID_PATTERN.match(vm_id) and isinstance(vm, dict)}
+            for vm_id, vm in vms.items():
+                if not isinstance(vm["path"], str) or not VM_PATH_PATTERN.match(vm["path"]):
+                    raise ValueError(f"invalid path for vm {vm_id}: {vm['path']!r}")
+        except (KeyError, ValueError, TypeError, json.JSONDecodeError) as e:
+            return web.json_response({"error": str(e)}, status=400)
+
+        node = self.nodes.get(node_id)
+        if node is None or node.url != url:
+            logger.info(f"Node {node_id} registered: {url} ({len(vms)} VMs)")
+            node = NodeInfo(node_id, url, vms, load)
+            self.nodes[node_id] = node
+        node.vms = vms
+        node.load = load
+        node.last_seen = time.monotonic()
+        node.heartbeats += 1
+        return web.json_response({"status": "ok", "timeout": self.timeout})
+
+    async def handle_nodes(self, request: web.Request) -> web.Response:
+        """登録中のノードと中継の統計"""
+        self._expire()
+        return web.json_response({
+            "nodes": [node.stats() for node in self.nodes.values()],
+            "sessions": len(self.session_nodes),
+            "proxied": self.proxied,
+            "proxyErrors": self.proxy_errors,
+        })
+
+    async def handle_vms(self, request: web.Request) -> web.Response:
+        """全ノードのVM一覧（同じVMを複数ノードが配信している場合はノードごとに並べる）"""
+        self._expire()
+        vms = []
+        for node in self.nodes.values():
+            for vm_id, vm in node.vms.items():
+                vms.append({"id": vm_id, "node": node.node_id, **vm})
+        return web.json_response({"vms": vms})
+
+    async def handle_ready(self, request: web.Request) -> web.Response:
+        """準備完了のVMがあれば200"""
+        vm_id = self.least_loaded_vm()
+        return web.json_response({"ready": vm_id is not None, "nodes": len(self.nodes)},
+                                 status=200 if vm_id is not None else 503)
+
+    async def handle_index(self, request: web.Request) -> web.Response:
+        """最も空いているVMの画面へ"""
+        vm_id = self.least_loaded_vm()
+        if vm_id is None:
+            return web.json_response({"error": "no nodes available"}, status=503)
+        raise web.HTTPFound(f"/vm/{vm_id}/")
+
+    async def handle_vm_root(self, request: web.Request) -> web.Response:
+        # 相対パスのfetchが /vm/{vm_id}/ 以下を指すように末尾のスラッシュを付ける
+        raise web.HTTPFound(f"/vm/{request.match_info['vm_id']}/")
+
+    # ========== 中継 ==========
+
+    def _select_node(self, vm_id: str, session_id: Optional[str]) -> Optional[NodeInfo]:
+        """セッションを持つノード、なければ最も空いているノード"""
+        candidates = self.candidates(vm_id)
+        if session_id is not None and session_id in self.session_nodes:
+            owner = self.session_nodes[session_id][0]
+            for node in candidates:
+                if node.node_id == owner:
+                    return node
+        return candidates[0] if candidates else None
+
+    @staticmethod
+    def _session_id(body: bytes) -> Optional[str]:
+        """リクエストボディのsession_id（再接続のOfferはresume.session_id）"""
+        if not body or not body.lstrip().startswith(b"{"):
+            return None
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return None
+        if not isinstance(data, dict):
+            return None
+        resume = data.get("resume")
+        if isinstance(resume, dict) and isinstance(resume.get("session_id"), str):
+            return resume["session_id"]
+        session_id = data.get("session_id")
+        return session_id if isinstance(session_id, str) else None
+
+    def _remember_session(self, node: NodeInfo, body: bytes):
+        """Answerのsession_idを記録（以後のviewport・client-metricsを同じノードへ）"""
+        try:
+            session_id = json.loads(body).get("session_id")
+        except (ValueError, AttributeError):
+            return
+        if isinstance(session_id, str):
+            self.session_nodes[session_id] = (node.node_id, time.monotonic())
+
+    async def handle_proxy(self, request: web.Request) -> web.StreamResponse:
+        """/vm/{vm_id}/{tail} を担当ノードへ中継"""
+        vm_id = request.match_info["vm_id"]
+        tail = request.match_info["tail"]
+        body = await request.read()
+        node = self._select_node(vm_id, self._session_id(body))
+        if node is None:
+            return web.json_response({"error": "unknown vm"}, status=404)
+
+        # node.urlとpathはハートビートで検証済み（スキーム・ホスト・ポートと / または /vm/{vm_id}/）
+        url = f"{node.url}{node.vms[vm_id]['path']}{tail}"
+        if tail == "ws":
+            return await self._proxy_websocket(request, url)
+
+        headers = {name: request.headers[name] for name in FORWARD_HEADERS if name in request.headers}
+        try:
+            async with self._session.request(
+                request.method, url, params=request.query, data=body or None,
+                headers=headers, allow_redirects=False,
+            ) as response:
+                payload = await response.read()
+                self.proxied += 1
+                if tail == "offer" and response.status == 200:
+                    self._remember_session(node, payload)
+                return web.Response(
+                    body=payload, status=response.status,
+                    headers={name: response.headers[name]
+                             for name in ("Content-Type", "Location") if name in response.headers},
+                )
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.proxy_errors += 1
+            logger.error(f"Proxy to node {node.node_id} failed: {e}")
+            return web.json_response({"error": f"node {node.node_id} unavailable"}, status=502)
+
+    async def _proxy_websocket(self, request: web.Request, url: str) -> web.WebSocketResponse:
+        """WebSocketシグナリングを双方向に中継"""
+        client = web.WebSocketResponse(heartbeat=30)
+        await client.prepare(request)
+        try:
+            async with self._session.ws_connect(url.replace("http", "ws", 1), heartbeat=30) as upstream:
+                self.proxied += 1
+
+                async def relay(source, target):
+                    async for message in source:
+                        if message.type == aiohttp.WSMsgType.TEXT:
+                            await target.send_str(message.data)
+                        elif message.type == aiohttp.WSMsgType.BINARY:
+                            await target.send_bytes(message.data)
+                        else:
+                            break
+
+                tasks = [asyncio.ensure_future(relay(client, upstream)),
+                         asyncio.ensure_future(relay(upstream, client))]
+                # どちらかが閉じたら両方閉じる
+                await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in tasks:
+                    task.cancel()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.proxy_errors += 1
+            logger.error(f"WebSocket proxy to {url} failed: {e}")
+            if not client.closed:
+                await client.send_json({"type": "error", "error": "node unavailable"})
+        if not client.closed:
+            await client.close()
+        return client
+
+    def add_routes(self, app: web.Application):
+        app.router.add_get("/", self.handle_index)
+        app.router.add_get("/ready", self.handle_ready)
+        app.router.add_get("/nodes", self.handle_nodes)
+        app.router.add_post("/nodes/heartbeat", self.handle_heartbeat)
+        app.router.add_get("/vms", self.handle_vms)
+        app.router.add_get("/vm/{vm_id}", self.handle_vm_root)
+        app.router.add_route("*", "/vm/{vm_id}/{tail:.*}", self.handle_proxy)
+
+
+class HeartbeatReporter:
+    """ノード側: 配信中のVMと負荷をゲートウェイへ定期送信"""
+
+    def __init__(self, gateway_url: str, port: int, collect_vms, loop_monitor=None):
+        """
+        Args:
+            gateway_url: ゲートウェイのベースURL（QEMU_WEBRTC_GATEWAY_URL）
+            port: このノードの待ち受けポート
+            collect_vms: () -> {vm_id: {"path", "state", "viewers", "sessions"}}
+            loop_monitor: LoopLagMonitor（負荷として送る）
+        """
+        self.gateway_url = gateway_url.rstrip("/")
+        hostname = socket.gethostname()
+        # ブラウザ（ゲートウェイ経由のHTTP）とゲートウェイから到達できるURL
+        self.public_url = os.environ.get("QEMU_WEBRTC_PUBLIC_URL", f"http://{hostname}:{port}").rstrip("/")
+        self.node_id = os.environ.get("QEMU_WEBRTC_NODE_ID", f"{hostname}:{port}")
+        self.interval = float(os.environ.get("QEMU_WEBRTC_HEARTBEAT", "5"))
+        self.token = os.environ.get("QEMU_WEBRTC_GATEWAY_TOKEN", "")
+        self.collect_vms = collect_vms
+        self.loop_monitor = loop_monitor
+        self.sent = 0
+        self.failures = 0
+        self._cpu_sample = (time.monotonic(), time.process_time())
+        self._task = None
+
+    def _cpu_pct(self) -> float:
+        """前回のハートビートからのプロセスCPU使用率"""
+        now, cpu = time.monotonic(), time.process_time()
+        last_now, last_cpu = self._cpu_sample
+        self._cpu_sample = (now, cpu)
+        return round((cpu - last_cpu) / max(now - last_now, 1e-6) * 100, 1)
+
+    def payload(self) -> dict:
+        vms = self.collect_vms()
+        return {
+            "node": self.node_id,
+            "url": self.public_url,
+            "vms": vms,
+            "load": {
+                "viewers": sum(vm.get("viewers", 0) for vm in vms.values()),
+                "sessions": sum(vm.get("sessions", 0) for vm in vms.values()),
+                "cpuPct": self._cpu_pct(),
+                "loadAvg": round(os.getloadavg()[0], 2),
+                "cpus": os.cpu_count(),
+                "loopLag": self.loop_monitor.stats() if self.loop_monitor is not None else None,
+            },
+        }
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+        logger.info(f"Reporting to gateway {self.gateway_url} as {self.node_id} ({self.public_url})")
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        headers = {"Authorization": f"Bearer {self.token}"} if self.token else {}
+        timeout = aiohttp.ClientTimeout(total=max(1.0, self.interval))
+        try:
+            async with aiohttp.ClientSession(timeout=timeout, headers=headers) as session:
+                while True:
+                    try:
+                        async with session.post(f"{self.gateway_url}/nodes/heartbeat",
+                                                json=self.payload()) as response:
+                            if response.status != 200:
+                                raise aiohttp.ClientError(f"HTTP {response.status}")
+                        if self.failures:
+                            logger.info(f"Gateway reachable again after {self.failures} failures")
+                        self.failures = 0
+                        self.sent += 1
+                    except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                        self.failures += 1
+                        if self.failures == 1:
+                            logger.warning(f"Heartbeat to {self.gateway_url} failed: {e}")
+                    await asyncio.sleep(self.interval)
+        except asyncio.CancelledError:
+            pass
+
+
+def vm_entry(path: str, state: str, signaling) -> dict:
+    """
+    ハートビートのVM1台分
+
+    Args:
+        path: ノード上のVMのベースパス（単一VMは "/"、フリートモードは "/vm/{vm_id}/"）
+        state: "ready"のVMだけがルーティング対象
+        signaling: VMのSignalingServer
+    """
+    sessions = signaling.sessions.values()
+    return {
+        "path": path,
+        "state": state,
+        "viewers": sum(1 for session in sessions if session.detached_at is None),
+        "sessions": len(signaling.sessions),
+    }
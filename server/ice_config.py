@@ -0,0 +1,209 @@
+"""
+ICE Gathering Controls
+
+aioiceのホスト候補収集を絞り込む
+
+- インターフェースの許可/除外リスト（fnmatchパターン、例: "eth*", "tap*"）。
+  VMごとのbridge/tapが多いホストで無駄な候補と接続確認を減らす
+- ローカルアドレス一覧のキャッシュ（aioiceは収集のたびに全インターフェースを列挙する）
+- UDPポート範囲（ファイアウォールで開けた範囲だけを使う）
+- 接続ごとの収集時間と候補数の記録
+
+aioice.iceのget_host_addressesとasyncio参照を差し替え、aiortcのRTCIceGatherer.gatherを
+計測付きにする（プロセス全体の設定）。
+"""
+
+import asyncio
+import fnmatch
+import itertools
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+import ifaddr
+from aioice import ice
+from aiortc.rtcicetransport import RTCIceGatherer
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class IceGatheringPolicy:
+    """ホスト候補の収集方針"""
+    interfaces: list = field(default_factory=list)  # 許可するインターフェース（空なら全て）
+    exclude_interfaces: list = field(default_factory=list)  # 除外するインターフェース
+    port_range: Optional[tuple] = None  # (最小, 最大)
+    address_cache_ttl: float = 30.0  # アドレス一覧のキャッシュ時間（秒、0で無効）
+
+    def allows(self, name: str) -> bool:
+        if self.interfaces and not any(fnmatch.fnmatch(name, p) for p in self.interfaces):
+            return False
+        return not any(fnmatch.fnmatch(name, p) for p in self.exclude_interfaces)
+
+
+def parse_ice_gathering_env(env, errors: list) -> dict:
+    """
+    環境変数からICE収集設定を読み込む（/webrtc-configのペイロード用、不正な値はerrorsに追加）
+
+    Returns:
+        {"interfaces", "excludeInterfaces", "portRange", "addressCacheSec"}
+    """
+    def patterns(name):
+        return [p.strip() for p in env.get(name, "").split(",") if p.strip()]
+
+    port_range = None
+    value = env.get("QEMU_WEBRTC_ICE_PORT_RANGE", "").strip()
+    if value:
+        try:
+            low, high = (int(v) for v in value.split("-", 1))
+            if not 1024 <= low <= high <= 65535:
+                raise ValueError
+            port_range = [low, high]
+        except ValueError:
+            errors.append("QEMU_WEBRTC_ICE_PORT_RANGE must be MIN-MAX within 1024-65535")
+
+    try:
+        cache_sec = float(env.get("QEMU_WEBRTC_ICE_ADDRESS_CACHE", "30"))
+    except ValueError:
+        errors.append("QEMU_WEBRTC_ICE_ADDRESS_CACHE must be a number of seconds")
+        cache_sec = 30.0
+
+    return {
+        "interfaces": patterns("QEMU_WEBRTC_ICE_INTERFACES"),
+        "excludeInterfaces": patterns("QEMU_WEBRTC_ICE_EXCLUDE_INTERFACES"),
+        "portRange": port_range,
+        "addressCacheSec": cache_sec,
+    }
+
+
+def policy_from_payload(payload: dict) -> IceGatheringPolicy:
+    """parse_ice_gathering_env()の結果からポリシーを作成"""
+    port_range = payload.get("portRange")
+    return IceGatheringPolicy(
+        interfaces=list(payload.get("interfaces", [])),
+        exclude_interfaces=list(payload.get("excludeInterfaces", [])),
+        port_range=tuple(port_range) if port_range else None,
+        address_cache_ttl=float(payload.get("addressCacheSec", 30.0)),
+    )
+
+
+_policy = IceGatheringPolicy()
+_address_cache = {}  # (use_ipv4, use_ipv6) -> (取得時刻, アドレス一覧)
+_installed = False
+
+
+def get_host_addresses(use_ipv4: bool, use_ipv6: bool) -> list:
+    """aioice.ice.get_host_addressesの置き換え（インターフェース絞り込み・キャッシュ）"""
+    key = (use_ipv4, use_ipv6)
+    cached = _address_cache.get(key)
+    now = time.monotonic()
+    if cached is not None and now - cached[0] < _policy.address_cache_ttl:
+        return list(cached[1])
+
+    addresses = []
+    skipped = []
+    for adapter in ifaddr.get_adapters():
+        name = adapter.nice_name or adapter.name
+        if not _policy.allows(name):
+            skipped.append(name)
+            continue
+        for ip in adapter.ips:
+            if isinstance(ip.ip, str) and use_ipv4 and ip.ip != "127.0.0.1":
+                addresses.append(ip.ip)
+            elif not isinstance(ip.ip, str) and use_ipv6 and ip.ip[0] != "::1" and ip.ip[2] == 0:
+                addresses.append(ip.ip[0])
+
+    if cached is None or cached[1] != addresses:
+        logger.info(f"ICE host addresses: {addresses} (skipped interfaces: {len(skipped)})")
+    _address_cache[key] = (now, addresses)
+    return list(addresses)
+
+
+class _PortRangeLoop:
+    """ホスト候補のUDPソケットを指定範囲のポートにバインドするループのラッパー"""
+
+    _ports = None  # 範囲内を巡回するイテレータ（接続間でポートをずらす）
+
+    def __init__(self, loop):
+        self._loop = loop
+
+    def __getattr__(self, name):
+        return getattr(self._loop, name)
+
+    async def create_datagram_endpoint(self, protocol_factory, local_addr=None, **kwargs):
+        port_range = _policy.port_range
+        if port_range is None or local_addr is None or local_addr[1] != 0:
+            return await self._loop.create_datagram_endpoint(
+                protocol_factory, local_addr=local_addr, **kwargs
+            )
+        low, high = port_range
+        if _PortRangeLoop._ports is None:
+            _PortRangeLoop._ports = itertools.cycle(range(low, high + 1))
+        for _ in range(high - low + 1):
+            port = next(_PortRangeLoop._ports)
+            try:
+                return await self._loop.create_datagram_endpoint(
+                    protocol_factory, local_addr=(local_addr[0], port), **kwargs
+                )
+            except OSError:
+                continue
+        raise OSError(f"No free UDP port in {low}-{high} on {local_addr[0]}")
+
+
+class _AsyncioProxy:
+    """aioice.ice内のasyncio参照（get_event_loopのみ差し替え）"""
+
+    def __getattr__(self, name):
+        return getattr(asyncio, name)
+
+    @staticmethod
+    def get_event_loop():
+        return _PortRangeLoop(asyncio.get_event_loop())
+
+
+def install_ice_gathering(policy: IceGatheringPolicy):
+    """
+    aioice/aiortcに収集方針を適用（プロセスで1回だけ）
+
+    フリートではVMごとのSignalingServerから呼ばれるため、2回目以降は
+    アドレスキャッシュ・ポート割り当ての状態を消さずにそのまま返す。
+
+    Args:
+        policy: IceGatheringPolicy
+    """
+    global _policy, _installed
+    if _installed:
+        if policy != _policy:
+            logger.warning("ICE gathering policy already installed in this process, "
+                           "ignoring a different one")
+        return
+    _policy = policy
+    ice.get_host_addresses = get_host_addresses
+    if policy.port_range is not None:
+        ice.asyncio = _AsyncioProxy()
+
+    original_gather = RTCIceGatherer.gather
+
+    async def gather(self):
+        started = time.perf_counter()
+        await original_gather(self)
+        if getattr(self, "gathering_ms", None) is None:
+            self.gathering_ms = round((time.perf_counter() - started) * 1000, 1)
+
+    RTCIceGatherer.gather = gather
+    _installed = True
+
+    logger.info(
+        f"ICE gathering policy: interfaces={policy.interfaces or 'all'}, "
+        f"exclude={policy.exclude_interfaces or 'none'}, ports={policy.port_range or 'any'}, "
+        f"address cache={policy.address_cache_ttl}s"
+    )
+
+
+def gathering_stats(ice_gatherer) -> dict:
+    """RTCIceGathererの収集時間と候補数"""
+    return {
+        "gatheringMs": getattr(ice_gatherer, "gathering_ms", None),
+        "localCandidates": len(ice_gatherer.getLocalCandidates()),
+    }
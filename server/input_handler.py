@@ -2,15 +2,39 @@
 Input Handler for WebRTC
 
 ブラウザからの入力イベントを受信してQEMUに送信
+
+入力はRTCPeerConnection上のDataChannel（マウス移動は順序なしの
+input-unordered、ボタン・キーは順序ありのinput）で受け取る。
+DataChannelのメッセージはバイナリ（input_protocol）を基本とし、
+キーコードをクライアントで解決できない場合のみJSONを使う。
+DataChannelが使えないクライアント向けに /mouse と /keyboard も残す。
+文字列の一括入力は /type（DataChannelでは {"kind": "text", ...}）で受け付ける。
 """
 
+import asyncio
+import json
 import logging
 import time
 from aiohttp import web
-from dbus.keymap import js_code_to_qemu
+from dbus.keymap import JS_TO_QEMU, js_code_to_qemu
+from telemetry import metrics
+
+from .input_scheduler import InputScheduler
+from .text_input import TextTyper
+from .input_protocol import (
+    EVENT_MOVE, EVENT_MOVE_REL, EVENT_PRESS, EVENT_RELEASE, EVENT_KEYDOWN, EVENT_KEYUP,
+    decode_events, to_screen_coords, relative_deltas, timestamp_older,
+)
 
 logger = logging.getLogger(__name__)
 
+# KeyboardEvent.codeで判定できない場合のKeyboardEvent.key → QEMUキーコード
+SPECIAL_KEY_MAP = {
+    '\\': 124,  # IntlYen
+    '|': 124,   # IntlYen with shift
+    '¥': 124,   # Yen key
+}
+
 
 class InputHandler:
     """マウス/キーボード入力ハンドラ"""
@@ -21,12 +45,191 @@ class InputHandler:
             display_capture: DisplayCaptureインスタンス
         """
         self.display_capture = display_capture
-        self._mouse_move_count = 0  # Phase 2: 測定用カウンター
+        # 送信キュー（同じ周回内のマウス移動を結合、実際のD-Bus送信時間は/input-statsのdispatch）
+        self.scheduler = InputScheduler(display_capture)
+        self.typer = TextTyper(self.scheduler)
+        self._typing_tasks = set()
+        self._mouse_move_count = 0
+        self.loop_monitor = None  # LoopLagMonitor（main.pyが設定）
         logger.info("InputHandler initialized")
     
+    def attach_datachannel(self, channel, latency=None):
+        """
+        入力用DataChannelのメッセージをこのハンドラに接続
+        
+        バイナリメッセージはinput_protocolのイベント列、文字列メッセージは
+        {"kind": "mouse" | "keyboard" | "text", ...} のJSON（フィールドは /mouse, /keyboard, /type と同じ）。
+        順序なしチャネルでは古いマウス移動（seq・タイムスタンプが戻ったもの）を捨てる。
+        
+        Args:
+            channel: aiortcのRTCDataChannel
+            latency: セッションのLatencyTracker（入力→画面更新の遅延計測）
+        """
+        unordered = not channel.ordered
+        last_move_seq = [-1]
+        last_move_timestamp = [None]
+        logger.info(f"Input DataChannel attached: {channel.label} "
+                    f"({'unordered' if unordered else 'ordered'})")
+        
+        @channel.on("message")
+        def on_message(message):
+            try:
+                t_receive = time.perf_counter()
+                if isinstance(message, bytes):
+                    events = decode_events(message)
+                    if unordered and len(events):
+                        timestamp = int(events["timestamp"][-1])
+                        if (last_move_timestamp[0] is not None
+                                and timestamp_older(timestamp, last_move_timestamp[0])):
+                            return
+                        last_move_timestamp[0] = timestamp
+                    self.handle_binary_events(events, t_receive, latency)
+                    return
+                data = json.loads(message)
+                kind = data.get('kind')
+                if kind == 'mouse':
+                    seq = data.get('seq')
+                    if unordered and seq is not None:
+                        if seq <= last_move_seq[0]:
+                            return
+                        last_move_seq[0] = seq
+                    self.handle_mouse_event(data, t_receive, latency)
+                elif kind == 'keyboard':
+                    self.handle_keyboard_event(data, latency)
+                elif kind == 'text':
+                    # 入力完了まで他のメッセージ処理を止めない
+                    task = asyncio.ensure_future(self._type_text_from_channel(data))
+                    self._typing_tasks.add(task)
+                    task.add_done_callback(self._typing_tasks.discard)
+            except Exception as e:
+                logger.error(f"DataChannel input error ({channel.label}): {e}")
+    
+    def handle_binary_events(self, events, t_receive: float, latency=None):
+        """
+        バイナリイベント列をQEMUに送信
+        
+        座標変換はバッチ全体でまとめて行い、送信は到着順に1件ずつ行う。
+        
+        Args:
+            events: input_protocol.EVENT_DTYPEの配列
+            t_receive: 受信時刻（time.perf_counter()、input_receiveの計測用）
+            latency: LatencyTracker（押下イベントをクライアント時刻付きで計測）
+        """
+        capture = self.display_capture
+        sink = self.scheduler
+        xs, ys = to_screen_coords(events, capture.width, capture.height)
+        dxs, dys = relative_deltas(events)
+        for i, event_type in enumerate(events["type"].tolist()):
+            if event_type == EVENT_MOVE:
+                sink.send_mouse_move(int(xs[i]), int(ys[i]))
+                self._mouse_move_count += 1
+            elif event_type == EVENT_MOVE_REL:
+                sink.send_mouse_rel(int(dxs[i]), int(dys[i]))
+                self._mouse_move_count += 1
+            elif event_type in (EVENT_PRESS, EVENT_RELEASE):
+                button = int(events["buttons"][i])
+                sink.send_mouse_move(int(xs[i]), int(ys[i]))
+                if event_type == EVENT_PRESS:
+                    if latency is not None:
+                        latency.begin("press", int(events["timestamp"][i]), int(xs[i]), int(ys[i]))
+                    sink.send_mouse_press(button)
+                    logger.info(f"Mouse press: {button}")
+                else:
+                    sink.send_mouse_release(button)
+                    logger.info(f"Mouse release: {button}")
+            elif event_type == EVENT_KEYDOWN:
+                keycode = int(events["keycode"][i])
+                if latency is not None:
+                    latency.begin("keydown", int(events["timestamp"][i]))
+                sink.send_key_press(keycode)
+                logger.info(f"Key down: {keycode}")
+            elif event_type == EVENT_KEYUP:
+                keycode = int(events["keycode"][i])
+                sink.send_key_release(keycode)
+                logger.info(f"Key up: {keycode}")
+            else:
+                logger.warning(f"Unknown binary input event type: {event_type}")
+        metrics.INPUT_RECEIVE.observe_since(t_receive)
+    
+    async def handle_input_stats(self, request: web.Request) -> web.Response:
+        """
+        入力送信のブロック時間とasyncioループの停止時間
+        
+        QEMU_WEBRTC_ASYNC_INPUT=0/1、QEMU_WEBRTC_INPUT_CONNECTION=dedicated/shared で比較できる
+        """
+        capture = self.display_capture
+        return web.json_response({
+            'mode': 'async' if capture.input_sender is not None else 'sync',
+            'dispatch': capture.input_timing.stats(),
+            'connection': capture.input_connection_stats(),
+            'scheduler': self.scheduler.stats(),
+            'typing': self.typer.stats(),
+            'loopLag': self.loop_monitor.stats() if self.loop_monitor is not None else None,
+        })
+    
+    def metric_samples(self, **labels):
+        """
+        入力キューの深さ（/metricsのコレクター）
+        
+        Args:
+            labels: 全系列に付けるラベル（フリートモードのvmなど）
+        """
+        yield ("qemu_webrtc_queue_depth", {**labels, "queue": "input_scheduler"}, len(self.scheduler.queue))
+        connection_stats = getattr(self.display_capture, "input_connection_stats", None)
+        if connection_stats is not None:
+            yield ("qemu_webrtc_queue_depth", {**labels, "queue": "input_connection"},
+                   connection_stats().get("queued"))
+    
+    async def handle_keymap(self, request: web.Request) -> web.Response:
+        """
+        クライアントがバイナリ入力でキーコードを解決するためのキーマップ
+        
+        Returns:
+            {"codes": KeyboardEvent.code → keycode, "keys": KeyboardEvent.key → keycode}
+        """
+        return web.json_response({'codes': JS_TO_QEMU, 'keys': SPECIAL_KEY_MAP})
+    
+    async def handle_type(self, request: web.Request) -> web.Response:
+        """
+        文字列を入力
+        
+        Args:
+            request: {"text": str, "layout": "us" | "jp", "delayMs": float, "batch": int}
+                （text以外は省略可）。textの改行はCRLF・LF・CRのいずれも1回のEnterとして入力する
+        
+        Returns:
+            入力した文字数・スキップした文字数・所要時間
+        """
+        try:
+            data = await request.json()
+            if not isinstance(data.get('text'), str):
+                return web.json_response({'error': 'text is required'}, status=400)
+            result = await self._type_text(data)
+            return web.json_response(result)
+        except ValueError as e:
+            return web.json_response({'error': str(e)}, status=400)
+        except Exception as e:
+            logger.error(f"Type error: {e}")
+            return web.json_response({'error': str(e)}, status=500)
+    
+    async def _type_text(self, data: dict) -> dict:
+        return await self.typer.type_text(
+            data['text'],
+            layout=data.get('layout'),
+            delay_ms=data.get('delayMs'),
+            batch=data.get('batch'),
+        )
+    
+    async def _type_text_from_channel(self, data: dict):
+        """DataChannelからの文字列入力（結果は返さずログのみ）"""
+        try:
+            await self._type_text(data)
+        except Exception as e:
+            logger.error(f"DataChannel typing error: {e}")
+    
     async def handle_mouse(self, request: web.Request) -> web.Response:
         """
-        マウスイベントを処理
+        マウスイベントを処理（HTTPフォールバック）
         
         Args:
             request: マウスイベントデータを含むPOSTリクエスト
@@ -35,79 +238,10 @@ class InputHandler:
             JSONレスポンス
         """
         try:
-            # === Phase 2: 測定開始 ===
-            t_receive = time.time()
+            t_receive = time.perf_counter()
             
             data = await request.json()
-            t1 = time.time()
-            
-            event_type = data.get('type')
-            
-            if event_type == 'move':
-                # マウス移動
-                x_norm = data.get('x_norm')
-                y_norm = data.get('y_norm')
-                if x_norm is None or y_norm is None:
-                    x = int(data.get('x', 0))
-                    y = int(data.get('y', 0))
-                else:
-                    x = int(max(0, min(1, float(x_norm))) * (self.display_capture.width - 1))
-                    y = int(max(0, min(1, float(y_norm))) * (self.display_capture.height - 1))
-
-                t2 = time.time()
-                self.display_capture.send_mouse_move(x, y)
-                t3 = time.time()
-
-                # 100回に1回だけログ（頻繁すぎるため）
-                self._mouse_move_count += 1
-                if self._mouse_move_count % 100 == 0:
-                    logger.debug(f"[PERF-MOUSE] #{self._mouse_move_count}: 受信→JSON解析={(t1-t_receive)*1000:.1f}ms, D-Bus送信={(t3-t2)*1000:.1f}ms, 総時間={(t3-t_receive)*1000:.1f}ms")
-            elif event_type == 'move_rel':
-                # マウス相対移動
-                dx = int(data.get('dx', 0))
-                dy = int(data.get('dy', 0))
-
-                t2 = time.time()
-                self.display_capture.send_mouse_rel(dx, dy)
-                t3 = time.time()
-
-                self._mouse_move_count += 1
-                if self._mouse_move_count % 100 == 0:
-                    logger.debug(f"[PERF-MOUSE] #{self._mouse_move_count}: 受信→JSON解析={(t1-t_receive)*1000:.1f}ms, D-Bus送信={(t3-t2)*1000:.1f}ms, 総時間={(t3-t_receive)*1000:.1f}ms")
-                
-            elif event_type == 'press':
-                # マウスボタン押下
-                button = int(data.get('button', 1))
-                x_norm = data.get('x_norm')
-                y_norm = data.get('y_norm')
-                
-                t2 = time.time()
-                if x_norm is not None and y_norm is not None:
-                    x = int(max(0, min(1, float(x_norm))) * (self.display_capture.width - 1))
-                    y = int(max(0, min(1, float(y_norm))) * (self.display_capture.height - 1))
-                    self.display_capture.send_mouse_move(x, y)
-                self.display_capture.send_mouse_press(button)
-                t3 = time.time()
-                
-                logger.info(f"Mouse press: {button}")
-                logger.debug(f"[PERF-MOUSE] Press: D-Bus送信={(t3-t2)*1000:.1f}ms")
-                
-            elif event_type == 'release':
-                # マウスボタン解放
-                button = int(data.get('button', 1))
-                x_norm = data.get('x_norm')
-                y_norm = data.get('y_norm')
-                
-                t2 = time.time()
-                if x_norm is not None and y_norm is not None:
-                    x = int(max(0, min(1, float(x_norm))) * (self.display_capture.width - 1))
-                    y = int(max(0, min(1, float(y_norm))) * (self.display_capture.height - 1))
-                    self.display_capture.send_mouse_move(x, y)
-                self.display_capture.send_mouse_release(button)
-                t3 = time.time()
-                
-                logger.info(f"Mouse release: {button}")
-                logger.debug(f"[PERF-MOUSE] Release: D-Bus送信={(t3-t2)*1000:.1f}ms")
+            self.handle_mouse_event(data, t_receive)
             
             return web.json_response({'status': 'ok'})
             
@@ -115,9 +249,74 @@ class InputHandler:
             logger.error(f"Mouse event error: {e}")
             return web.json_response({'error': str(e)}, status=500)
     
+    def handle_mouse_event(self, data: dict, t_receive: float, latency=None):
+        """
+        マウスイベントをQEMUに送信
+        
+        Args:
+            data: マウスイベント（type, x_norm/y_norm, dx/dy, button）
+            t_receive: 受信時刻（time.perf_counter()、input_receiveの計測用）
+            latency: LatencyTracker（押下イベントを計測）
+        """
+        event_type = data.get('type')
+        
+        if event_type == 'move':
+            # マウス移動
+            x_norm = data.get('x_norm')
+            y_norm = data.get('y_norm')
+            if x_norm is None or y_norm is None:
+                x = int(data.get('x', 0))
+                y = int(data.get('y', 0))
+            else:
+                x = int(max(0, min(1, float(x_norm))) * (self.display_capture.width - 1))
+                y = int(max(0, min(1, float(y_norm))) * (self.display_capture.height - 1))
+
+            self.scheduler.send_mouse_move(x, y)
+            self._mouse_move_count += 1
+        elif event_type == 'move_rel':
+            # マウス相対移動
+            dx = int(data.get('dx', 0))
+            dy = int(data.get('dy', 0))
+
+            self.scheduler.send_mouse_rel(dx, dy)
+            self._mouse_move_count += 1
+            
+        elif event_type == 'press':
+            # マウスボタン押下
+            button = int(data.get('button', 1))
+            x_norm = data.get('x_norm')
+            y_norm = data.get('y_norm')
+            
+            x = y = None
+            if x_norm is not None and y_norm is not None:
+                x = int(max(0, min(1, float(x_norm))) * (self.display_capture.width - 1))
+                y = int(max(0, min(1, float(y_norm))) * (self.display_capture.height - 1))
+                self.scheduler.send_mouse_move(x, y)
+            if latency is not None:
+                latency.begin("press", None, x, y)
+            self.scheduler.send_mouse_press(button)
+            
+            logger.info(f"Mouse press: {button}")
+            
+        elif event_type == 'release':
+            # マウスボタン解放
+            button = int(data.get('button', 1))
+            x_norm = data.get('x_norm')
+            y_norm = data.get('y_norm')
+            
+            if x_norm is not None and y_norm is not None:
+                x = int(max(0, min(1, float(x_norm))) * (self.display_capture.width - 1))
+                y = int(max(0, min(1, float(y_norm))) * (self.display_capture.height - 1))
+                self.scheduler.send_mouse_move(x, y)
+            self.scheduler.send_mouse_release(button)
+            
+            logger.info(f"Mouse release: {button}")
+        
+        metrics.INPUT_RECEIVE.observe_since(t_receive)
+    
     async def handle_keyboard(self, request: web.Request) -> web.Response:
         """
-        キーボードイベントを処理
+        キーボードイベントを処理（HTTPフォールバック）
         
         Args:
             request: キーボードイベントデータを含むPOSTリクエスト
@@ -127,37 +326,44 @@ class InputHandler:
         """
         try:
             data = await request.json()
-            event_type = data.get('type')
-            code = data.get('code')
-            key = data.get('key')
-
-            keycode = None
-            if code:
-                keycode = js_code_to_qemu(code)
-
-            special_key_map = {
-                '\\': 124,  # IntlYen
-                '|': 124,   # IntlYen with shift
-                '¥': 124,   # Yen key
-            }
-            if keycode is None and key in special_key_map:
-                keycode = special_key_map[key]
-
-            if keycode is None:
-                keycode = int(data.get('keycode', 0))
-            
-            if event_type == 'keydown':
-                # キー押下
-                self.display_capture.send_key_press(keycode)
-                logger.info(f"Key down: {keycode}")
-                
-            elif event_type == 'keyup':
-                # キー解放
-                self.display_capture.send_key_release(keycode)
-                logger.info(f"Key up: {keycode}")
+            self.handle_keyboard_event(data)
             
             return web.json_response({'status': 'ok'})
             
         except Exception as e:
             logger.error(f"Keyboard event error: {e}")
             return web.json_response({'error': str(e)}, status=500)
+    
+    def handle_keyboard_event(self, data: dict, latency=None):
+        """
+        キーボードイベントをQEMUに送信
+        
+        Args:
+            data: キーボードイベント（type, code, key, keycode）
+            latency: LatencyTracker（キー押下を計測）
+        """
+        event_type = data.get('type')
+        code = data.get('code')
+        key = data.get('key')
+
+        keycode = None
+        if code:
+            keycode = js_code_to_qemu(code)
+
+        if keycode is None and key in SPECIAL_KEY_MAP:
+            keycode = SPECIAL_KEY_MAP[key]
+
+        if keycode is None:
+            keycode = int(data.get('keycode', 0))
+        
+        if event_type == 'keydown':
+            # キー押下
+            if latency is not None:
+                latency.begin("keydown")
+            self.scheduler.send_key_press(keycode)
+            logger.info(f"Key down: {keycode}")
+            
+        elif event_type == 'keyup':
+            # キー解放
+            self.scheduler.send_key_release(keycode)
+            logger.info(f"Key up: {keycode}")
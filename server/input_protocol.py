@@ -0,0 +1,99 @@
+"""
+Binary Input Protocol
+
+ブラウザとサーバー間の固定長バイナリ入力イベント（DataChannel用）
+
+1イベント12バイト（リトルエンディアン）、1メッセージに複数イベントを連結できる:
+
+    offset  size  field
+    0       1     type       EVENT_* （下記）
+    1       1     buttons    press/release: ボタン番号、move: 押下中ボタンのビットマスク
+    2       2     x          move: 0-65535 に正規化した座標、move_rel: int16 のdx
+    4       2     y          同上（dy）
+    6       2     keycode    QEMUキーコード（keydown/keyup）
+    8       4     timestamp  クライアント時刻（ms、2^32で循環）
+
+デコードはnumpyの構造化dtypeでバッチ単位に行い、座標変換もベクトル化する。
+"""
+
+import numpy as np
+
+EVENT_MOVE = 1
+EVENT_MOVE_REL = 2
+EVENT_PRESS = 3
+EVENT_RELEASE = 4
+EVENT_KEYDOWN = 5
+EVENT_KEYUP = 6
+
+EVENT_NAMES = {
+    EVENT_MOVE: "move",
+    EVENT_MOVE_REL: "move_rel",
+    EVENT_PRESS: "press",
+    EVENT_RELEASE: "release",
+    EVENT_KEYDOWN: "keydown",
+    EVENT_KEYUP: "keyup",
+}
+
+COORD_MAX = 0xFFFF
+
+EVENT_DTYPE = np.dtype([
+    ("type", "u1"),
+    ("buttons", "u1"),
+    ("x", "<u2"),
+    ("y", "<u2"),
+    ("keycode", "<u2"),
+    ("timestamp", "<u4"),
+])
+EVENT_SIZE = EVENT_DTYPE.itemsize  # 12
+
+
+def decode_events(data: bytes) -> np.ndarray:
+    """
+    バイナリメッセージをイベント配列に変換（コピーなし）
+
+    Args:
+        data: EVENT_SIZEの倍数長のバイト列
+
+    Returns:
+        EVENT_DTYPEの構造化配列
+
+    Raises:
+        ValueError: 長さが不正な場合
+    """
+    if len(data) % EVENT_SIZE:
+        raise ValueError(f"Invalid input message length: {len(data)} (not a multiple of {EVENT_SIZE})")
+    return np.frombuffer(data, dtype=EVENT_DTYPE)
+
+
+def encode_events(events) -> bytes:
+    """
+    イベントをバイナリにエンコード（テスト・ベンチマーク用）
+
+    Args:
+        events: (type, buttons, x, y, keycode, timestamp) のタプルのリスト
+    """
+    return np.array(events, dtype=EVENT_DTYPE).tobytes()
+
+
+def to_screen_coords(events: np.ndarray, width: int, height: int):
+    """
+    正規化座標を画面座標に一括変換
+
+    move/press/release以外の行の値は意味を持たない。
+
+    Returns:
+        (x, y) int32配列
+    """
+    x = (events["x"].astype(np.int64) * (width - 1) // COORD_MAX).astype(np.int32)
+    y = (events["y"].astype(np.int64) * (height - 1) // COORD_MAX).astype(np.int32)
+    return x, y
+
+
+def relative_deltas(events: np.ndarray):
+    """move_relのdx, dy（int16として再解釈）"""
+    return events["x"].view("<i2"), events["y"].view("<i2")
+
+
+def timestamp_older(timestamp: int, reference: int) -> bool:
+    """循環するu32タイムスタンプの比較（timestampがreferenceより古いか）"""
+    return ((timestamp - reference) & 0xFFFFFFFF) >= 0x80000000
@@ -0,0 +1,102 @@
+"""
+Input Scheduler
+
+入力イベントをキューに積み、イベントループの次の周回でまとめてQEMUに送る
+
+キュー末尾と同種のマウス移動は1件にまとめる:
+- 絶対座標の移動（SetAbsPosition）は最新の座標だけを残す
+- 相対移動（RelMotion）は移動量を合算する
+ボタン・キーイベントは結合の境界になるため、移動との前後関係は保たれる。
+"""
+
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+MOVE = "move"
+REL = "rel"
+
+
+class InputScheduler:
+    """
+    DisplayCaptureと同じsend_*インターフェースを持つ結合キュー
+
+    1回の周回内に届いたイベント（バイナリのバッチ、連続したDataChannelメッセージ）は
+    結合されてから送信される。周回をまたいで溜まる分（ソケット書き込みが詰まっている間）は
+    入力専用接続の送信スレッドが同じ規則で結合する（dbus/input_connection.py）。
+    """
+
+    def __init__(self, display_capture):
+        """
+        Args:
+            display_capture: DisplayCaptureインスタンス（送信先）
+        """
+        self.display_capture = display_capture
+        self.queue = []  # [op, args]
+        self._flush_scheduled = False
+
+        # 検証用カウンター
+        self.enqueued = 0
+        self.coalesced = 0
+        self.sent = 0
+        self.max_queue = 0
+
+    def _push(self, op: str, *args):
+        self.enqueued += 1
+        tail = self.queue[-1] if self.queue else None
+        if tail is not None and tail[0] == op == MOVE:
+            tail[1] = args
+            self.coalesced += 1
+        elif tail is not None and tail[0] == op == REL:
+            tail[1] = (tail[1][0] + args[0], tail[1][1] + args[1])
+            self.coalesced += 1
+        else:
+            self.queue.append([op, args])
+            self.max_queue = max(self.max_queue, len(self.queue))
+
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self.flush)
+
+    def flush(self):
+        """キューのイベントを順に送信"""
+        self._flush_scheduled = False
+        queue, self.queue = self.queue, []
+        capture = self.display_capture
+        for op, args in queue:
+            if op == MOVE:
+                capture.send_mouse_move(*args)
+            elif op == REL:
+                if args != (0, 0):
+                    capture.send_mouse_rel(*args)
+            else:
+                getattr(capture, op)(*args)
+        self.sent += len(queue)
+
+    def send_mouse_move(self, x: int, y: int):
+        self._push(MOVE, x, y)
+
+    def send_mouse_rel(self, dx: int, dy: int):
+        self._push(REL, dx, dy)
+
+    def send_mouse_press(self, button: int):
+        self._push("send_mouse_press", button)
+
+    def send_mouse_release(self, button: int):
+        self._push("send_mouse_release", button)
+
+    def send_key_press(self, keycode: int):
+        self._push("send_key_press", keycode)
+
+    def send_key_release(self, keycode: int):
+        self._push("send_key_release", keycode)
+
+    def stats(self) -> dict:
+        """結合の状況"""
+        return {
+            "enqueued": self.enqueued,
+            "coalesced": self.coalesced,
+            "sent": self.sent,
+            "maxQueue": self.max_queue,
+        }
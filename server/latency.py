@@ -0,0 +1,181 @@
+"""
+Input-to-Photon Latency Tracker
+
+入力イベントから、それによる画面更新が映像として送出されるまでの遅延を
+セッションごとに段階別に計測する
+
+    受信 → damage（ゲストの描画、Listenerの更新通知）
+         → capture（VideoTrackがその更新を含むフレームを読んだ）
+         → sent（エンコード完了、直後にRTP送出）
+
+同時に追跡する入力は1件だけ（サンプリング）。マウス移動はハードウェアカーソルで
+描画されdamageが発生しないことが多いため、ボタン押下とキー押下のみを対象にする。
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Optional
+
+from telemetry import metrics
+
+logger = logging.getLogger(__name__)
+
+# damageを待つ時間（これを過ぎた入力は画面変化なしとみなす）
+PROBE_TIMEOUT_SEC = 2.0
+# マウス押下位置からこの距離内のdamageを対応する更新とみなす
+DAMAGE_RADIUS = 128
+
+STAGES = ("inputToDamage", "damageToCapture", "captureToSent", "total")
+
+
+@dataclass
+class _Probe:
+    kind: str
+    x: Optional[int]
+    y: Optional[int]
+    t_receive: float
+    t_damage: Optional[float] = None
+    damage_seq: Optional[int] = None
+    t_capture: Optional[float] = None
+    pts: Optional[int] = None
+
+
+class LatencyTracker:
+    """1セッション分の遅延計測"""
+
+    def __init__(self, display_capture, window: int = 500):
+        """
+        Args:
+            display_capture: ConsoleCapture（damage通知の購読先）
+            window: パーセンタイル計算に使う直近サンプル数
+        """
+        self.display_capture = display_capture
+        self.samples = {stage: deque(maxlen=window) for stage in STAGES}
+        # クライアント→サーバーの片道遅延の揺らぎ（時計がずれているため最小値基準）
+        self.client_delay = deque(maxlen=window)
+        self._client_offset: Optional[int] = None
+        self.completed = 0
+        self.timeouts = 0
+        self._probe: Optional[_Probe] = None
+        self._lock = threading.Lock()
+        self._hooked_encoder = None
+        display_capture.damage_listeners.append(self.on_damage)
+
+    def close(self):
+        """damage通知の購読を解除"""
+        try:
+            self.display_capture.damage_listeners.remove(self.on_damage)
+        except ValueError:
+            pass
+
+    def begin(self, kind: str, client_ts: Optional[int] = None,
+              x: Optional[int] = None, y: Optional[int] = None):
+        """
+        入力受信時に呼ぶ（asyncioスレッド）
+
+        Args:
+            kind: "press" / "keydown"
+            client_ts: クライアント時刻（ms、u32）
+            x, y: マウス押下位置（画面座標）
+        """
+        now = time.monotonic()
+        if client_ts is not None:
+            offset = (int(now * 1000) - client_ts) & 0xFFFFFFFF
+            if self._client_offset is None or offset < self._client_offset:
+                self._client_offset = offset
+            self.client_delay.append(offset - self._client_offset)
+
+        with self._lock:
+            probe = self._probe
+            if probe is not None:
+                if now - probe.t_receive < PROBE_TIMEOUT_SEC:
+                    return  # 計測中
+                if probe.t_damage is None:
+                    self.timeouts += 1
+            self._probe = _Probe(kind=kind, x=x, y=y, t_receive=now)
+
+    def on_damage(self, x: int, y: int, width: int, height: int, seq: int):
+        """Listenerの更新通知（GLibスレッドから呼ばれる）"""
+        with self._lock:
+            probe = self._probe
+            if probe is None or probe.t_damage is not None:
+                return
+            if probe.x is not None and not (
+                x - DAMAGE_RADIUS <= probe.x < x + width + DAMAGE_RADIUS
+                and y - DAMAGE_RADIUS <= probe.y < y + height + DAMAGE_RADIUS
+            ):
+                return
+            probe.t_damage = time.monotonic()
+            probe.damage_seq = seq
+
+    def on_frame_read(self, seq: int, pts: int, sender=None):
+        """
+        VideoTrackが新しいフレームを読んだとき（asyncioスレッド）
+
+        Args:
+            seq: フレームのframe_seq
+            pts: このフレームに付けるPTS
+            sender: RTCRtpSender（エンコード完了の検出用）
+        """
+        if sender is not None:
+            self._hook_encoder(sender)
+        with self._lock:
+            probe = self._probe
+            if probe is None or probe.t_damage is None or probe.t_capture is not None:
+                return
+            if seq > probe.damage_seq:
+                probe.t_capture = time.monotonic()
+                probe.pts = pts
+
+    def on_frame_encoded(self, pts: int):
+        """エンコード完了（エンコーダのスレッドから呼ばれる）"""
+        with self._lock:
+            probe = self._probe
+            if probe is None or probe.pts is None or pts < probe.pts:
+                return
+            self._probe = None
+        now = time.monotonic()
+        self.samples["inputToDamage"].append((probe.t_damage - probe.t_receive) * 1000)
+        self.samples["damageToCapture"].append((probe.t_capture - probe.t_damage) * 1000)
+        self.samples["captureToSent"].append((now - probe.t_capture) * 1000)
+        self.samples["total"].append((now - probe.t_receive) * 1000)
+        self.completed += 1
+
+    def _hook_encoder(self, sender):
+        """送信側エンコーダのencode()をラップ（エンコーダは最初のフレームで遅延生成）"""
+        encoder = getattr(sender, "_RTCRtpSender__encoder", None)
+        if encoder is None or encoder is self._hooked_encoder:
+            return
+        original = encoder.encode
+        tracker = self
+
+        def encode(frame, force_keyframe=False):
+            result = original(frame, force_keyframe)
+            tracker.on_frame_encoded(frame.pts)
+            return result
+
+        encoder.encode = encode
+        self._hooked_encoder = encoder
+
+    @staticmethod
+    def _percentiles(values) -> Optional[dict]:
+        values = sorted(values)
+        if not values:
+            return None
+        return {
+            "p50": round(metrics.percentile(values, 0.5), 1),
+            "p95": round(metrics.percentile(values, 0.95), 1),
+            "p99": round(metrics.percentile(values, 0.99), 1),
+        }
+
+    def stats(self) -> dict:
+        """段階別のパーセンタイル（ms）"""
+        return {
+            "completed": self.completed,
+            "timeouts": self.timeouts,
+            "clientJitter": self._percentiles(self.client_delay),
+            **{stage: self._percentiles(values) for stage, values in self.samples.items()},
+        }
@@ -0,0 +1,63 @@
+"""
+Event Loop Lag Monitor
+
+asyncioループの停止時間（スケジュールした時刻からの遅れ）を計測する
+
+同期的なD-Bus呼び出しなどでループがブロックされると、
+WebRTC送信・シグナリングを含むすべての処理が遅れる。
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+
+from telemetry import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class LoopLagMonitor:
+    """一定間隔でスリープし、起床の遅れを記録"""
+
+    def __init__(self, interval: float = 0.01, window: int = 1000):
+        """
+        Args:
+            interval: 計測間隔（秒）
+            window: パーセンタイル計算に使う直近サンプル数
+        """
+        self.interval = interval
+        self.samples = deque(maxlen=window)
+        self.max_lag_ms = 0.0
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        try:
+            while True:
+                expected = time.monotonic() + self.interval
+                await asyncio.sleep(self.interval)
+                lag_ms = max(0.0, (time.monotonic() - expected) * 1000)
+                self.samples.append(lag_ms)
+                self.max_lag_ms = max(self.max_lag_ms, lag_ms)
+        except asyncio.CancelledError:
+            pass
+
+    def stats(self) -> dict:
+        """直近の遅れ（ms）"""
+        samples = sorted(self.samples)
+        if not samples:
+            return {"samples": 0}
+        return {
+            "samples": len(samples),
+            "p50Ms": round(metrics.percentile(samples, 0.5), 2),
+            "p99Ms": round(metrics.percentile(samples, 0.99), 2),
+            "maxMs": round(self.max_lag_ms, 2),
+        }
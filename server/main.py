@@ -18,6 +18,14 @@ sys.path.insert(0, str(Path(__file__).parent.parent))
 from dbus.display_capture import DisplayCapture
 from server.signaling import SignalingServer
 from server.input_handler import InputHandler
+from server.warmup import WarmStartup, warm_egl, warm_encoder, warm_certificate
+from server.encoder_profiles import load_encoder_profile, load_codec_preference
+from server.loop_monitor import LoopLagMonitor
+from server.ice_config import parse_ice_gathering_env
+from server.fleet import Fleet
+from server.shard import RemoteDisplay, WorkerSupervisor
+from server.gateway import Gateway, HeartbeatReporter, vm_entry
+from telemetry import metrics, tracing
 
 logging.basicConfig(
     level=logging.WARNING,
@@ -55,10 +63,14 @@ def _load_webrtc_config_payload():
         else:
             config["iceServers"].append({"urls": stun_url})
 
+    # ホスト候補の収集範囲（サーバー側のみで使用、/webrtc-configでは返さない）
+    ice_gathering = parse_ice_gathering_env(os.environ, errors)
+
     payload = {
         "iceServers": config.get("iceServers", []),
         "errors": errors,
         "iceTransportPolicy": config["iceTransportPolicy"],
+        "iceGathering": ice_gathering,
     }
 
     if errors:
@@ -67,19 +79,6 @@ def _load_webrtc_config_payload():
     return payload
 
 
-async def wait_for_initial_frame(display_capture):
-    """初期フレームをバックグラウンドで待機"""
-    try:
-        while True:
-            frame = await display_capture.get_frame()
-            if frame is not None:
-                logger.info(f"✓ Initial frame received: {frame.shape}")
-                break
-            await asyncio.sleep(1)
-    except Exception as e:
-        logger.error(f"Error waiting for initial frame: {e}")
-
-
 async def index(request):
     """インデックスページ"""
     content = Path(__file__).parent.parent / 'client' / 'index.html'
@@ -88,7 +87,131 @@ async def index(request):
 
 async def webrtc_config(request):
     """WebRTC ICE設定を返す"""
-    return web.json_response(request.app["webrtc_config"])
+    payload = {k: v for k, v in request.app["webrtc_config"].items() if k != "iceGathering"}
+    return web.json_response(payload)
+
+
+def _cors_setup(app):
+    """CORS設定"""
+    aiohttp_cors.setup(app, defaults={
+        "*": aiohttp_cors.ResourceOptions(
+            allow_credentials=True,
+            expose_headers="*",
+            allow_headers="*",
+            allow_methods="*",
+        )
+    })
+
+
+async def gateway_main(port: int):
+    """
+    ゲートウェイモード（QEMU_WEBRTC_GATEWAY=1）
+    
+    ノードのハートビートを受け、/vm/{vm_id}/ 以下を担当ノードへ中継する（QEMUには接続しない）
+    """
+    logger.info("Gateway mode")
+    try:
+        gateway = Gateway(insecure_heartbeat="--insecure-heartbeat" in sys.argv[1:])
+    except RuntimeError as e:
+        logger.error(f"Gateway not started: {e}")
+        return
+    await gateway.start()
+    
+    app = web.Application()
+    gateway.add_routes(app)
+    app.router.add_static('/client', Path(__file__).parent.parent / 'client')
+    
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '0.0.0.0', port)
+    await site.start()
+    logger.info(f"✓ Gateway running on http://localhost:{port}/nodes")
+    
+    try:
+        await asyncio.Event().wait()
+    finally:
+        logger.info("Cleaning up...")
+        await gateway.close()
+        await runner.cleanup()
+        logger.info("✓ Shutdown complete")
+
+
+def _start_heartbeat(port: int, collect_vms, loop_monitor):
+    """QEMU_WEBRTC_GATEWAY_URLが設定されていればゲートウェイへのハートビートを開始"""
+    gateway_url = os.environ.get("QEMU_WEBRTC_GATEWAY_URL", "").strip()
+    if not gateway_url:
+        return None
+    reporter = HeartbeatReporter(gateway_url, port, collect_vms, loop_monitor=loop_monitor)
+    reporter.start()
+    return reporter
+
+
+async def _recover_worker(display_capture, signaling, warmup):
+    """
+    単一VMモードでワーカーが終了した場合、再起動したワーカーに接続し直す
+    
+    接続し直すまで/readyは503を返し、Offerを受け付けない（ワーカーの映像は途切れているため
+    既存のセッションは閉じ、クライアントに再接続させる）。
+    """
+    warmup.ready = False
+    await signaling.cleanup_all()
+    if await display_capture.reattach():
+        warmup.ready = True
+
+
+async def fleet_main(socket_dir: str, port: int):
+    """
+    フリートモード（1プロセスで複数VM）
+    
+    socket_dirのD-Busソケットごとに1台のVMとして配信し、/vm/{vm_id}/ 以下にルーティングする
+    """
+    logger.info(f"Fleet mode: watching {socket_dir}")
+    warmup = WarmStartup()
+    webrtc_config_payload = _load_webrtc_config_payload()
+    loop_monitor = LoopLagMonitor()
+    fleet = Fleet(socket_dir, webrtc_config_payload, loop_monitor=loop_monitor)
+    
+    app = web.Application()
+    app["webrtc_config"] = webrtc_config_payload
+    app.router.add_get('/ready', warmup.handle_ready)
+    fleet.add_routes(app, index=index, webrtc_config=webrtc_config)
+    app.router.add_static('/client', Path(__file__).parent.parent / 'client')
+    _cors_setup(app)
+    
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '0.0.0.0', port)
+    await site.start()
+    
+    # EGL・エンコーダ・DTLS証明書のウォームアップは全VMで1回だけ
+    # （ワーカープロセスを使う場合、EGL・エンコーダは各ワーカーが準備する）
+    fleet.start()
+    steps = [warmup.run_in_thread("certificate", warm_certificate, fleet.certificates)]
+    if fleet.supervisor is None:
+        encoder_profile = load_encoder_profile()
+        steps += [
+            warmup.run_in_thread("egl", warm_egl),
+            warmup.run_in_thread("encoder", warm_encoder, encoder_profile,
+                                 [load_codec_preference() or "video/VP8"]),
+        ]
+    await asyncio.gather(*steps)
+    warmup.mark_ready()
+    loop_monitor.start()
+    heartbeat = _start_heartbeat(port, lambda: {
+        vm.vm_id: vm_entry(f"/vm/{vm.vm_id}/", vm.state, vm.signaling) for vm in fleet.vms.values()
+    }, loop_monitor)
+    logger.info(f"✓ Fleet server running on http://localhost:{port}/vms")
+    
+    try:
+        await asyncio.Event().wait()
+    finally:
+        logger.info("Cleaning up...")
+        if heartbeat is not None:
+            heartbeat.stop()
+        loop_monitor.stop()
+        await fleet.close()
+        await runner.cleanup()
+        logger.info("✓ Shutdown complete")
 
 
 async def main():
@@ -98,72 +221,146 @@ async def main():
     logger.info("=" * 80)
     print()
     
-    # 1. DisplayCapture初期化
-    logger.info("1. Initializing DisplayCapture...")
-    display_capture = DisplayCapture()
-    
-    # D-Bus接続
-    if not await display_capture.connect():
-        logger.error("Failed to connect to QEMU D-Bus")
+    port = int(os.environ.get("QEMU_WEBRTC_PORT", "8081"))
+    if os.environ.get("QEMU_WEBRTC_GATEWAY", "0") != "0":
+        await gateway_main(port)
         return
-    
-    logger.info(f"✓ Connected to QEMU: {display_capture.width}x{display_capture.height}")
-    
-    # DisplayListener登録
-    if not await display_capture.setup_listener():
-        logger.error("Failed to setup DisplayListener")
+    fleet_dir = os.environ.get("QEMU_WEBRTC_FLEET_DIR", "").strip()
+    if fleet_dir:
+        await fleet_main(fleet_dir, port)
         return
     
-    logger.info("✓ DisplayListener registered")
-    print()
+    warmup = WarmStartup()
     
-    # 2. WebRTCサーバー起動（先に起動）
-    logger.info("2. Starting WebRTC server...")
+    # 1. DisplayCapture・WebRTCサーバー初期化（/readyは起動中から応答する）
+    logger.info("1. Starting WebRTC server...")
+    # QEMU_WEBRTC_WORKERS>0: キャプチャ・エンコードをワーカープロセスで行う
+    workers = int(os.environ.get("QEMU_WEBRTC_WORKERS", "0"))
+    supervisor = None
+    if workers > 0:
+        supervisor = WorkerSupervisor(workers)
+        display_capture = RemoteDisplay(supervisor, "default")
+        display_capture.on_lost = lambda: asyncio.ensure_future(
+            _recover_worker(display_capture, signaling, warmup))
+    else:
+        display_capture = DisplayCapture()
     
     webrtc_config_payload = _load_webrtc_config_payload()
 
     signaling = SignalingServer(display_capture, webrtc_config_payload)
+    signaling.warmup = warmup
     input_handler = InputHandler(display_capture)
+    signaling.input_handler = input_handler
+    loop_monitor = LoopLagMonitor()
+    input_handler.loop_monitor = loop_monitor
+    # /metricsの現在値（セッションfps・キューの深さ・ワーカーのリング使用量とワーカーの計測値）
+    metrics.REGISTRY.add_collector(signaling.metric_samples)
+    metrics.REGISTRY.add_collector(input_handler.metric_samples)
+    if supervisor is not None:
+        metrics.REGISTRY.add_collector(supervisor.metric_samples)
+        metrics.REGISTRY.add_remote(supervisor.metric_snapshots)
     
     # aiohttp Application作成
     app = web.Application()
     app["webrtc_config"] = webrtc_config_payload
     app.router.add_get('/', index)
     app.router.add_get('/webrtc-config', webrtc_config)
+    app.router.add_get('/ready', warmup.handle_ready)
     app.router.add_post('/offer', signaling.handle_offer)
+    app.router.add_get('/ws', signaling.handle_websocket)
+    app.router.add_post('/client-metrics', signaling.handle_client_metrics)
+    app.router.add_post('/viewport', signaling.handle_viewport)
+    app.router.add_get('/sessions', signaling.handle_sessions)
+    app.router.add_get('/consoles', signaling.handle_consoles)
+    app.router.add_get('/latency', signaling.handle_latency)
     app.router.add_post('/mouse', input_handler.handle_mouse)
     app.router.add_post('/keyboard', input_handler.handle_keyboard)
+    app.router.add_post('/type', input_handler.handle_type)
+    app.router.add_get('/keymap', input_handler.handle_keymap)
+    app.router.add_get('/input-stats', input_handler.handle_input_stats)
+    app.router.add_get('/metrics', metrics.handle_metrics)
+    app.router.add_get('/trace', tracing.handle_trace)
+    if supervisor is not None:
+        app.router.add_get('/workers', supervisor.handle_workers)
     app.router.add_static('/client', Path(__file__).parent.parent / 'client')
     
     # CORS設定
-    cors = aiohttp_cors.setup(app, defaults={
-        "*": aiohttp_cors.ResourceOptions(
-            allow_credentials=True,
-            expose_headers="*",
-            allow_headers="*",
-            allow_methods="*",
-        )
-    })
+    _cors_setup(app)
     
     # サーバー起動
     runner = web.AppRunner(app)
     await runner.setup()
     
-    # ポート8081を使用（8080は使用中）
-    site = web.TCPSite(runner, '0.0.0.0', 8081)
+    # 既定はポート8081（8080は使用中、QEMU_WEBRTC_PORTで変更）
+    site = web.TCPSite(runner, '0.0.0.0', port)
     await site.start()
+    print()
+    
+    # 2. ウォームスタート（EGL・エンコーダ・DTLS証明書はスレッドで並行実行）
+    logger.info("2. Warming up...")
+    background_steps = [
+        warmup.run_in_thread("certificate", warm_certificate, signaling.certificates),
+    ]
+    if supervisor is not None:
+        # EGL・エンコーダはワーカーが起動時に準備する
+        supervisor.start()
+    else:
+        background_steps += [
+            warmup.run_in_thread("egl", warm_egl),
+            warmup.run_in_thread(
+                "encoder", warm_encoder,
+                signaling.encoder_profile, [signaling.codec_mime_type or "video/VP8"],
+            ),
+        ]
+    display_capture.start_glib_loop()
+    # ICE収集済みRTCPeerConnectionの準備と補充（準備完了は待たない）
+    signaling.pc_pool.start()
+    
+    # コンソール検出・DisplayListener登録（D-Bus呼び出しはexecutorで実行し、ループは止めない）
+    if not await warmup.step("discovery", display_capture.connect()):
+        logger.error("Failed to connect to QEMU D-Bus")
+        await signaling.pc_pool.close()
+        display_capture.disconnect()
+        if supervisor is not None:
+            await supervisor.close()
+        await runner.cleanup()
+        return
+    
+    logger.info(f"✓ Connected to QEMU: {display_capture.width}x{display_capture.height} "
+                f"({len(display_capture.consoles)} consoles)")
+    
+    if not await warmup.step("listener", display_capture.setup_listener()):
+        logger.error("Failed to setup DisplayListener")
+        await signaling.pc_pool.close()
+        display_capture.disconnect()
+        if supervisor is not None:
+            await supervisor.close()
+        await runner.cleanup()
+        return
+    
+    logger.info("✓ DisplayListener registered")
+    
+    await asyncio.gather(*background_steps)
+    warmup.mark_ready()
+    print()
     
     logger.info("=" * 80)
-    logger.info("✓ Server running on http://localhost:8081")
+    logger.info(f"✓ Server running on http://localhost:{port}")
     logger.info("=" * 80)
-    logger.info("Open http://localhost:8081 in your browser")
+    logger.info(f"Open http://localhost:{port} in your browser")
     logger.info("Press Ctrl+C to stop")
     logger.info("=" * 80)
     print()
     
-    # 初期フレームを取得（サーバー起動後にバックグラウンドで待機）
-    logger.info("Waiting for initial frame in background...")
-    asyncio.create_task(wait_for_initial_frame(display_capture))
+    # 新規視聴者用のスナップショットをコンソールごとに準備（視聴者がいない間だけ更新）
+    logger.info("Preparing join snapshots in background...")
+    snapshot_task = asyncio.create_task(signaling.run_snapshots())
+    loop_monitor.start()
+    # ゲートウェイに登録（同じVM IDを複数ノードが配信する場合は負荷で振り分けられる）
+    vm_id = os.environ.get("QEMU_WEBRTC_VM_ID", "default")
+    heartbeat = _start_heartbeat(port, lambda: {
+        vm_id: vm_entry("/", "ready" if warmup.ready else "starting", signaling)
+    }, loop_monitor)
     
     try:
         # サーバー実行
@@ -173,8 +370,15 @@ async def main():
     finally:
         # クリーンアップ
         logger.info("Cleaning up...")
+        if heartbeat is not None:
+            heartbeat.stop()
+        snapshot_task.cancel()
+        loop_monitor.stop()
+        await signaling.pc_pool.close()
         await signaling.cleanup_all()
         display_capture.disconnect()
+        if supervisor is not None:
+            await supervisor.close()
         await runner.cleanup()
         logger.info("✓ Shutdown complete")
 
@@ -0,0 +1,203 @@
+"""
+Peer Connection Pool
+
+Offer受信時のRTCPeerConnection生成コストを事前に払っておく
+
+- CertificatePool: DTLS証明書をスレッドで事前生成し、RTCPeerConnection()が
+  生成する代わりにプールから渡す
+- PeerConnectionPool: 送信用videoトランシーバーを追加し、ICE候補の収集
+  （UDPポートのバインド、STUNの問い合わせ）まで済ませたRTCPeerConnectionを保持する。
+  ブラウザのOfferのvideo m-lineはこのトランシーバーに割り当てられ、
+  setLocalDescription()では収集済みの候補がそのまま使われる
+
+STUNで得たNATマッピングは無通信のままだと失効するため、一定時間使われなかった
+接続は破棄して作り直す。
+"""
+
+import asyncio
+import collections
+import logging
+import threading
+import time
+from typing import Optional
+
+from aiortc import RTCPeerConnection, rtcpeerconnection
+from aiortc.rtcdtlstransport import RTCCertificate
+
+logger = logging.getLogger(__name__)
+
+
+class CertificatePool:
+    """事前生成したDTLS証明書のプール"""
+
+    def __init__(self, size: int = 4):
+        """
+        Args:
+            size: 保持する証明書の数
+        """
+        self.size = size
+        self._certificates = collections.deque()
+        self._fill_lock = threading.Lock()
+        self._filling = False
+        self.hits = 0
+        self.misses = 0
+
+    def install(self):
+        """aiortcのRTCPeerConnectionが証明書をこのプールから取るようにする"""
+        pool = self
+
+        class PooledCertificate(RTCCertificate):
+            @classmethod
+            def generateCertificate(cls):
+                return pool.take()
+
+        rtcpeerconnection.RTCCertificate = PooledCertificate
+        logger.info(f"Certificate pool installed (size {self.size})")
+
+    def fill(self) -> int:
+        """
+        プールが満杯になるまで生成（ワーカースレッドで呼ぶ）
+
+        Returns:
+            生成した数
+        """
+        with self._fill_lock:
+            generated = 0
+            while len(self._certificates) < self.size:
+                self._certificates.append(RTCCertificate.generateCertificate())
+                generated += 1
+            self._filling = False
+            return generated
+
+    def take(self) -> RTCCertificate:
+        """証明書を1つ取り出す（空なら同期生成）、バックグラウンドで補充"""
+        try:
+            certificate = self._certificates.popleft()
+            self.hits += 1
+        except IndexError:
+            certificate = RTCCertificate.generateCertificate()
+            self.misses += 1
+        self._schedule_fill()
+        return certificate
+
+    def _schedule_fill(self):
+        if self._filling:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._filling = True
+        loop.run_in_executor(None, self.fill)
+
+    def stats(self) -> dict:
+        return {"available": len(self._certificates), "hits": self.hits, "misses": self.misses}
+
+
+class PeerConnectionPool:
+    """ICE収集済みのRTCPeerConnectionのプール"""
+
+    def __init__(self, configuration=None, size: int = 1, max_age: float = 30.0):
+        """
+        Args:
+            configuration: RTCConfiguration（Noneで既定値）
+            size: 保持する接続数（0で無効）
+            max_age: 接続を保持する最大時間（秒）
+        """
+        self.configuration = configuration
+        self.size = size
+        self.max_age = max_age
+        self._ready = collections.deque()  # (pc, prepared_at)
+        self._wake = asyncio.Event()
+        self._task = None
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.last_prepare_ms: Optional[float] = None
+
+    def create(self) -> RTCPeerConnection:
+        """プールを通さずにRTCPeerConnectionを作成"""
+        if self.configuration is not None:
+            return RTCPeerConnection(configuration=self.configuration)
+        return RTCPeerConnection()
+
+    async def _prepare(self) -> RTCPeerConnection:
+        """videoトランシーバーを追加してICE候補を収集"""
+        started = time.perf_counter()
+        pc = self.create()
+        transceiver = pc.addTransceiver("video", direction="sendonly")
+        await transceiver.sender.transport.transport.iceGatherer.gather()
+        self.last_prepare_ms = (time.perf_counter() - started) * 1000
+        return pc
+
+    def take(self) -> Optional[RTCPeerConnection]:
+        """
+        準備済みの接続を1つ取り出す
+
+        Returns:
+            RTCPeerConnection（addTrack()でvideoトランシーバーに送信トラックを設定する）、
+            プールが空の場合None
+        """
+        self._expire()
+        if self._ready:
+            pc, _ = self._ready.popleft()
+            self.hits += 1
+        else:
+            pc = None
+            if self.size > 0:
+                self.misses += 1
+        self._wake.set()
+        return pc
+
+    def _expire(self):
+        now = time.monotonic()
+        while self._ready and now - self._ready[0][1] > self.max_age:
+            pc, _ = self._ready.popleft()
+            self.expired += 1
+            asyncio.ensure_future(pc.close())
+
+    async def fill(self):
+        """プールが満杯になるまで準備"""
+        self._expire()
+        while len(self._ready) < self.size:
+            pc = await self._prepare()
+            self._ready.append((pc, time.monotonic()))
+
+    def start(self):
+        if self.size > 0:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        try:
+            while True:
+                try:
+                    await self.fill()
+                except Exception as e:
+                    logger.error(f"Peer connection pre-warm failed: {e}")
+                    await asyncio.sleep(5.0)
+                    continue
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=self.max_age / 2)
+                except asyncio.TimeoutError:
+                    pass
+        except asyncio.CancelledError:
+            pass
+
+    async def close(self):
+        """補充を止めて保持中の接続を閉じる"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        while self._ready:
+            pc, _ = self._ready.popleft()
+            await pc.close()
+
+    def stats(self) -> dict:
+        return {
+            "available": len(self._ready),
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "lastPrepareMs": round(self.last_prepare_ms, 1) if self.last_prepare_ms is not None else None,
+        }
@@ -0,0 +1,280 @@
+"""
+Bandwidth Adaptation Controller
+
+RTCPレシーバーレポート / REMBを監視し、セッションごとに
+エンコーダのビットレート・フレームレート・出力スケールを調整する
+"""
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from aiortc.rtp import RtcpPsfbPacket, RTCP_PSFB_APP, unpack_remb_fci
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class QualityLevel:
+    """品質レベル（ラダーの1段）"""
+    bitrate: int  # bps
+    fps: int
+    scale: int  # 1 = フル解像度, 2 = 1/2
+
+
+# 高品質 → 低品質の順: (ビットレート範囲内の位置, fps, scale)
+# 位置は1.0がプロファイルの上限、0.0が下限（間は対数スケールで補間）
+LADDER_STEPS = [
+    (1.0, 15, 1),
+    (0.75, 10, 1),
+    (0.5, 10, 2),
+    (0.25, 8, 2),
+    (0.0, 5, 2),
+]
+
+
+def build_ladder(min_bitrate: int, max_bitrate: int, max_fps: Optional[int] = None) -> list:
+    """
+    エンコーダプロファイルのビットレート範囲から品質ラダーを作る
+
+    範囲はプロファイル（QEMU_WEBRTC_MAX_BITRATEを含む）が決め、
+    適応制御はその中の位置だけを選ぶ。
+
+    Args:
+        min_bitrate: 最下段のビットレート（bps）
+        max_bitrate: 最上段のビットレート（bps）
+        max_fps: トラックのフレームレート上限（各段のfpsをこれ以下にする）
+
+    Returns:
+        QualityLevelのリスト（高品質 → 低品質）
+    """
+    min_bitrate = max(1, min(min_bitrate, max_bitrate))
+    ratio = max_bitrate / min_bitrate
+    return [
+        QualityLevel(bitrate=int(min_bitrate * ratio ** position),
+                     fps=fps if max_fps is None else min(fps, max_fps), scale=scale)
+        for position, fps, scale in LADDER_STEPS
+    ]
+
+
+# aiortc既定の範囲（250kbps〜1.5Mbps）のラダー
+QUALITY_LADDER = build_ladder(250_000, 1_500_000)
+
+# 劣化判定しきい値
+LOSS_DOWNGRADE = 0.10  # 10%以上のパケットロスで劣化
+LOSS_UPGRADE = 0.02  # 2%未満でのみ改善を検討
+RTT_DOWNGRADE = 0.40  # 400ms以上のRTTで劣化
+REMB_DOWN_MARGIN = 0.85  # REMB < 現在ビットレート * 0.85 で劣化
+REMB_UP_MARGIN = 1.15  # REMB >= 次段ビットレート * 1.15 で改善
+
+# ヒステリシス（連続サンプル数とクールダウン）
+DOWNGRADE_SAMPLES = 2
+UPGRADE_SAMPLES = 5
+COOLDOWN_SEC = 3.0
+
+
+def get_sender_encoder(sender):
+    """RTCRtpSenderが保持するエンコーダを取得（未生成ならNone）"""
+    return getattr(sender, "_RTCRtpSender__encoder", None)
+
+
+class AdaptationController:
+    """
+    1セッション（RTCPeerConnection）分の適応制御
+
+    aiortcはREMB受信時にエンコーダのtarget_bitrateを直接書き換えるだけなので、
+    ここでRTCP統計とREMBを集約し、ラダーに沿って品質レベルを上下させる。
+    """
+
+    def __init__(self, sender, track, interval: float = 1.0, start_level: int = 1,
+                 min_bitrate: Optional[int] = None, max_bitrate: Optional[int] = None):
+        """
+        Args:
+            sender: ビデオトラックのRTCRtpSender
+            track: QEMUVideoTrack
+            interval: 評価間隔（秒）
+            start_level: 初期品質レベル（ラダーのインデックス）
+            min_bitrate: ビットレート下限（エンコーダプロファイル由来、Noneで既定のラダー）
+            max_bitrate: ビットレート上限（エンコーダプロファイル由来、Noneで既定のラダー）
+        """
+        self.sender = sender
+        self.track = track
+        self.interval = interval
+        if min_bitrate is None or max_bitrate is None:
+            min_bitrate, max_bitrate = QUALITY_LADDER[-1].bitrate, QUALITY_LADDER[0].bitrate
+        # set_quality()はトラック作成時のfpsを超えないため、ラダーもそこで頭打ちにする
+        self.ladder = build_ladder(min_bitrate, max_bitrate, getattr(track, "max_fps", None))
+        self.level_index = max(0, min(start_level, len(self.ladder) - 1))
+
+        # 最新の観測値
+        self.remb_bitrate: Optional[int] = None
+        self.fraction_lost = 0.0
+        self.rtt: Optional[float] = None
+        self.send_bitrate = 0
+
+        self._down_votes = 0
+        self._up_votes = 0
+        self._last_change = 0.0
+        self._last_bytes_sent = None
+        self._last_sample_time = None
+        self._task = None
+        self._original_rtcp_handler = None
+
+        logger.info(f"AdaptationController initialized: level={self.level_index}, "
+                    f"bitrate {self.ladder[-1].bitrate}-{self.ladder[0].bitrate}bps")
+
+    @property
+    def level(self) -> QualityLevel:
+        return self.ladder[self.level_index]
+
+    def start(self):
+        """RTCPフックを設置し、評価ループを開始"""
+        self._install_rtcp_hook()
+        self._apply_level()
+        self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        """評価ループを停止"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._original_rtcp_handler is not None:
+            self.sender._handle_rtcp_packet = self._original_rtcp_handler
+            self._original_rtcp_handler = None
+
+    def rebind(self, sender):
+        """
+        再接続したセッションの新しいRTCRtpSenderに付け替える（品質レベルは引き継ぐ）
+
+        Args:
+            sender: 新しいRTCRtpSender
+        """
+        self.stop()
+        self.sender = sender
+        self._last_bytes_sent = None
+        self._last_sample_time = None
+        self.start()
+
+    def _install_rtcp_hook(self):
+        """REMBを観測するためRTCPハンドラをラップ"""
+        original = self.sender._handle_rtcp_packet
+        self._original_rtcp_handler = original
+
+        async def handle_rtcp_packet(packet):
+            await original(packet)
+            if isinstance(packet, RtcpPsfbPacket) and packet.fmt == RTCP_PSFB_APP:
+                try:
+                    bitrate, ssrcs = unpack_remb_fci(packet.fci)
+                except ValueError:
+                    return
+                if self.sender._ssrc in ssrcs:
+                    self.remb_bitrate = bitrate
+                    # aiortcがREMB値で上書きしたビットレートをレベル上限に戻す
+                    self._apply_bitrate()
+
+        self.sender._handle_rtcp_packet = handle_rtcp_packet
+
+    async def _run(self):
+        try:
+            while True:
+                await asyncio.sleep(self.interval)
+                await self._sample()
+                self._evaluate()
+                # エンコーダは最初のフレームで遅延生成されるため毎回反映する
+                self._apply_bitrate()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"AdaptationController error: {e}")
+
+    async def _sample(self):
+        """送信統計とリモート受信統計を取得"""
+        report = await self.sender.getStats()
+        now = time.monotonic()
+        for stats in report.values():
+            if stats.type == "remote-inbound-rtp":
+                # RTCP RRのfraction lostは 0-255 の固定小数点
+                self.fraction_lost = (stats.fractionLost or 0) / 256.0
+                self.rtt = stats.roundTripTime
+            elif stats.type == "outbound-rtp":
+                if self._last_bytes_sent is not None and now > self._last_sample_time:
+                    delta = stats.bytesSent - self._last_bytes_sent
+                    self.send_bitrate = int(delta * 8 / (now - self._last_sample_time))
+                self._last_bytes_sent = stats.bytesSent
+                self._last_sample_time = now
+
+    def _evaluate(self):
+        """ヒステリシス付きでレベルを上下させる"""
+        level = self.level
+        congested = (
+            self.fraction_lost >= LOSS_DOWNGRADE
+            or (self.rtt is not None and self.rtt >= RTT_DOWNGRADE)
+            or (self.remb_bitrate is not None
+                and self.remb_bitrate < level.bitrate * REMB_DOWN_MARGIN)
+        )
+
+        if congested:
+            self._down_votes += 1
+            self._up_votes = 0
+        else:
+            self._down_votes = 0
+            if self.level_index > 0 and self.fraction_lost < LOSS_UPGRADE:
+                target = self.ladder[self.level_index - 1]
+                if (self.remb_bitrate is None
+                        or self.remb_bitrate >= target.bitrate * REMB_UP_MARGIN):
+                    self._up_votes += 1
+                else:
+                    self._up_votes = 0
+            else:
+                self._up_votes = 0
+
+        if time.monotonic() - self._last_change < COOLDOWN_SEC:
+            return
+
+        if self._down_votes >= DOWNGRADE_SAMPLES and self.level_index < len(self.ladder) - 1:
+            self._change_level(self.level_index + 1)
+        elif self._up_votes >= UPGRADE_SAMPLES and self.level_index > 0:
+            self._change_level(self.level_index - 1)
+
+    def _change_level(self, index: int):
+        previous = self.level_index
+        self.level_index = index
+        self._down_votes = 0
+        self._up_votes = 0
+        self._last_change = time.monotonic()
+        self._apply_level()
+        logger.info(
+            f"Adaptation level {previous} -> {index}: {self.level} "
+            f"(loss={self.fraction_lost:.1%}, rtt={self.rtt}, remb={self.remb_bitrate}, "
+            f"send={self.send_bitrate}bps)"
+        )
+
+    def _apply_level(self):
+        level = self.level
+        self.track.set_quality(fps=level.fps, scale=level.scale)
+        self._apply_bitrate()
+
+    def _apply_bitrate(self):
+        encoder = get_sender_encoder(self.sender)
+        if encoder is None or not hasattr(encoder, "target_bitrate"):
+            return
+        bitrate = self.level.bitrate
+        if self.remb_bitrate is not None:
+            bitrate = min(bitrate, self.remb_bitrate)
+        encoder.target_bitrate = bitrate
+
+    def state(self) -> dict:
+        """現在の制御状態（デバッグ用）"""
+        level = self.level
+        return {
+            "level": self.level_index,
+            "bitrate": level.bitrate,
+            "fps": level.fps,
+            "scale": level.scale,
+            "remb": self.remb_bitrate,
+            "fractionLost": self.fraction_lost,
+            "rtt": self.rtt,
+            "sendBitrate": self.send_bitrate,
+        }
@@ -0,0 +1,76 @@
+"""
+Frame Scaler
+
+エンコード前にフレームをクライアントの表示サイズへ縮小する
+
+swscaleのコンテキストをVideoReformatterでキャッシュし、
+面積平均（AREA）補間での縮小とyuv420pへの変換を1パスで行う。
+"""
+
+import logging
+from typing import Optional, Tuple
+
+from av import VideoFrame
+from av.video.reformatter import VideoReformatter, Interpolation
+
+logger = logging.getLogger(__name__)
+
+
+def fit_size(src_width: int, src_height: int,
+             max_width: Optional[int] = None, max_height: Optional[int] = None,
+             divisor: float = 1.0) -> Tuple[int, int]:
+    """
+    アスペクト比を保ったまま出力サイズを計算（拡大はしない）
+
+    Args:
+        src_width, src_height: 元サイズ
+        max_width, max_height: 表示サイズ（デバイスピクセル、Noneは制限なし）
+        divisor: 追加の縮小率（帯域適応制御の出力スケール）
+
+    Returns:
+        (width, height) 偶数に丸めたサイズ（yuv420p用）
+    """
+    ratio = 1.0 / max(1.0, divisor)
+    if max_width:
+        ratio = min(ratio, max_width / src_width)
+    if max_height:
+        ratio = min(ratio, max_height / src_height)
+    width = max(2, int(src_width * ratio) & ~1)
+    height = max(2, int(src_height * ratio) & ~1)
+    return width, height
+
+
+class FrameScaler:
+    """
+    キャッシュ付きswscaleスケーラ
+
+    VideoReformatterは入出力サイズ・フォーマットが同じ間
+    SwsContextを再利用する（sws_getCachedContext）。
+    """
+
+    def __init__(self, interpolation: str = "AREA"):
+        self.reformatter = VideoReformatter()
+        self.interpolation = Interpolation[interpolation]
+        self.output_size: Optional[Tuple[int, int]] = None
+
+    def scale(self, frame: VideoFrame, width: int, height: int) -> VideoFrame:
+        """
+        フレームを指定サイズのyuv420pに変換
+
+        Args:
+            frame: 入力フレーム（rgb24など）
+            width, height: 出力サイズ
+
+        Returns:
+            yuv420pのVideoFrame
+        """
+        if self.output_size != (width, height):
+            logger.info(f"Scaler output: {frame.width}x{frame.height} -> {width}x{height}")
+            self.output_size = (width, height)
+        return self.reformatter.reformat(
+            frame,
+            width=width,
+            height=height,
+            format="yuv420p",
+            interpolation=self.interpolation,
+        )
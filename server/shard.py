@@ -0,0 +1,652 @@
+"""
+Worker Sharding
+
+VMのキャプチャとエンコードをワーカープロセスに分散する（QEMU_WEBRTC_WORKERS）
+
+1プロセスではGILが律速になり、1080pの配信が数本並ぶと頭打ちになる。
+WorkerSupervisorがワーカープロセス（shard_worker.py）を起動し、VMを
+割り当て数の少ないワーカーに振り分ける。配信プロセスに残るのは
+シグナリング・ICE/DTLS/SRTP・RTP送信・入力で、映像はワーカーがエンコードした
+RTPペイロードをShmRingで受け取り、RTCRtpSenderにそのまま渡す。
+
+配信プロセス側の代理オブジェクト:
+- RemoteDisplay: DisplayCaptureの代わり（入力は従来どおりこのプロセスからQEMUへ直接送る）
+- RemoteConsole: ConsoleCaptureの代わり（解像度・統計はワーカーから定期的に届く）
+- RemoteVideoTrack / RemoteEncoder: QEMUVideoTrackとエンコーダの代わり
+
+ワーカーが終了した場合は同じ番号のワーカーを起動し直し、割り当てていたVMの
+on_lostを呼ぶ（フリートモードではVMを失敗扱いにして再試行に任せる）。
+on_lostがなければRemoteDisplayが自分で再起動したワーカーに接続し直す。
+"""
+
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import os
+import time
+from dataclasses import dataclass
+from typing import Callable, List, Optional
+
+from aiohttp import web
+from aiortc.mediastreams import MediaStreamError, MediaStreamTrack
+from dasbus.connection import AddressedMessageBus, SessionMessageBus
+
+from dbus.display_capture import DisplayCapture
+from telemetry import metrics, tracing
+from .shard_worker import run_worker
+from .shm_ring import ShmRing
+
+logger = logging.getLogger(__name__)
+
+# ワーカーへの再接続に失敗した場合に次を試すまでの時間（秒）
+REATTACH_RETRY = 5.0
+
+
+@dataclass
+class EncodedFrame:
+    """ワーカーがエンコードした1フレーム（RTPペイロードの列）"""
+    payloads: List[bytes]
+    timestamp: int  # 90kHz
+
+
+class RemoteEncoder:
+    """
+    RTCRtpSenderに設定するエンコーダの代わり
+
+    トラックがav.Frame以外を返すとaiortcはpack()を呼ぶので、ワーカーの
+    ペイロードをそのまま返す。REMB・適応制御のtarget_bitrateはワーカーへ転送する。
+    """
+
+    def __init__(self, track: "RemoteVideoTrack"):
+        self.track = track
+        # 最後に渡したフレームの時刻（ConnectionTrackが送信時間の計測に使う）
+        self.encoded_at: Optional[float] = None
+
+    @property
+    def target_bitrate(self) -> Optional[int]:
+        return self.track.bitrate
+
+    @target_bitrate.setter
+    def target_bitrate(self, bitrate: int):
+        self.track.set_bitrate(bitrate)
+
+    def encode(self, frame, force_keyframe: bool = False):
+        raise RuntimeError("RemoteEncoder only packs frames encoded by a worker")
+
+    def pack(self, frame: EncodedFrame):
+        self.encoded_at = time.perf_counter()
+        return frame.payloads, frame.timestamp
+
+
+class RemoteVideoTrack(MediaStreamTrack):
+    """
+    ワーカープロセスのQEMUVideoTrack＋エンコーダを代理するトラック
+
+    recv()のたびにワーカーへ1フレームを要求する。品質・ビューポート・キーフレームの
+    変更は次の要求にまとめて送る。
+    """
+
+    kind = "video"
+    remote = True
+
+    def __init__(self, console: "RemoteConsole", fps: int = 30, start_time: Optional[float] = None):
+        """
+        Args:
+            console: 配信するRemoteConsole
+            fps: フレームレート
+            start_time: 計測開始時刻（Noneの場合は現在時刻）
+        """
+        super().__init__()
+        self.console = console
+        self.fps = fps
+        self.max_fps = fps
+        self.scale = None
+        self.bitrate: Optional[int] = None
+        self.start_time = start_time or time.time()
+        self.sender = None  # RTCRtpSender（SignalingServerが設定）
+        self.latency = None  # 入力遅延はワーカーのdamage通知を受けないため計測しない
+        self.viewport = (None, None)
+        self.worker: Optional[WorkerHandle] = None  # ストリームを開いたワーカー
+        self.stream_id: Optional[int] = None
+        self.codec_mime: Optional[str] = None
+        self.encoder = RemoteEncoder(self)
+
+        # /sessions用（ワーカーの値を写す）
+        self.frame_count = 0
+        self.fps_meter = metrics.RateMeter()
+        self.first_frame_ms: Optional[float] = None
+        self.first_frame_source: Optional[str] = None
+        self.last_resize_latency_ms: Optional[float] = None
+
+        # 次の要求で送る変更
+        self._settings = {}
+        self._keyframe = False
+
+    def open(self, mime_type: str):
+        """ワーカーにストリームを開く（コーデックが変わった場合は開き直す）"""
+        if self.stream_id is not None:
+            if mime_type == self.codec_mime:
+                return
+            self.worker.close_stream(self.stream_id)
+            self.stream_id = None
+        self.codec_mime = mime_type
+        self.worker = self.console.worker
+        if self.worker is None:
+            # VMのワーカーが終了している
+            return
+        # 開き直したストリームには現在の設定をすべて送る
+        self._settings["viewport"] = self.viewport
+        if self.scale is not None:
+            self._settings["scale"] = self.scale
+        if self.bitrate is not None:
+            self._settings["bitrate"] = self.bitrate
+        self.stream_id = self.worker.open_stream(self, mime_type)
+
+    def passthrough_encoder(self, mime_type: Optional[str]) -> RemoteEncoder:
+        """ネゴシエーションしたコーデックでストリームを開き、送信側に渡すエンコーダを返す"""
+        self.open(mime_type or "video/VP8")
+        return self.encoder
+
+    def set_quality(self, fps: Optional[int] = None, scale: Optional[float] = None):
+        """送信品質を変更（AdaptationControllerから呼ばれる）"""
+        if fps is not None:
+            fps = max(1, min(int(fps), self.max_fps))
+            if fps != self.fps:
+                self.fps = fps
+                self._settings["fps"] = fps
+        if scale is not None and scale != self.scale:
+            self.scale = scale
+            self._settings["scale"] = scale
+
+    def set_viewport(self, width: Optional[int], height: Optional[int]):
+        """クライアントの表示サイズを設定"""
+        self.viewport = (int(width) if width else None, int(height) if height else None)
+        self._settings["viewport"] = self.viewport
+
+    def set_bitrate(self, bitrate: int):
+        if bitrate != self.bitrate:
+            self.bitrate = bitrate
+            self._settings["bitrate"] = bitrate
+
+    def request_keyframe(self):
+        """次のフレームをキーフレームにするようワーカーに要求"""
+        self._keyframe = True
+
+    def _take_keyframe_request(self) -> bool:
+        # PLI/FIRで送信側に立ったフラグはpack()の経路では使われないため、ここで拾う
+        keyframe = self._keyframe
+        self._keyframe = False
+        if self.sender is not None and getattr(self.sender, "_RTCRtpSender__force_keyframe", False):
+            self.sender._RTCRtpSender__force_keyframe = False
+            keyframe = True
+        return keyframe
+
+    async def recv(self) -> EncodedFrame:
+        """ワーカーから次のエンコード済みフレームを受け取る"""
+        if self.readyState != "live":
+            raise MediaStreamError
+        if self.stream_id is None:
+            self.open(self.codec_mime or "video/VP8")
+            if self.stream_id is None:
+                raise MediaStreamError
+        while True:
+            settings, self._settings = self._settings, {}
+            record = await self.worker.pull(self.stream_id, self._take_keyframe_request(), settings or None)
+            if record is not None:
+                break
+            # リングに書けずに落ちたフレームの後はキーフレームから
+            # （すぐに要求し直すとリングが空くまでループを占有するため1フレーム間隔待つ）
+            self._keyframe = True
+            await asyncio.sleep(1.0 / self.fps)
+            if self.readyState != "live" or self.stream_id is None:
+                raise MediaStreamError
+        timestamp, payloads, meta = record
+        self.frame_count += 1
+        self.fps_meter.tick()
+        self.last_resize_latency_ms = meta["resizeLatencyMs"]
+        if self.first_frame_ms is None:
+            self.first_frame_ms = (time.time() - self.start_time) * 1000
+            self.first_frame_source = meta["source"]
+            logger.info(f"First frame from worker after {self.first_frame_ms:.1f}ms "
+                        f"(source={self.first_frame_source})")
+        return EncodedFrame(payloads, timestamp)
+
+    def stop(self):
+        super().stop()
+        if self.stream_id is not None:
+            self.worker.close_stream(self.stream_id)
+            self.stream_id = None
+        logger.info(f"RemoteVideoTrack stopped: {self.frame_count} frames sent")
+
+
+class RemoteConsole:
+    """ワーカーが配信しているコンソールの代理（ConsoleCaptureと同じ属性を持つ）"""
+
+    remote = True
+
+    def __init__(self, display: "RemoteDisplay", info: dict):
+        self.display = display
+        self.console_id = info["id"]
+        self.console_path = f"/org/qemu/Display1/Console_{self.console_id}"
+        # 入力遅延の計測はワーカー側のdamage通知に依存するため配信プロセスでは空
+        self.damage_listeners = []
+        self.resize_time = None
+        self.update(info)
+
+    @property
+    def worker(self) -> "WorkerHandle":
+        return self.display.worker
+
+    def update(self, info: dict):
+        """ワーカーから届いたconsoles_info()の1件を反映"""
+        self.label = info.get("label")
+        self.head = info.get("head")
+        self.console_type = info.get("type")
+        self.width = info.get("width", 0)
+        self.height = info.get("height", 0)
+        self.frame_seq = info.get("frameSeq", 0)
+        self.info = info
+
+    def describe(self) -> dict:
+        return {
+            "id": self.console_id,
+            "label": self.label,
+            "head": self.head,
+            "type": self.console_type,
+            "width": self.width,
+            "height": self.height,
+        }
+
+    def stats(self) -> dict:
+        return {
+            key: self.info[key] for key in ("frameSeq", "dispatched", "backlog", "maxBacklog")
+            if key in self.info
+        }
+
+    def request_ui_info(self, width: int, height: int, dpr: float = 1.0):
+        """表示サイズをワーカー経由でゲストに通知"""
+        if self.worker is not None:
+            self.worker.send(("ui_info", self.display.vm_id, self.console_id, width, height, dpr))
+
+    def create_track(self, fps: int = 30, start_time: Optional[float] = None) -> RemoteVideoTrack:
+        return RemoteVideoTrack(self, fps=fps, start_time=start_time)
+
+    def close(self):
+        """Listener・共有メモリはワーカーが解放する"""
+
+
+class RemoteDisplay(DisplayCapture):
+    """
+    ワーカープロセスで配信するVMのDisplayCapture
+
+    コンソールとフレームはワーカーが持つ。入力プロキシ・入力専用接続は
+    DisplayCaptureと同じくこのプロセスで作成する。
+    """
+
+    def __init__(self, supervisor: "WorkerSupervisor", vm_id: str, bus_address: Optional[str] = None):
+        """
+        Args:
+            supervisor: ワーカーを割り当てるWorkerSupervisor
+            vm_id: VM ID（ワーカーとのやり取りに使う）
+            bus_address: QEMUが接続しているD-Busのアドレス（Noneでセッションバス）
+        """
+        super().__init__(bus_address)
+        self.supervisor = supervisor
+        self.vm_id = vm_id
+        self.worker: Optional[WorkerHandle] = None
+        # ワーカーが終了したときに呼ぶ（フリートモードではVMを失敗扱いにする）
+        # 未設定の場合は再起動したワーカーにreattach()で接続し直す
+        self.on_lost: Optional[Callable[[], None]] = None
+        self._reattach_task = None
+        self._closed = False
+
+    async def connect(self) -> bool:
+        """ワーカーを割り当ててVMに接続させ、入力用の接続をこのプロセスで開く"""
+        self.worker = self.supervisor.assign(self)
+        consoles, error = await self.worker.attach(self)
+        if error is not None:
+            logger.error(f"VM {self.vm_id} on worker {self.worker.index}: {error}")
+            self.worker.displays.pop(self.vm_id, None)
+            self.worker = None
+            return False
+
+        self.consoles = {}
+        for info in consoles:
+            console = RemoteConsole(self, info)
+            self.consoles[console.console_id] = console
+            if info.get("primary"):
+                self.primary = console
+        if not isinstance(self.primary, RemoteConsole):
+            self.primary = next(iter(self.consoles.values()))
+
+        # 入力用の接続（SASL・プロキシ作成）はQEMUが応答しないとブロックするためexecutorで開く
+        await self._run_blocking(self._connect_input)
+        logger.info(f"✓ VM {self.vm_id} on worker {self.worker.index}: {self.width}x{self.height} "
+                    f"({len(self.consoles)} consoles)")
+        return True
+
+    def _connect_input(self):
+        try:
+            self.bus = AddressedMessageBus(self.bus_address) if self.bus_address else SessionMessageBus()
+            self._init_input_proxies()
+        except Exception as e:
+            logger.error(f"VM {self.vm_id}: input connection failed: {e}")
+
+    def start_glib_loop(self):
+        """GLibメインループはワーカーが動かす"""
+
+    async def setup_listener(self) -> bool:
+        """Listenerはconnect()でワーカーが登録済み"""
+        return self.worker is not None and bool(self.consoles)
+
+    def update_consoles(self, infos: list):
+        for info in infos:
+            console = self.consoles.get(info["id"])
+            if console is not None:
+                console.update(info)
+
+    def consoles_info(self) -> list:
+        return [
+            {**console.describe(), "primary": console is self.primary, **console.stats()}
+            for console in self.consoles.values()
+        ]
+
+    def worker_lost(self):
+        """割り当て先のワーカーが終了した"""
+        logger.error(f"VM {self.vm_id}: worker {self.worker.index if self.worker else '?'} exited")
+        self.worker = None
+        if self.on_lost is not None:
+            self.on_lost()
+        elif self._reattach_task is None or self._reattach_task.done():
+            self._reattach_task = asyncio.ensure_future(self.reattach())
+
+    async def reattach(self) -> bool:
+        """
+        ワーカーが終了したVMを再起動したワーカーに接続し直す（成功するかdisconnect()まで再試行）
+
+        Returns:
+            接続できた場合True
+        """
+        # 入力用の接続は開き直す（コンソールはワーカーから届いた一覧で作り直す）
+        super().disconnect()
+        while not self._closed:
+            if await self.connect():
+                logger.info(f"VM {self.vm_id} re-attached to worker {self.worker.index}")
+                return True
+            logger.warning(f"VM {self.vm_id}: re-attach failed, retrying in {REATTACH_RETRY}s")
+            await asyncio.sleep(REATTACH_RETRY)
+        return False
+
+    def disconnect(self):
+        self._closed = True
+        if self._reattach_task is not None:
+            self._reattach_task.cancel()
+            self._reattach_task = None
+        if self.worker is not None:
+            self.worker.detach(self)
+            self.worker = None
+        super().disconnect()
+
+
+class WorkerHandle:
+    """1つのワーカープロセスとの制御パイプ・リング"""
+
+    def __init__(self, index: int, ring_capacity: int, on_exit: Callable[["WorkerHandle"], None]):
+        self.index = index
+        self.ring = ShmRing(capacity=ring_capacity)
+        context = multiprocessing.get_context("spawn")
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=run_worker, args=(index, child_conn, self.ring.name),
+            name=f"qemu-webrtc-worker{index}", daemon=True,
+        )
+        self._child_conn = child_conn
+        self._on_exit_callback = on_exit
+        self.displays = {}  # vm_id -> RemoteDisplay
+        self.streams = {}  # stream_id -> RemoteVideoTrack
+        self._attaching = {}  # vm_id -> Future
+        self._pulls = {}  # stream_id -> Future
+        self.alive = False
+        self.started_at = None
+        self.frames = 0
+        self.ring_stats = {}  # ワーカー側（書き込み側）のShmRing.stats()
+        self.metrics = {}  # ワーカーのmetrics.REGISTRY.snapshot()
+
+    def start(self):
+        self.process.start()
+        self._child_conn.close()
+        self.alive = True
+        self.started_at = time.monotonic()
+        loop = asyncio.get_running_loop()
+        loop.add_reader(self.conn.fileno(), self._on_readable)
+        loop.add_reader(self.process.sentinel, self._on_exit)
+        logger.info(f"Worker {self.index} started (pid {self.process.pid}, ring {self.ring.capacity // 1024}KB)")
+
+    def send(self, message: tuple):
+        if not self.alive:
+            return
+        try:
+            self.conn.send(message)
+        except (BrokenPipeError, OSError) as e:
+            logger.error(f"Worker {self.index}: send failed: {e}")
+
+    async def attach(self, display: RemoteDisplay):
+        """VMをワーカーに接続させる"""
+        future = asyncio.get_running_loop().create_future()
+        self._attaching[display.vm_id] = future
+        self.displays[display.vm_id] = display
+        self.send(("attach", display.vm_id, display.bus_address))
+        return await future
+
+    def detach(self, display: RemoteDisplay):
+        if self.displays.get(display.vm_id) is display:
+            del self.displays[display.vm_id]
+            self.send(("detach", display.vm_id))
+
+    def open_stream(self, track: RemoteVideoTrack, mime_type: str) -> int:
+        stream_id = next(_stream_ids)
+        self.streams[stream_id] = track
+        console = track.console
+        self.send(("open", stream_id, console.display.vm_id, console.console_id, mime_type, track.fps))
+        return stream_id
+
+    def close_stream(self, stream_id: int):
+        if self.streams.pop(stream_id, None) is not None:
+            self.send(("close", stream_id))
+        future = self._pulls.pop(stream_id, None)
+        if future is not None and not future.done():
+            future.set_exception(MediaStreamError())
+
+    def pull(self, stream_id: int, keyframe: bool, settings: Optional[dict]) -> asyncio.Future:
+        """1フレームを要求（(timestamp, payloads, meta)、リングに書けなかった場合はNone）"""
+        future = asyncio.get_running_loop().create_future()
+        if not self.alive or stream_id not in self.streams:
+            future.set_exception(MediaStreamError())
+            return future
+        self._pulls[stream_id] = future
+        self.send(("pull", stream_id, keyframe, settings))
+        return future
+
+    def _on_readable(self):
+        try:
+            while self.conn.poll():
+                self._handle(self.conn.recv())
+        except (EOFError, OSError):
+            # 終了はsentinelで処理する
+            asyncio.get_running_loop().remove_reader(self.conn.fileno())
+
+    def _handle(self, message: tuple):
+        kind = message[0]
+        if kind == "frame":
+            _, stream_id, meta = message
+            record = None
+            if meta is not None:
+                # リングのレコードは通知と同じ順に並んでいる
+                record_stream, timestamp, payloads = self.ring.read_next()
+                if record_stream != stream_id:
+                    logger.error(f"Worker {self.index}: ring out of sync "
+                                 f"(stream {record_stream}, expected {stream_id})")
+                record = (timestamp, payloads, meta)
+                self.frames += 1
+            future = self._pulls.pop(stream_id, None)
+            if future is not None and not future.done():
+                future.set_result(record)
+        elif kind == "ring":
+            self.ring_stats = message[1]
+        elif kind == "metrics":
+            self.metrics = message[1]
+        elif kind == "trace":
+            tracing.TRACER.extend(message[1])
+        elif kind == "consoles":
+            display = self.displays.get(message[1])
+            if display is not None:
+                display.update_consoles(message[2])
+        elif kind == "attached":
+            _, vm_id, consoles, error = message
+            future = self._attaching.pop(vm_id, None)
+            if future is not None and not future.done():
+                future.set_result((consoles, error))
+        elif kind == "closed":
+            _, stream_id, reason = message
+            logger.warning(f"Worker {self.index}: stream {stream_id} closed: {reason}")
+            track = self.streams.pop(stream_id, None)
+            future = self._pulls.pop(stream_id, None)
+            if future is not None and not future.done():
+                future.set_exception(MediaStreamError())
+            if track is not None:
+                track.stop()
+
+    def _on_exit(self):
+        loop = asyncio.get_running_loop()
+        loop.remove_reader(self.process.sentinel)
+        loop.remove_reader(self.conn.fileno())
+        self.alive = False
+        self.process.join(timeout=1)
+        for future in self._pulls.values():
+            if not future.done():
+                future.set_exception(MediaStreamError())
+        for future in self._attaching.values():
+            if not future.done():
+                future.set_result((None, "worker exited"))
+        self._pulls.clear()
+        self._attaching.clear()
+        self._on_exit_callback(self)
+
+    def request_stop(self):
+        """ワーカーに終了を要求（asyncioループ上で呼ぶ）"""
+        if self.alive:
+            self.send(("stop",))
+            self.alive = False
+            loop = asyncio.get_running_loop()
+            loop.remove_reader(self.process.sentinel)
+            loop.remove_reader(self.conn.fileno())
+
+    def join(self, timeout: float = 5.0):
+        """終了を待つ（応答しなければ強制終了）。ブロックするためexecutorで呼ぶ"""
+        self.process.join(timeout=timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(timeout=1)
+        self.conn.close()
+        self.ring.close()
+
+    def stats(self) -> dict:
+        return {
+            "index": self.index,
+            "pid": self.process.pid,
+            "alive": self.alive,
+            "uptimeSec": round(time.monotonic() - self.started_at, 1) if self.started_at else None,
+            "vms": sorted(self.displays),
+            "streams": len(self.streams),
+            "frames": self.frames,
+            "ring": {
+                **self.ring.stats(),
+                **{key: self.ring_stats[key] for key in ("written", "dropped", "maxUsed") if key in self.ring_stats},
+            },
+        }
+
+
+# ストリームIDは全ワーカーで一意（ログで追いやすいように）
+_stream_ids = itertools.count(1)
+
+
+class WorkerSupervisor:
+    """ワーカープロセスの起動・VMの割り当て・再起動"""
+
+    def __init__(self, count: int):
+        """
+        Args:
+            count: ワーカープロセス数
+        """
+        self.count = max(1, count)
+        self.ring_capacity = int(float(os.environ.get("QEMU_WEBRTC_SHM_RING_MB", "8")) * 1024 * 1024)
+        self.workers: List[WorkerHandle] = []
+        self.restarts = 0
+        self._closing = False
+        logger.info(f"WorkerSupervisor initialized: {self.count} workers")
+
+    def start(self):
+        """ワーカーを起動（asyncioループ上で呼ぶ）"""
+        for index in range(self.count):
+            worker = WorkerHandle(index, self.ring_capacity, self._on_worker_exit)
+            self.workers.append(worker)
+            worker.start()
+
+    def assign(self, display: RemoteDisplay) -> WorkerHandle:
+        """割り当てVM数が最も少ないワーカーを選ぶ"""
+        alive = [worker for worker in self.workers if worker.alive] or self.workers
+        return min(alive, key=lambda worker: (len(worker.displays), worker.index))
+
+    def _on_worker_exit(self, worker: WorkerHandle):
+        if self._closing:
+            return
+        logger.error(f"Worker {worker.index} exited (code {worker.process.exitcode}), restarting")
+        displays = list(worker.displays.values())
+        worker.displays.clear()
+        for track in list(worker.streams.values()):
+            track.stop()
+        worker.conn.close()
+        worker.ring.close()
+
+        replacement = WorkerHandle(worker.index, self.ring_capacity, self._on_worker_exit)
+        self.workers[self.workers.index(worker)] = replacement
+        replacement.start()
+        self.restarts += 1
+        for display in displays:
+            display.worker_lost()
+
+    async def close(self):
+        """全ワーカーを終了"""
+        self._closing = True
+        for worker in self.workers:
+            for track in list(worker.streams.values()):
+                track.stop()
+            worker.request_stop()
+        await asyncio.gather(*(
+            asyncio.get_running_loop().run_in_executor(None, worker.join) for worker in self.workers
+        ), return_exceptions=True)
+        self.workers.clear()
+
+    def stats(self) -> dict:
+        return {"workers": [worker.stats() for worker in self.workers], "restarts": self.restarts}
+
+    def metric_samples(self):
+        """/metrics用: ワーカーごとのリングの未読バイト数"""
+        for worker in self.workers:
+            yield "qemu_webrtc_shm_ring_used_bytes", {"worker": worker.index}, worker.ring.used()
+
+    def metric_snapshots(self):
+        """/metrics用: ワーカーから届いたヒストグラム・カウンター"""
+        for worker in self.workers:
+            if worker.metrics:
+                yield {"worker": str(worker.index)}, worker.metrics
+
+    async def handle_workers(self, request: web.Request) -> web.Response:
+        """
+        ワーカーごとの割り当てVM・ストリーム数・リング使用量
+
+        Returns:
+            {"workers": [...], "restarts": int}
+        """
+        return web.json_response(self.stats())
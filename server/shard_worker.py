@@ -0,0 +1,286 @@
+"""
+Shard Worker Process
+
+WorkerSupervisorが起動するワーカープロセス本体
+
+割り当てられたVMのキャプチャ（D-Bus Listener・DMA-BUF描画・画素変換）と
+エンコードをこのプロセスで行い、RTPペイロードの列をShmRingに書き込む。
+配信プロセスとはmultiprocessingのPipeでタプルをやり取りする。
+
+配信プロセス → ワーカー:
+    ("attach", vm_id, bus_address)      VMに接続してListenerを登録
+    ("detach", vm_id)
+    ("open", stream_id, vm_id, console_id, mime_type, fps)
+    ("pull", stream_id, keyframe, settings)   1フレームをエンコードしてリングへ
+    ("close", stream_id)
+    ("ui_info", vm_id, console_id, width, height, dpr)
+    ("stop",)
+ワーカー → 配信プロセス:
+    ("attached", vm_id, consoles, error)  consolesはconsoles_info()
+    ("frame", stream_id, meta)            リングに1レコード書いた（metaがNoneなら書けなかった）
+    ("closed", stream_id, reason)         ストリームを開けなかった
+    ("consoles", vm_id, consoles)         解像度・統計の定期通知
+    ("ring", stats)                       書き込み側のリング統計の定期通知
+    ("metrics", snapshot)                 段階別ヒストグラム・カウンターの定期通知
+    ("trace", events)                     前回以降に記録したトレース区間（QEMU_WEBRTC_TRACE=1 の場合）
+
+aiortcのRTCRtpSenderと同じく配信側がフレームを要求した分だけエンコードするため、
+再接続待ちのセッションや詰まった接続のためにエンコードし続けることはない。
+"""
+
+import asyncio
+import logging
+import os
+import signal
+import time
+from typing import Optional
+
+from aiortc.rtcrtpparameters import RTCRtpCodecParameters
+
+from dbus.display_capture import DisplayCapture
+from dbus.dmabuf_gl import get_renderer
+from dbus.glib_asyncio import GLibAsyncioIntegration
+from telemetry import metrics, tracing
+from .encoder_profiles import create_encoder, load_encoder_profile, load_codec_preference
+from .shm_ring import ShmRing
+from .snapshot import SnapshotCache
+from .video_track import QEMUVideoTrack
+from .warmup import warm_egl, warm_encoder
+
+logger = logging.getLogger(__name__)
+
+# コンソールの解像度・統計を配信プロセスへ送る間隔（秒）
+REPORT_INTERVAL = 1.0
+
+
+class WorkerStream:
+    """1セッション分のトラックとエンコーダ（ワーカー側）"""
+
+    def __init__(self, stream_id: int, console, snapshots, mime_type: str, fps: int, profile):
+        self.stream_id = stream_id
+        self.console = console
+        self.track = QEMUVideoTrack(console, fps=fps, snapshots=snapshots)
+        self.encoder = create_encoder(
+            RTCRtpCodecParameters(mimeType=mime_type, clockRate=90000, payloadType=96), profile
+        )
+        self.busy = False
+
+    def apply(self, settings: dict):
+        """配信プロセスの適応制御・ビューポートの変更を反映"""
+        if "fps" in settings or "scale" in settings:
+            self.track.set_quality(fps=settings.get("fps"), scale=settings.get("scale"))
+        if "viewport" in settings:
+            self.track.set_viewport(*settings["viewport"])
+        if "bitrate" in settings and hasattr(self.encoder, "target_bitrate"):
+            self.encoder.target_bitrate = settings["bitrate"]
+
+    def meta(self) -> dict:
+        """配信プロセスの/sessions用の値"""
+        track = self.track
+        return {
+            "frames": track.frame_count,
+            "source": track.first_frame_source,
+            "resizeLatencyMs": track.last_resize_latency_ms,
+            "width": self.console.width,
+            "height": self.console.height,
+        }
+
+
+class ShardWorker:
+    """ワーカープロセス内のVM群とストリーム"""
+
+    def __init__(self, index: int, conn, ring_name: str):
+        self.index = index
+        self.conn = conn
+        self.ring = ShmRing(ring_name)
+        self.profile = load_encoder_profile()
+        tracing.TRACER.process_name = f"worker {index}"
+        self.glib_integration = GLibAsyncioIntegration()
+        self.vms = {}  # vm_id -> DisplayCapture
+        self.snapshots = {}  # (vm_id, console_id) -> SnapshotCache
+        self.streams = {}  # stream_id -> WorkerStream
+        self._tasks = {}  # vm_id -> スナップショット更新タスクのリスト
+        self._stopped = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        # 複数VM・コンソールのディスパッチスレッドが1つのEGLコンテキストを使う
+        get_renderer().shared = True
+        self.glib_integration.start()
+        loop.add_reader(self.conn.fileno(), self._on_readable)
+        await asyncio.gather(
+            loop.run_in_executor(None, warm_egl),
+            loop.run_in_executor(None, warm_encoder, self.profile,
+                                 [load_codec_preference() or "video/VP8"]),
+            return_exceptions=True,
+        )
+        logger.info(f"Worker {self.index} ready (pid {os.getpid()})")
+        reporter = asyncio.ensure_future(self._report())
+        try:
+            await self._stopped.wait()
+        finally:
+            reporter.cancel()
+            loop.remove_reader(self.conn.fileno())
+            for vm_id in list(self.vms):
+                self.detach(vm_id)
+            self.glib_integration.stop()
+            self.ring.close()
+
+    def _send(self, message: tuple):
+        try:
+            self.conn.send(message)
+        except (BrokenPipeError, OSError):
+            # 配信プロセスが終了した
+            self._stopped.set()
+
+    def _on_readable(self):
+        try:
+            while self.conn.poll():
+                self._handle(self.conn.recv())
+        except (EOFError, OSError):
+            self._stopped.set()
+
+    def _handle(self, message: tuple):
+        kind = message[0]
+        if kind == "pull":
+            stream = self.streams.get(message[1])
+            if stream is not None and not stream.busy:
+                stream.busy = True
+                asyncio.ensure_future(self._encode(stream, message[2], message[3]))
+        elif kind == "attach":
+            asyncio.ensure_future(self.attach(message[1], message[2]))
+        elif kind == "open":
+            self.open(*message[1:])
+        elif kind == "close":
+            stream = self.streams.pop(message[1], None)
+            if stream is not None:
+                stream.track.stop()
+        elif kind == "ui_info":
+            _, vm_id, console_id, width, height, dpr = message
+            capture = self.vms.get(vm_id)
+            if capture is not None and console_id in capture.consoles:
+                capture.consoles[console_id].request_ui_info(width, height, dpr)
+        elif kind == "detach":
+            self.detach(message[1])
+        elif kind == "stop":
+            self._stopped.set()
+        else:
+            logger.warning(f"Worker {self.index}: unknown message {kind}")
+
+    async def attach(self, vm_id: str, bus_address: Optional[str]):
+        """VMに接続してListenerを登録（入力は配信プロセスが直接送る）"""
+        capture = DisplayCapture(bus_address, glib_integration=self.glib_integration)
+        capture.async_input = False
+        error = None
+        try:
+            if not await capture.connect():
+                error = "failed to connect to QEMU D-Bus"
+            elif not await capture.setup_listener():
+                error = "failed to setup DisplayListener"
+        except Exception as e:
+            error = str(e)
+        if error is not None:
+            capture.disconnect()
+            self._send(("attached", vm_id, None, error))
+            return
+
+        self.vms[vm_id] = capture
+        tasks = []
+        for console_id, console in capture.consoles.items():
+            cache = SnapshotCache(console)
+            self.snapshots[(vm_id, console_id)] = cache
+            tasks.append(asyncio.ensure_future(
+                cache.run(is_idle=lambda console=console: not self._has_streams(console))
+            ))
+        self._tasks[vm_id] = tasks
+        logger.info(f"Worker {self.index}: VM {vm_id} attached "
+                    f"({len(capture.consoles)} consoles)")
+        self._send(("attached", vm_id, capture.consoles_info(), None))
+
+    def detach(self, vm_id: str):
+        capture = self.vms.pop(vm_id, None)
+        if capture is None:
+            return
+        for stream_id, stream in list(self.streams.items()):
+            if stream.console in capture.consoles.values():
+                stream.track.stop()
+                del self.streams[stream_id]
+        for task in self._tasks.pop(vm_id, []):
+            task.cancel()
+        for console_id in capture.consoles:
+            self.snapshots.pop((vm_id, console_id), None)
+        capture.disconnect()
+        logger.info(f"Worker {self.index}: VM {vm_id} detached")
+
+    def open(self, stream_id: int, vm_id: str, console_id: int, mime_type: str, fps: int):
+        capture = self.vms.get(vm_id)
+        if capture is None or console_id not in capture.consoles:
+            logger.warning(f"Worker {self.index}: stream {stream_id} for unknown console {vm_id}/{console_id}")
+            self._send(("closed", stream_id, "unknown console"))
+            return
+        self.streams[stream_id] = WorkerStream(
+            stream_id, capture.consoles[console_id], self.snapshots.get((vm_id, console_id)),
+            mime_type, fps, self.profile,
+        )
+
+    def _has_streams(self, console) -> bool:
+        return any(stream.console is console for stream in self.streams.values())
+
+    async def _encode(self, stream: WorkerStream, keyframe: bool, settings: Optional[dict]):
+        """1フレームを取得・エンコードしてリングに書き込む"""
+        meta = None
+        try:
+            if settings:
+                stream.apply(settings)
+            frame = await stream.track.recv()
+            payloads, timestamp = await asyncio.get_running_loop().run_in_executor(
+                None, stream.encoder.encode, frame, keyframe
+            )
+            started = time.perf_counter()
+            written = self.ring.write(stream.stream_id, timestamp, payloads)
+            tracing.TRACER.span("ring_write", started, stream=stream.stream_id, written=written)
+            if written:
+                meta = stream.meta()
+            else:
+                metrics.DROPPED_RING_FULL.inc()
+                logger.warning(f"Worker {self.index}: ring full, dropped frame of stream {stream.stream_id}")
+        except Exception as e:
+            logger.error(f"Worker {self.index}: stream {stream.stream_id} encode error: {e}")
+        finally:
+            stream.busy = False
+        # 閉じたストリームでもリングに書いたレコードは配信プロセスが読み飛ばす必要がある
+        self._send(("frame", stream.stream_id, meta))
+
+    async def _report(self):
+        try:
+            while True:
+                await asyncio.sleep(REPORT_INTERVAL)
+                for vm_id, capture in self.vms.items():
+                    self._send(("consoles", vm_id, capture.consoles_info()))
+                self._send(("ring", self.ring.stats()))
+                self._send(("metrics", metrics.REGISTRY.snapshot()))
+                if tracing.TRACER.enabled:
+                    self._send(("trace", tracing.TRACER.drain()))
+        except asyncio.CancelledError:
+            pass
+
+
+def run_worker(index: int, conn, ring_name: str):
+    """multiprocessingのエントリポイント（spawnで起動）"""
+    logging.basicConfig(
+        level=logging.WARNING,
+        format=f'%(asctime)s - worker{index} - %(name)s - %(levelname)s - %(message)s'
+    )
+    logging.getLogger('aiortc').setLevel(logging.WARNING)
+    logging.getLogger('dbus.listener').setLevel(logging.WARNING)
+    logging.getLogger('dbus.dmabuf_gl').setLevel(logging.WARNING)
+    # Ctrl+Cは配信プロセスが受け、"stop"で終了させる
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    started = time.monotonic()
+    worker = ShardWorker(index, conn, ring_name)
+    try:
+        asyncio.run(worker.run())
+    except KeyboardInterrupt:
+        pass
+    logger.info(f"Worker {index} exited after {time.monotonic() - started:.0f}s")
@@ -0,0 +1,176 @@
+"""
+Shared Memory Ring
+
+ワーカープロセスから配信プロセスへエンコード済みフレームを渡す
+単一プロデューサー・単一コンシューマーのリングバッファ
+
+multiprocessing.shared_memoryの上に可変長レコードを書き込み、
+書き込み位置・読み出し位置（どちらも単調増加のバイト数）をヘッダーに置く。
+ペイロードはpickleもパイプも通らず、コピーは書き込み時と読み出し時の1回ずつ。
+到着の通知はワーカーとの制御パイプで行う（リングは待ち合わせを持たない）。
+
+レコード:
+    [size u32][stream_id u32][timestamp u32][count u32][長さ u32 × count][ペイロード...]
+    sizeは8バイト境界に揃えた全長。末尾に収まらない場合はPADを書いて先頭から書く。
+"""
+
+import logging
+import struct
+from multiprocessing import shared_memory
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# ヘッダー: 書き込み位置, 読み出し位置（u64、リング先頭からの累積バイト数）
+HEADER = struct.Struct("<QQ")
+WRITE_OFFSET = 0
+READ_OFFSET = 8
+DATA_OFFSET = 64  # 書き込み位置と読み出し位置を別のキャッシュラインに置かない程度の余白
+
+RECORD = struct.Struct("<IIII")
+LENGTH = struct.Struct("<I")
+PAD = 0xFFFFFFFF  # 末尾の余りを飛ばす印
+ALIGN = 8
+
+
+def _align(n: int) -> int:
+    return (n + ALIGN - 1) & ~(ALIGN - 1)
+
+
+class ShmRing:
+    """
+    エンコード済みフレーム（RTPペイロードの列）のリングバッファ
+
+    書き込みはワーカープロセスの1スレッド、読み出しは配信プロセスのasyncioループのみ。
+    位置はレコード本体を書き終えてから進めるため、読み出し側が書き込み途中の
+    レコードを見ることはない（x86のストア順序を前提にしている）。
+    """
+
+    def __init__(self, name: Optional[str] = None, capacity: int = 8 * 1024 * 1024):
+        """
+        Args:
+            name: 既存のリングに接続する場合の共有メモリ名（Noneで新規作成）
+            capacity: 新規作成時のデータ領域のサイズ（バイト、8の倍数に切り上げ）
+        """
+        if name is None:
+            capacity = _align(capacity)
+            self.shm = shared_memory.SharedMemory(create=True, size=DATA_OFFSET + capacity)
+            self.owner = True
+            HEADER.pack_into(self.shm.buf, 0, 0, 0)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.name = self.shm.name
+        self.capacity = (self.shm.size - DATA_OFFSET) & ~(ALIGN - 1)
+        self.buf = self.shm.buf
+
+        # 統計
+        self.written = 0
+        self.dropped = 0
+        self.read = 0
+        self.max_used = 0
+
+    def _positions(self) -> Tuple[int, int]:
+        return HEADER.unpack_from(self.buf, 0)
+
+    def used(self) -> int:
+        """未読のバイト数"""
+        write_pos, read_pos = self._positions()
+        return write_pos - read_pos
+
+    def write(self, stream_id: int, timestamp: int, payloads: List[bytes]) -> bool:
+        """
+        レコードを書き込む（ワーカープロセス側）
+
+        Returns:
+            空きがなく書き込めなかった場合False（読み出し側が止まっている）
+        """
+        header_size = RECORD.size + LENGTH.size * len(payloads)
+        size = _align(header_size + sum(len(p) for p in payloads))
+        write_pos, read_pos = self._positions()
+        offset = write_pos % self.capacity
+        tail = self.capacity - offset
+        # 末尾に収まらなければ残りを飛ばして先頭から
+        skip = tail if tail < size else 0
+        if size + skip > self.capacity - (write_pos - read_pos):
+            self.dropped += 1
+            return False
+
+        buf = self.buf
+        if skip:
+            LENGTH.pack_into(buf, DATA_OFFSET + offset, PAD)
+            offset = 0
+        base = DATA_OFFSET + offset
+        RECORD.pack_into(buf, base, size, stream_id, timestamp & 0xFFFFFFFF, len(payloads))
+        pos = base + RECORD.size
+        for payload in payloads:
+            LENGTH.pack_into(buf, pos, len(payload))
+            pos += LENGTH.size
+        for payload in payloads:
+            buf[pos:pos + len(payload)] = payload
+            pos += len(payload)
+
+        # 本体を書き終えてから書き込み位置を進める
+        write_pos += skip + size
+        struct.pack_into("<Q", buf, WRITE_OFFSET, write_pos)
+        self.written += 1
+        self.max_used = max(self.max_used, write_pos - read_pos)
+        return True
+
+    def read_next(self) -> Optional[Tuple[int, int, List[bytes]]]:
+        """
+        次のレコードを読み出す（配信プロセス側）
+
+        Returns:
+            (stream_id, timestamp, payloads)、未読のレコードがなければNone
+        """
+        write_pos, read_pos = self._positions()
+        if read_pos == write_pos:
+            return None
+        buf = self.buf
+        offset = read_pos % self.capacity
+        tail = self.capacity - offset
+        if tail < RECORD.size or LENGTH.unpack_from(buf, DATA_OFFSET + offset)[0] == PAD:
+            read_pos += tail
+            offset = 0
+
+        base = DATA_OFFSET + offset
+        size, stream_id, timestamp, count = RECORD.unpack_from(buf, base)
+        pos = base + RECORD.size
+        lengths = struct.unpack_from(f"<{count}I", buf, pos)
+        pos += LENGTH.size * count
+        payloads = []
+        for length in lengths:
+            payloads.append(bytes(buf[pos:pos + length]))
+            pos += length
+
+        # コピーし終えてから読み出し位置を進める（書き込み側が再利用できる）
+        struct.pack_into("<Q", buf, READ_OFFSET, read_pos + size)
+        self.read += 1
+        return stream_id, timestamp, payloads
+
+    def stats(self) -> dict:
+        """使用量と書き込み失敗数"""
+        return {
+            "name": self.name,
+            "capacity": self.capacity,
+            "used": self.used(),
+            "maxUsed": self.max_used,
+            "written": self.written,
+            "read": self.read,
+            "dropped": self.dropped,
+        }
+
+    def close(self):
+        """共有メモリを閉じる（作成した側は削除も行う）"""
+        self.buf = None
+        try:
+            self.shm.close()
+        except BufferError:
+            # 読み出し中のmemoryviewが残っている場合（プロセス終了時に解放される）
+            pass
+        if self.owner:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
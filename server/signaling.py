@@ -2,59 +2,171 @@
 WebRTC Signaling Server
 
 SDP offer/answerとICE candidateの交換を処理
+
+接続が切れたセッションはQEMU_WEBRTC_RESUME_GRACE秒の間トラック・エンコーダ・
+適応制御の状態を保持し、Answerで渡した再接続トークン付きのOfferが来れば
+新しいRTCPeerConnectionに付け替える（aiortcはICE restart未対応のため、
+再接続はOffer/Answerの1往復で行う）。
+
+POST /offer は1往復でOffer/Answerを交換する。WebSocketの /ws では
+クライアントのICE candidateを逐次（trickle）受け取り、Answer送信後に届いた
+candidateも接続確認に加える。サーバー側のcandidateはaiortcが
+setLocalDescription内で収集を終えるため、Answerにすべて含まれる。
+
+マルチヘッドのゲストではOfferの"console"でコンソールIDを選ぶ（省略時はプライマリ）。
+スナップショットはコンソールごとに持つ。
+ワーカープロセスで配信するコンソール（shard.py）では、トラックとエンコーダを
+ワーカーの代理（RemoteVideoTrack / RemoteEncoder）に置き換える。
 """
 
+import asyncio
 import json
 import logging
+import os
+import secrets
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Optional
 from aiohttp import web
 from aiortc import RTCPeerConnection, RTCSessionDescription, RTCConfiguration, RTCIceServer
 from aiortc.contrib.media import MediaBlackhole
+from aiortc.sdp import candidate_from_sdp
 
-from .video_track import QEMUVideoTrack, MockVideoTrack
+from .video_track import QEMUVideoTrack, MockVideoTrack, ConnectionTrack
+from .rate_control import AdaptationController, get_sender_encoder
+from .snapshot import SnapshotCache
+from .latency import LatencyTracker
+from .pc_pool import CertificatePool, PeerConnectionPool
+from .ice_config import install_ice_gathering, policy_from_payload, gathering_stats
+from .encoder_profiles import (
+    load_encoder_profile, load_codec_preference, install_encoder_profile, apply_codec_preference,
+)
 
 logger = logging.getLogger(__name__)
 
 
+def build_rtc_configuration(payload: dict) -> Optional[RTCConfiguration]:
+    """環境変数由来のWebRTC設定をaiortc向けに変換（ホスト候補の収集方針もここで適用）"""
+    install_ice_gathering(policy_from_payload(payload.get("iceGathering", {})))
+
+    ice_servers = []
+    for server in payload.get("iceServers", []):
+        if not isinstance(server, dict):
+            continue
+        urls = server.get("urls")
+        if isinstance(urls, str):
+            urls = [urls]
+        if not isinstance(urls, list) or not urls:
+            continue
+        if not all(isinstance(url, str) and url for url in urls):
+            continue
+        ice_servers.append(
+            RTCIceServer(
+                urls=urls,
+                username=server.get("username"),
+                credential=server.get("credential"),
+            )
+        )
+
+    if not ice_servers:
+        return None
+    return RTCConfiguration(iceServers=ice_servers)
+
+
+@dataclass
+class PeerSession:
+    """1クライアント分の配信セッション"""
+    session_id: str
+    pc: RTCPeerConnection
+    track: QEMUVideoTrack
+    sender: object
+    console: object = None  # 配信中のConsoleCapture
+    connection_track: Optional[ConnectionTrack] = None  # senderに渡した接続ごとのトラック
+    controller: Optional[AdaptationController] = None
+    latency: Optional[LatencyTracker] = None
+    created_at: float = field(default_factory=time.time)
+    connected_ms: Optional[float] = None  # Offer受信からDTLS接続完了まで
+    signaling: str = "http"  # "http" / "ws"
+    client_connect_ms: Optional[float] = None  # クライアントが計測した接続開始から接続完了まで
+    answer_ms: Optional[float] = None  # Offer受信からAnswer作成まで
+    prewarmed: bool = False  # 事前準備したRTCPeerConnectionを使ったか
+    resume_token: str = field(default_factory=lambda: secrets.token_urlsafe(16))
+    detached_at: Optional[float] = None  # 接続が切れて再接続待ちになった時刻
+    resumes: int = 0  # 再接続した回数
+    codec_mime: Optional[str] = None  # ネゴシエーションしたコーデック
+    encoder: object = None  # 再接続待ちの間保持するエンコーダ
+    expiry: object = None  # 再接続待ちの期限（asyncio.TimerHandle）
+
+    def stats(self) -> dict:
+        """セッションの計測値（/sessions用）"""
+        track = self.track
+        return {
+            "session_id": self.session_id,
+            "console": self.console.console_id if self.console is not None else None,
+            "state": "detached" if self.detached_at is not None else self.pc.connectionState,
+            "resumes": self.resumes,
+            "signaling": self.signaling,
+            "connectedMs": self.connected_ms,
+            "clientConnectMs": self.client_connect_ms,
+            "answerMs": self.answer_ms,
+            "prewarmed": self.prewarmed,
+            **gathering_stats(self.sender.transport.transport.iceGatherer),
+            "timeToFirstFrameMs": track.first_frame_ms,
+            "firstFrameSource": track.first_frame_source,
+            "frames": track.frame_count,
+            "resizeLatencyMs": track.last_resize_latency_ms,
+            "adaptation": self.controller.state() if self.controller is not None else None,
+        }
+
+
 class SignalingServer:
     """WebRTCシグナリングサーバー"""
     
-    def __init__(self, display_capture, webrtc_config_payload=None):
+    def __init__(self, display_capture, webrtc_config_payload=None, certificates=None, pc_pool=None):
         """
         Args:
             display_capture: DisplayCaptureインスタンス
             webrtc_config_payload: /webrtc-configで返す設定ペイロード
+            certificates: 共有するCertificatePool（フリートモード、Noneなら作成してインストール）
+            pc_pool: 共有するPeerConnectionPool（フリートモード、Noneなら作成）
         """
         self.display_capture = display_capture
         self.pcs = set()  # アクティブなRTCPeerConnection
-        self.rtc_configuration = self._build_rtc_configuration(webrtc_config_payload or {})
+        self.sessions = {}  # session_id -> PeerSession
+        # 帯域適応制御（QEMU_WEBRTC_ADAPTIVE=0 で無効化）
+        self.adaptive = os.environ.get("QEMU_WEBRTC_ADAPTIVE", "1") != "0"
+        # エンコーダプロファイルとコーデック優先順位（デプロイ単位の設定）
+        self.encoder_profile = load_encoder_profile()
+        install_encoder_profile(self.encoder_profile)
+        self.codec_mime_type = load_codec_preference()
+        # 表示サイズをSetUIInfoでゲストに通知（QEMU_WEBRTC_GUEST_RESIZE=0 で無効化）
+        self.guest_resize = os.environ.get("QEMU_WEBRTC_GUEST_RESIZE", "1") != "0"
+        self.rtc_configuration = build_rtc_configuration(webrtc_config_payload or {})
+        # DTLS証明書とICE収集済みRTCPeerConnectionの事前準備
+        # （QEMU_WEBRTC_PC_POOL=0 で無効化、補充はmain.pyがstart()で開始）
+        if certificates is None:
+            certificates = CertificatePool(int(os.environ.get("QEMU_WEBRTC_CERT_POOL", "4")))
+            certificates.install()
+        self.certificates = certificates
+        if pc_pool is None:
+            pc_pool = PeerConnectionPool(
+                self.rtc_configuration,
+                size=int(os.environ.get("QEMU_WEBRTC_PC_POOL", "1")),
+                max_age=float(os.environ.get("QEMU_WEBRTC_PC_POOL_MAX_AGE", "30")),
+            )
+        self.pc_pool = pc_pool
+        # 新規視聴者の最初のフレーム用スナップショット（コンソールID -> SnapshotCache）
+        self.snapshots = {}
+        # ウォームスタートの状態（main.pyが設定、準備完了までOfferを受け付けない）
+        self.warmup = None
+        # DataChannel入力の受け先（main.pyが設定）
+        self.input_handler = None
+        # 切断後に再接続を待つ時間（秒、0で切断時に即破棄）
+        self.resume_grace = float(os.environ.get("QEMU_WEBRTC_RESUME_GRACE", "30"))
         
         logger.info("SignalingServer initialized")
 
-    def _build_rtc_configuration(self, payload):
-        """環境変数由来のWebRTC設定をaiortc向けに変換"""
-        ice_servers = []
-        for server in payload.get("iceServers", []):
-            if not isinstance(server, dict):
-                continue
-            urls = server.get("urls")
-            if isinstance(urls, str):
-                urls = [urls]
-            if not isinstance(urls, list) or not urls:
-                continue
-            if not all(isinstance(url, str) and url for url in urls):
-                continue
-            ice_servers.append(
-                RTCIceServer(
-                    urls=urls,
-                    username=server.get("username"),
-                    credential=server.get("credential"),
-                )
-            )
-
-        if not ice_servers:
-            return None
-        return RTCConfiguration(iceServers=ice_servers)
-    
     async def handle_offer(self, request: web.Request) -> web.Response:
         """
         WebRTCクライアントからのOfferを処理
@@ -65,6 +177,9 @@ class SignalingServer:
         Returns:
             SDP answerを含むJSONレスポンス
         """
+        if self.warmup is not None and not self.warmup.ready:
+            return web.json_response({'error': 'server is starting'}, status=503)
+        
         try:
             params = await request.json()
             offer = RTCSessionDescription(
@@ -72,52 +187,494 @@ class SignalingServer:
                 type=params['type']
             )
             
+            console = self._resolve_console(params.get('console'))
+            if console is None:
+                return web.json_response({'error': 'unknown console'}, status=400)
+            
             logger.info(f"Received offer from {request.remote}")
+            session = await self.create_session(offer, resume=params.get('resume'), console=console)
             
-            # RTCPeerConnection作成
-            if self.rtc_configuration is not None:
-                pc = RTCPeerConnection(configuration=self.rtc_configuration)
-            else:
-                pc = RTCPeerConnection()
-            self.pcs.add(pc)
+            return web.json_response({
+                'sdp': session.pc.localDescription.sdp,
+                'type': session.pc.localDescription.type,
+                'session_id': session.session_id,
+                'resume_token': session.resume_token,
+                'resumed': session.resumes > 0 and params.get('resume') is not None,
+            })
             
-            @pc.on("connectionstatechange")
-            async def on_connectionstatechange():
-                logger.info(f"Connection state: {pc.connectionState}")
-                if pc.connectionState in ["failed", "closed"]:
+        except Exception as e:
+            logger.error(f"Error handling offer: {e}")
+            import traceback
+            logger.error(traceback.format_exc())
+            return web.json_response(
+                {'error': str(e)},
+                status=500
+            )
+    
+    async def handle_websocket(self, request: web.Request) -> web.WebSocketResponse:
+        """
+        WebSocketシグナリング（trickle ICE）
+        
+        クライアント→サーバー:
+            {"type": "offer", "sdp": str, "console": int（省略可）,
+             "resume": {"session_id", "token"}（省略可）}
+            {"type": "candidate", "candidate": RTCIceCandidateInit | null}（nullは収集完了）
+        サーバー→クライアント:
+            {"type": "answer", "sdp": str, "session_id": str, "resume_token": str, "resumed": bool}
+            {"type": "error", "error": str}
+        
+        Offerより先に届いたcandidateはなく（クライアントはOffer送信後に送る）、
+        Answer作成中に届いたものはメッセージ順に処理される。
+        """
+        ws = web.WebSocketResponse(heartbeat=30)
+        await ws.prepare(request)
+        
+        if self.warmup is not None and not self.warmup.ready:
+            await ws.send_json({'type': 'error', 'error': 'server is starting'})
+            await ws.close()
+            return ws
+        
+        session = None
+        try:
+            async for message in ws:
+                if message.type != web.WSMsgType.TEXT:
+                    continue
+                data = json.loads(message.data)
+                kind = data.get('type')
+                if kind == 'offer' and session is None:
+                    console = self._resolve_console(data.get('console'))
+                    if console is None:
+                        await ws.send_json({'type': 'error', 'error': 'unknown console'})
+                        continue
+                    logger.info(f"Received offer over WebSocket from {request.remote}")
+                    offer = RTCSessionDescription(sdp=data['sdp'], type='offer')
+                    session = await self.create_session(
+                        offer, signaling="ws", resume=data.get('resume'), console=console
+                    )
+                    await ws.send_json({
+                        'type': 'answer',
+                        'sdp': session.pc.localDescription.sdp,
+                        'session_id': session.session_id,
+                        'resume_token': session.resume_token,
+                        'resumed': session.resumes > 0 and data.get('resume') is not None,
+                    })
+                elif kind == 'candidate' and session is not None:
+                    await session.pc.addIceCandidate(self._parse_candidate(data.get('candidate')))
+                else:
+                    logger.warning(f"Unexpected signaling message: {kind}")
+        except Exception as e:
+            logger.error(f"WebSocket signaling error: {e}")
+            import traceback
+            logger.error(traceback.format_exc())
+            if not ws.closed:
+                await ws.send_json({'type': 'error', 'error': str(e)})
+        
+        return ws
+    
+    def _resolve_console(self, console_id):
+        """OfferのコンソールIDからConsoleCaptureを取得（不正・未配信のIDはNone）"""
+        try:
+            return self.display_capture.console(console_id)
+        except (KeyError, TypeError, ValueError):
+            return None
+    
+    def snapshot_cache(self, console) -> SnapshotCache:
+        """コンソールのスナップショットキャッシュ（なければ作成）"""
+        cache = self.snapshots.get(console.console_id)
+        if cache is None:
+            cache = SnapshotCache(console)
+            self.snapshots[console.console_id] = cache
+        return cache
+    
+    async def run_snapshots(self):
+        """全コンソールのスナップショットをバックグラウンド更新（視聴者がいない間だけ）"""
+        consoles = list(self.display_capture.consoles.values()) or [self.display_capture.primary]
+        # ワーカープロセスで配信するコンソールはワーカーがスナップショットを持つ
+        consoles = [console for console in consoles if not getattr(console, "remote", False)]
+        await asyncio.gather(*(
+            self.snapshot_cache(console).run(
+                is_idle=lambda console=console: not self.has_viewers(console)
+            )
+            for console in consoles
+        ))
+    
+    @staticmethod
+    def _parse_candidate(init: Optional[dict]):
+        """
+        ブラウザのRTCIceCandidateInitをaiortcのRTCIceCandidateに変換
+        
+        Returns:
+            RTCIceCandidate、収集完了（nullまたは空文字列）の場合None
+        """
+        if not init or not init.get('candidate'):
+            return None
+        sdp = init['candidate']
+        if sdp.startswith('candidate:'):
+            sdp = sdp[len('candidate:'):]
+        candidate = candidate_from_sdp(sdp)
+        candidate.sdpMid = init.get('sdpMid')
+        candidate.sdpMLineIndex = init.get('sdpMLineIndex')
+        return candidate
+    
+    async def create_session(self, offer: RTCSessionDescription, signaling: str = "http",
+                             resume: Optional[dict] = None, console=None) -> PeerSession:
+        """
+        Offerからセッションを作成し、Answerをローカル記述に設定する
+        
+        Args:
+            offer: クライアントのOffer
+            signaling: シグナリング経路（"http" / "ws"、計測用）
+            resume: 再接続トークン {"session_id", "token"}。一致するセッションがあれば
+                    トラック・エンコーダ・適応制御を引き継ぐ（なければ新規作成）
+            console: 配信するConsoleCapture（Noneでプライマリ）
+        
+        Returns:
+            作成したPeerSession（Answerはpc.localDescription）
+        """
+        started = time.time()
+        if console is None:
+            console = self.display_capture.primary
+        resumed = await self._take_resumable(resume, console)
+        
+        # RTCPeerConnection作成（事前準備済みがあればそれを使う）
+        pc = self.pc_pool.take()
+        prewarmed = pc is not None
+        if pc is None:
+            pc = self.pc_pool.create()
+        self.pcs.add(pc)
+        
+        @pc.on("connectionstatechange")
+        async def on_connectionstatechange():
+            logger.info(f"Connection state: {pc.connectionState}")
+            session = self.find_session_by_pc(pc)
+            if pc.connectionState == "connected" and session is not None:
+                session.connected_ms = (time.time() - session.created_at) * 1000
+                logger.info(f"Session {session.session_id[:8]} connected after "
+                            f"{session.connected_ms:.1f}ms")
+            if pc.connectionState in ["failed", "closed"]:
+                if session is not None and self.resume_grace > 0:
+                    await self.detach_session(session)
+                else:
                     await self.cleanup_pc(pc)
+        
+        @pc.on("iceconnectionstatechange")
+        async def on_iceconnectionstatechange():
+            logger.info(f"ICE connection state: {pc.iceConnectionState}")
+        
+        # 入力用DataChannel（クライアントがOffer前に作成）
+        @pc.on("datachannel")
+        def on_datachannel(channel):
+            if self.input_handler is not None and channel.label.startswith("input"):
+                session = self.find_session_by_pc(pc)
+                self.input_handler.attach_datachannel(
+                    channel, latency=session.latency if session is not None else None
+                )
+            else:
+                logger.warning(f"Ignoring DataChannel: {channel.label}")
+        
+        # ビデオトラック追加（10fpsで大幅なパフォーマンス改善）
+        # 事前準備した接続ではICE収集済みのvideoトランシーバーに割り当てられる
+        if resumed is not None:
+            video_track = resumed.track
+        elif getattr(console, "remote", False):
+            # キャプチャ・エンコードはワーカープロセス（スナップショットもワーカー側）
+            video_track = console.create_track(fps=10, start_time=started)
+        else:
+            video_track = QEMUVideoTrack(
+                console, fps=10, start_time=started, snapshots=self.snapshot_cache(console)
+            )
+        connection_track = ConnectionTrack(video_track)
+        sender = pc.addTrack(connection_track)
+        video_track.sender = sender
+        
+        # コーデック優先順位（QEMU_WEBRTC_CODEC）
+        for transceiver in pc.getTransceivers():
+            if transceiver.sender is sender:
+                apply_codec_preference(transceiver, self.codec_mime_type)
+        
+        if resumed is not None:
+            session = resumed
+            session.pc = pc
+            session.sender = sender
+            session.connection_track = connection_track
+            session.created_at = started
+            session.connected_ms = None
+            session.client_connect_ms = None
+            session.signaling = signaling
+            session.prewarmed = prewarmed
+            session.resume_token = secrets.token_urlsafe(16)
+            session.resumes += 1
+            if session.controller is not None:
+                session.controller.rebind(sender)
+            # 新しいデコーダはキーフレームから始める必要がある
+            video_track.request_keyframe()
+        else:
+            session = PeerSession(
+                session_id=uuid.uuid4().hex,
+                pc=pc,
+                track=video_track,
+                sender=sender,
+                console=console,
+                connection_track=connection_track,
+                created_at=started,
+                latency=LatencyTracker(console),
+                signaling=signaling,
+                prewarmed=prewarmed,
+            )
+            video_track.latency = session.latency
             
-            @pc.on("iceconnectionstatechange")
-            async def on_iceconnectionstatechange():
-                logger.info(f"ICE connection state: {pc.iceConnectionState}")
-            
-            # ビデオトラック追加（10fpsで大幅なパフォーマンス改善）
-            import time
-            video_track = QEMUVideoTrack(self.display_capture, fps=10, start_time=time.time())
-            pc.addTrack(video_track)
-            
+            # 帯域適応制御（RTCP RR / REMBからビットレート・fps・スケールを調整）
+            if self.adaptive:
+                session.controller = AdaptationController(
+                    sender, video_track,
+                    min_bitrate=self.encoder_profile.min_bitrate,
+                    max_bitrate=self.encoder_profile.max_bitrate,
+                )
+                session.controller.start()
+        self.sessions[session.session_id] = session
+        
+        try:
             # Offerを設定
             await pc.setRemoteDescription(offer)
             
             # Answer作成
             answer = await pc.createAnswer()
             await pc.setLocalDescription(answer)
+        except Exception:
+            # 不正なOfferなど。登録したセッション・接続を残さない
+            await self.cleanup_pc(pc)
+            raise
+        
+        # 同じコーデックなら以前のエンコーダを引き継ぐ（最初のフレームで生成される前に設定）
+        previous_codec = session.codec_mime
+        session.codec_mime = self._negotiated_codec(pc, sender)
+        if getattr(video_track, "remote", False):
+            # ワーカーがエンコードしたペイロードをそのまま送る
+            sender._RTCRtpSender__encoder = video_track.passthrough_encoder(session.codec_mime)
+            session.encoder = None
+        elif session.encoder is not None:
+            if session.codec_mime == previous_codec and get_sender_encoder(sender) is None:
+                sender._RTCRtpSender__encoder = session.encoder
+            session.encoder = None
+        
+        session.answer_ms = round((time.time() - started) * 1000, 1)
+        logger.info(f"Answer created in {session.answer_ms}ms"
+                    f"{' (pre-warmed)' if prewarmed else ''}"
+                    f"{f' (resumed session {session.session_id[:8]})' if resumed is not None else ''}")
+        return session
+    
+    @staticmethod
+    def _negotiated_codec(pc: RTCPeerConnection, sender) -> Optional[str]:
+        for transceiver in pc.getTransceivers():
+            if transceiver.sender is sender and transceiver._codecs:
+                return transceiver._codecs[0].mimeType
+        return None
+    
+    async def _take_resumable(self, resume: Optional[dict], console) -> Optional[PeerSession]:
+        """
+        再接続トークンに一致するセッションを取り出す（別のコンソールを要求された場合は引き継がない）
+        
+        まだ接続中（サーバー側で切断を検知していない）の場合は、ここで古い接続を切り離す。
+        """
+        if not resume or self.resume_grace <= 0:
+            return None
+        session = self.sessions.get(resume.get('session_id'))
+        token = resume.get('token')
+        if session is None or not isinstance(token, str) \
+                or not secrets.compare_digest(session.resume_token, token):
+            logger.info("Resume token did not match, creating a new session")
+            return None
+        if session.console is not console:
+            logger.info("Resume requested a different console, creating a new session")
+            return None
+        if session.detached_at is None:
+            await self.detach_session(session)
+        if session.expiry is not None:
+            session.expiry.cancel()
+            session.expiry = None
+        logger.info(f"Resuming session {session.session_id[:8]} after "
+                    f"{(time.time() - session.detached_at) * 1000:.0f}ms")
+        session.detached_at = None
+        return session
+    
+    async def detach_session(self, session: PeerSession):
+        """
+        RTCPeerConnectionだけを閉じ、トラック・エンコーダ・適応制御を再接続用に保持する
+        
+        QEMU_WEBRTC_RESUME_GRACE秒以内に再接続がなければ破棄する。
+        """
+        if session.detached_at is not None:
+            return
+        session.detached_at = time.time()
+        pc = session.pc
+        # aiortcは切断時にエンコーダを解放するため、ConnectionTrackが保持した参照を使う
+        session.encoder = get_sender_encoder(session.sender)
+        if session.encoder is None and session.connection_track is not None:
+            session.encoder = session.connection_track.encoder
+        if session.controller is not None:
+            session.controller.stop()
+        self.pcs.discard(pc)
+        await pc.close()
+        
+        session.expiry = asyncio.get_running_loop().call_later(
+            self.resume_grace, lambda: asyncio.ensure_future(self._expire_session(session))
+        )
+        logger.info(f"Session {session.session_id[:8]} detached, "
+                    f"waiting {self.resume_grace:.0f}s for reconnect")
+    
+    async def _expire_session(self, session: PeerSession):
+        """再接続されなかったセッションを破棄"""
+        if session.detached_at is None or self.sessions.get(session.session_id) is not session:
+            return
+        logger.info(f"Session {session.session_id[:8]} expired without reconnect")
+        self._release_session(session)
+    
+    def _release_session(self, session: PeerSession):
+        """セッション削除・適応制御停止・遅延計測の購読解除・トラック停止"""
+        self.sessions.pop(session.session_id, None)
+        if session.expiry is not None:
+            session.expiry.cancel()
+            session.expiry = None
+        if session.controller is not None:
+            session.controller.stop()
+        if session.latency is not None:
+            session.latency.close()
+        session.track.stop()
+    
+    async def handle_client_metrics(self, request: web.Request) -> web.Response:
+        """
+        クライアントが計測した接続時間を受け取る（/sessionsでシグナリング経路ごとに比較）
+        
+        Args:
+            request: session_id, connectMs（接続開始からconnectedまで）を含むPOSTリクエスト
+        """
+        try:
+            data = await request.json()
+            session = self.sessions.get(data.get('session_id'))
+            if session is None:
+                return web.json_response({'error': 'unknown session'}, status=404)
+            session.client_connect_ms = round(float(data['connectMs']), 1)
+            logger.info(f"Session {session.session_id[:8]} client connect time: "
+                        f"{session.client_connect_ms}ms ({session.signaling})")
+            return web.json_response({'status': 'ok'})
+        except Exception as e:
+            logger.error(f"Client metrics error: {e}")
+            return web.json_response({'error': str(e)}, status=500)
+    
+    async def handle_viewport(self, request: web.Request) -> web.Response:
+        """
+        クライアントの表示サイズを受け取り、エンコード解像度の上限にする
+        
+        Args:
+            request: session_id, width, height（CSSピクセル）, dpr を含むPOSTリクエスト
+                     （dprはゲストの解像度要求にも使う）
+        
+        Returns:
+            JSONレスポンス
+        """
+        try:
+            data = await request.json()
+            session = self.sessions.get(data.get('session_id'))
+            if session is None:
+                return web.json_response({'error': 'unknown session'}, status=404)
             
-            logger.info("Answer created and sent")
+            dpr = max(0.5, min(4.0, float(data.get('dpr', 1.0))))
+            width = int(float(data.get('width', 0)) * dpr)
+            height = int(float(data.get('height', 0)) * dpr)
+            if width <= 0 or height <= 0:
+                session.track.set_viewport(None, None)
+            else:
+                session.track.set_viewport(width, height)
+                # ゲスト側で表示サイズに描画させる（変換・エンコード量を元から削減）
+                if self.guest_resize:
+                    session.console.request_ui_info(width, height, dpr)
+            logger.info(f"Viewport [{session.session_id[:8]}]: {width}x{height} (dpr={dpr})")
             
-            return web.json_response({
-                'sdp': pc.localDescription.sdp,
-                'type': pc.localDescription.type
-            })
+            return web.json_response({'status': 'ok'})
             
         except Exception as e:
-            logger.error(f"Error handling offer: {e}")
-            import traceback
-            logger.error(traceback.format_exc())
-            return web.json_response(
-                {'error': str(e)},
-                status=500
-            )
+            logger.error(f"Viewport error: {e}")
+            return web.json_response({'error': str(e)}, status=500)
+    
+    async def handle_sessions(self, request: web.Request) -> web.Response:
+        """
+        セッションごとの接続時間・最初のフレームまでの時間を返す
+        
+        Returns:
+            JSONレスポンス
+        """
+        return web.json_response({
+            'sessions': [session.stats() for session in self.sessions.values()],
+            'snapshot': {str(console_id): cache.stats() for console_id, cache in self.snapshots.items()},
+            'pcPool': self.pc_pool.stats(),
+            'certificatePool': self.certificates.stats(),
+        })
+    
+    async def handle_latency(self, request: web.Request) -> web.Response:
+        """
+        セッションごとの入力→映像送出の遅延（段階別パーセンタイル、ms）
+        
+        networkOneWayMsはRTCP RRのRTTの半分（適応制御が有効な場合のみ）
+        """
+        sessions = []
+        for session in self.sessions.values():
+            rtt = session.controller.rtt if session.controller is not None else None
+            sessions.append({
+                'session_id': session.session_id,
+                'networkOneWayMs': round(rtt * 500, 1) if rtt is not None else None,
+                **session.latency.stats(),
+            })
+        return web.json_response({'sessions': sessions})
+    
+    async def handle_consoles(self, request: web.Request) -> web.Response:
+        """
+        配信中のコンソール一覧（クライアントのコンソール選択用）
+        
+        Returns:
+            {"consoles": [{"id", "label", "head", "type", "width", "height", "primary", "viewers", ...}]}
+        """
+        consoles = []
+        for info in self.display_capture.consoles_info():
+            console = self.display_capture.consoles[info["id"]]
+            viewers = sum(1 for session in self.sessions.values()
+                          if session.console is console and session.detached_at is None)
+            consoles.append({**info, "viewers": viewers})
+        return web.json_response({'consoles': consoles})
+    
+    def metric_samples(self, **labels):
+        """
+        セッションごとの送出fpsとコンソールのディスパッチ待ち（/metricsのコレクター）
+        
+        Args:
+            labels: 全系列に付けるラベル（フリートモードのvmなど）
+        """
+        for session in list(self.sessions.values()):
+            if session.detached_at is not None:
+                continue
+            console_id = session.console.console_id if session.console is not None else None
+            yield ("qemu_webrtc_session_fps",
+                   {**labels, "session": session.session_id, "console": console_id},
+                   session.track.fps_meter.rate())
+        for console_id, console in list(self.display_capture.consoles.items()):
+            yield ("qemu_webrtc_queue_depth", {**labels, "queue": "console_dispatch", "console": console_id},
+                   console.stats().get("backlog"))
+    
+    def has_viewers(self, console=None) -> bool:
+        """
+        接続中（再接続待ちを除く）のセッションがあるか
+        
+        Args:
+            console: 指定した場合はそのConsoleCaptureを見ているセッションのみ数える
+        """
+        return any(session.detached_at is None and (console is None or session.console is console)
+                   for session in self.sessions.values())
+    
+    def find_session_by_pc(self, pc: RTCPeerConnection) -> Optional[PeerSession]:
+        """RTCPeerConnectionに対応するセッションを検索"""
+        for session in self.sessions.values():
+            if session.pc is pc:
+                return session
+        return None
     
     async def cleanup_pc(self, pc: RTCPeerConnection):
         """
@@ -128,6 +685,11 @@ class SignalingServer:
         """
         logger.info("Cleaning up peer connection")
         
+        # セッション削除・適応制御停止
+        session = self.find_session_by_pc(pc)
+        if session is not None:
+            self._release_session(session)
+        
         # トラック停止
         for sender in pc.getSenders():
             if sender.track:
@@ -143,10 +705,14 @@ class SignalingServer:
         """すべての接続をクリーンアップ"""
         logger.info(f"Cleaning up {len(self.pcs)} peer connections")
         
+        # 再接続待ちのセッションを破棄
+        for session in list(self.sessions.values()):
+            if session.detached_at is not None:
+                self._release_session(session)
+        
         # すべてのRTCPeerConnectionをクローズ
         coros = [self.cleanup_pc(pc) for pc in list(self.pcs)]
         if coros:
-            import asyncio
             await asyncio.gather(*coros, return_exceptions=True)
         
         logger.info("All peer connections cleaned up")
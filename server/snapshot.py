@@ -0,0 +1,132 @@
+"""
+Join Snapshot Cache
+
+新規視聴者の最初のフレーム用に、コンソールごとの
+エンコード直前フレーム（スケーリング・yuv420p変換済み）を保持する
+
+配信中のトラックが出力したフレームを共有し、視聴者がいない間は
+バックグラウンドでフル解像度のスナップショットを更新する。
+参加直後の最初のrecv()ではコピー・変換を待たずにこのフレームを返す。
+"""
+
+import asyncio
+import logging
+from typing import Optional
+
+from av import VideoFrame
+
+from .frame_pool import FramePool
+from .scaler import FrameScaler
+
+logger = logging.getLogger(__name__)
+
+
+class SnapshotCache:
+    """
+    1コンソール分のyuv420pスナップショット
+
+    put()されたフレームは他のトラックのエンコーダが読み取り中の場合があるため、
+    get()では複製（yuv420pで1.5バイト/画素）を返す。
+    """
+
+    def __init__(self, display_capture, refresh_interval: float = 1.0):
+        """
+        Args:
+            display_capture: 配信するコンソール（ConsoleCapture、またはプライマリに委譲するDisplayCapture）
+            refresh_interval: 視聴者がいない間の更新間隔（秒）
+        """
+        self.display_capture = display_capture
+        self.refresh_interval = refresh_interval
+        self.frame: Optional[VideoFrame] = None
+        self.seq = -1
+
+        # バックグラウンド更新用（配信中のトラックとは別のバッファ）
+        self.frame_pool = FramePool()
+        self.scaler = FrameScaler()
+        self._source_seq = -1
+
+        # 検証用カウンター
+        self.hits = 0
+        self.misses = 0
+
+    def put(self, seq: int, frame: VideoFrame):
+        """
+        スナップショットを更新（VideoTrackが新しいフレームを出力したとき）
+
+        Args:
+            seq: 元フレームのframe_seq
+            frame: yuv420pフレーム（以後書き換えないこと）
+        """
+        current = self.frame
+        # 同じ元フレームなら大きい方を残す（参加直後のトラックはビューポート未設定のため）
+        if (seq > self.seq or current is None
+                or (seq == self.seq and frame.width * frame.height > current.width * current.height)):
+            self.seq = seq
+            self.frame = frame
+
+    def get(self, seq: int, width: int, height: int) -> Optional[VideoFrame]:
+        """
+        指定した元フレーム・出力サイズに一致するスナップショットの複製を返す
+
+        Args:
+            seq: DisplayCaptureの現在のframe_seq
+            width, height: 出力サイズ
+
+        Returns:
+            yuv420pのVideoFrame、一致しない場合None
+        """
+        frame = self.frame
+        if frame is None or self.seq != seq or (frame.width, frame.height) != (width, height):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return VideoFrame.from_ndarray(frame.to_ndarray(), format="yuv420p")
+
+    def refresh(self) -> bool:
+        """
+        DisplayCaptureの最新フレームからフル解像度のスナップショットを作成
+
+        Returns:
+            更新した場合True
+        """
+        if self.seq == self.display_capture.frame_seq:
+            return False
+        frame, seq = self.display_capture.read_frame_into(self.frame_pool.acquire, self._source_seq)
+        if frame is None:
+            return False
+        self._source_seq = seq
+        self.put(seq, self.scaler.scale(frame, frame.width & ~1, frame.height & ~1))
+        return True
+
+    async def run(self, is_idle=lambda: True):
+        """
+        バックグラウンド更新ループ
+
+        Args:
+            is_idle: 視聴者がいない場合Trueを返す関数（配信中はトラックがput()する）
+        """
+        logger.info("Snapshot cache refresher started")
+        first = True
+        try:
+            while True:
+                if is_idle() and self.refresh():
+                    if first:
+                        logger.info(f"✓ Initial snapshot ready: {self.frame.width}x{self.frame.height}")
+                        first = False
+                await asyncio.sleep(self.refresh_interval)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"Snapshot cache error: {e}")
+            import traceback
+            logger.error(traceback.format_exc())
+
+    def stats(self) -> dict:
+        """ヒット率など（デバッグ用）"""
+        frame = self.frame
+        return {
+            "seq": self.seq,
+            "size": (frame.width, frame.height) if frame is not None else None,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,120 @@
+"""
+Text Typing
+
+文字列をゲストのキーボードレイアウトに合わせたキー押下/解放の列に変換し、
+一定数ずつまとめてQEMUに送る（自動セットアップでの長い文字列入力用）
+
+Shiftは連続するShift文字の間押したままにし、不要になった時点で離す。
+バッチの間に待ち時間を入れ、ゲスト側の入力キューが溢れないようにする。
+ゲストのCapsLock状態は考慮しない。
+"""
+
+import asyncio
+import logging
+import os
+import time
+from typing import Optional
+
+from dbus.keymap import CHAR_LAYOUTS, SHIFT_KEYCODE, char_to_qemu
+
+logger = logging.getLogger(__name__)
+
+
+class TextTyper:
+    """文字列の連続入力（同時に実行される入力は到着順に1件ずつ処理）"""
+
+    def __init__(self, sink):
+        """
+        Args:
+            sink: send_key_press/send_key_releaseを持つ送信先（InputScheduler）
+        """
+        self.sink = sink
+        self.layout = os.environ.get("QEMU_WEBRTC_KEYBOARD_LAYOUT", "us")
+        self.delay_ms = float(os.environ.get("QEMU_WEBRTC_TYPE_DELAY_MS", "2"))
+        self.batch = int(os.environ.get("QEMU_WEBRTC_TYPE_BATCH", "8"))
+        if self.layout not in CHAR_LAYOUTS:
+            logger.warning(f"Unknown keyboard layout {self.layout!r}, using 'us'")
+            self.layout = "us"
+        self._lock = asyncio.Lock()
+
+        # 統計
+        self.typed = 0
+        self.skipped = 0
+        self.last_chars_per_sec: Optional[float] = None
+        logger.info(f"TextTyper initialized: layout={self.layout}, "
+                    f"delay={self.delay_ms}ms, batch={self.batch}")
+
+    async def type_text(self, text: str, layout: Optional[str] = None,
+                        delay_ms: Optional[float] = None, batch: Optional[int] = None) -> dict:
+        """
+        文字列を入力
+
+        Args:
+            text: 入力する文字列（改行はCRLF・LF・CRのいずれも1回のEnter）
+            layout: ゲストのキーボードレイアウト（"us" / "jp"、省略時は既定値）
+            delay_ms: 1文字あたりの間隔（ms）。バッチごとに batch × delay_ms 待つ
+            batch: 待ち時間を入れずに続けて送る文字数
+
+        Returns:
+            {"typed", "skipped", "elapsedMs", "charsPerSec"}
+        """
+        layout = layout or self.layout
+        if layout not in CHAR_LAYOUTS:
+            raise ValueError(f"Unknown keyboard layout: {layout}")
+        delay_ms = self.delay_ms if delay_ms is None else max(0.0, float(delay_ms))
+        batch = self.batch if batch is None else max(1, int(batch))
+        # CRLFの貼り付けで1行ごとにEnterが2回押されないようにする（単独のCRはEnterのまま）
+        text = text.replace("\r\n", "\n")
+
+        async with self._lock:
+            started = time.perf_counter()
+            typed = 0
+            skipped = []
+            shifted = False
+            sink = self.sink
+            try:
+                for i, char in enumerate(text):
+                    entry = char_to_qemu(char, layout)
+                    if entry is None:
+                        skipped.append(char)
+                        continue
+                    keycode, shift = entry
+                    if shift != shifted:
+                        if shift:
+                            sink.send_key_press(SHIFT_KEYCODE)
+                        else:
+                            sink.send_key_release(SHIFT_KEYCODE)
+                        shifted = shift
+                    sink.send_key_press(keycode)
+                    sink.send_key_release(keycode)
+                    typed += 1
+                    if typed % batch == 0 and i + 1 < len(text):
+                        await asyncio.sleep(batch * delay_ms / 1000)
+            finally:
+                # 中断された場合もShiftを押したままにしない
+                if shifted:
+                    sink.send_key_release(SHIFT_KEYCODE)
+
+            elapsed = time.perf_counter() - started
+            self.typed += typed
+            self.skipped += len(skipped)
+            chars_per_sec = round(typed / elapsed, 1) if elapsed > 0 and typed else None
+            self.last_chars_per_sec = chars_per_sec
+            if skipped:
+                logger.warning(f"Typing skipped {len(skipped)} characters not on layout {layout}: "
+                               f"{''.join(sorted(set(skipped)))!r}")
+            logger.info(f"Typed {typed} characters in {elapsed * 1000:.0f}ms ({layout})")
+            return {
+                "typed": typed,
+                "skipped": len(skipped),
+                "elapsedMs": round(elapsed * 1000, 1),
+                "charsPerSec": chars_per_sec,
+            }
+
+    def stats(self) -> dict:
+        return {
+            "typed": self.typed,
+            "skipped": self.skipped,
+            "lastCharsPerSec": self.last_chars_per_sec,
+            "layout": self.layout,
+        }
@@ -11,7 +11,11 @@ import time
 import os
 from typing import Optional
 from av import VideoFrame
-from aiortc import VideoStreamTrack
+from aiortc import MediaStreamTrack, VideoStreamTrack
+
+from telemetry import metrics, tracing
+from .scaler import FrameScaler, fit_size
+from .frame_pool import FramePool
 
 logger = logging.getLogger(__name__)
 
@@ -21,26 +25,60 @@ class QEMUVideoTrack(VideoStreamTrack):
     QEMU DisplayCaptureからWebRTCへのビデオストリーム
     """
     
-    def __init__(self, display_capture, fps: int = 30, start_time: Optional[float] = None):
+    def __init__(self, display_capture, fps: int = 30, start_time: Optional[float] = None,
+                 snapshots=None):
         """
         Args:
-            display_capture: DisplayCaptureインスタンス
+            display_capture: 配信するコンソール（ConsoleCapture、またはプライマリに委譲するDisplayCapture）
             fps: フレームレート（デフォルト30fps）
             start_time: 計測開始時刻（Noneの場合は現在時刻）
+            snapshots: SnapshotCache（参加直後の最初のフレームに使う）
         """
         super().__init__()
         self.display_capture = display_capture
         self.fps = fps
+        self.max_fps = fps
         self.frame_interval = 1.0 / fps
         self.start_time = start_time or time.time()
         self._first_frame_logged = False
+        self._next_frame_time = None
+        
+        # 参加直後の最初のフレーム（time-to-first-frame）
+        self.snapshots = snapshots
+        self.first_frame_ms: Optional[float] = None
+        self.first_frame_source: Optional[str] = None
+        
+        # 入力→画面更新の遅延計測（LatencyTracker、SignalingServerが設定）
+        self.latency = None
+        
+        # 出力スケール（1 = フル解像度, 2 = 1/2）
+        # QEMU_WEBRTC_DOWNSAMPLE=1 の場合は常に1/2以下
+        self.base_scale = 2 if os.environ.get("QEMU_WEBRTC_DOWNSAMPLE", "0") != "0" else 1
+        self.scale = self.base_scale
+        
+        # クライアントの表示サイズ（デバイスピクセル）に合わせて縮小
+        self.scaler = FrameScaler()
+        self.viewport_width: Optional[int] = None
+        self.viewport_height: Optional[int] = None
+        
+        # 解像度変更の追跡（キーフレーム要求とリサイズ遅延計測）
+        self.sender = None  # RTCRtpSender（SignalingServerが設定）
+        self._resolution_generation = display_capture.resolution_generation
+        self._resize_pending = False
+        self.last_resize_latency_ms: Optional[float] = None
         
         # フレームカウンター
         self.frame_count = 0
+        self.fps_meter = metrics.RateMeter()
         
         # 最後のフレーム（新しいフレームがない場合に再送）
         self.last_frame = None
         
+        # 事前確保したフレームにDisplayCaptureから直接コピー
+        self.frame_pool = FramePool()
+        self._frame_seq = -1
+        self._recv_started = None  # 直近のrecvの処理開始時刻（トレース用）
+        
         # タイムスタンプ管理
         self.time_base = fractions.Fraction(1, 90000)  # WebRTC標準
         self.pts = 0
@@ -48,6 +86,75 @@ class QEMUVideoTrack(VideoStreamTrack):
         
         logger.info(f"QEMUVideoTrack initialized: {fps}fps")
     
+    def set_quality(self, fps: Optional[int] = None, scale: Optional[float] = None):
+        """
+        送信品質を変更（AdaptationControllerから呼ばれる）
+        
+        Args:
+            fps: フレームレート（max_fpsが上限）
+            scale: 出力スケール（base_scaleが下限）
+        """
+        if fps is not None:
+            fps = max(1, min(int(fps), self.max_fps))
+            if fps != self.fps:
+                self.fps = fps
+                self.frame_interval = 1.0 / fps
+                self.pts_increment = 90000 // fps
+        if scale is not None:
+            self.scale = max(self.base_scale, scale)
+    
+    def set_viewport(self, width: Optional[int], height: Optional[int]):
+        """
+        クライアントの表示サイズを設定（これより大きくはエンコードしない）
+        
+        Args:
+            width, height: 表示サイズ（デバイスピクセル）、Noneで制限解除
+        """
+        self.viewport_width = int(width) if width else None
+        self.viewport_height = int(height) if height else None
+    
+    def request_keyframe(self):
+        """次のフレームをキーフレームにするようエンコーダに要求"""
+        if self.sender is not None and hasattr(self.sender, "_send_keyframe"):
+            self.sender._send_keyframe()
+    
+    def _check_resolution_change(self):
+        """DisplayCaptureの解像度変更を検出"""
+        generation = self.display_capture.resolution_generation
+        if generation == self._resolution_generation:
+            return
+        self._resolution_generation = generation
+        # 旧サイズのフレームを再送しない（エンコーダがサイズを往復しないように）
+        self.last_frame = None
+        self._resize_pending = True
+        # エンコーダはフレームサイズの変化で再構成される。明示的にキーフレームも要求
+        self.request_keyframe()
+    
+    def _record_resize_latency(self, frame):
+        """新サイズの最初のフレームでリサイズ遅延を記録"""
+        capture = self.display_capture
+        if (frame.width, frame.height) != (capture.width, capture.height):
+            return
+        self._resize_pending = False
+        if capture.resize_time is not None:
+            self.last_resize_latency_ms = (time.monotonic() - capture.resize_time) * 1000
+            logger.info(f"Resize to {capture.width}x{capture.height} sent after "
+                        f"{self.last_resize_latency_ms:.1f}ms")
+    
+    async def _pace(self):
+        """フレーム間隔に合わせて待機"""
+        now = time.monotonic()
+        if self._next_frame_time is None:
+            self._next_frame_time = now
+        wait = self._next_frame_time - now
+        if wait > 0:
+            await asyncio.sleep(wait)
+        elif wait < -self.frame_interval:
+            # 送信側の要求が遅れて飛ばしたフレーム間隔
+            metrics.DROPPED_LATE.inc(int(-wait / self.frame_interval))
+        # 遅延が蓄積した場合は追いつこうとせず現在時刻から再開
+        self._next_frame_time = max(self._next_frame_time, time.monotonic() - self.frame_interval) + self.frame_interval
+    
     async def recv(self) -> VideoFrame:
         """
         次のビデオフレームを取得
@@ -57,52 +164,70 @@ class QEMUVideoTrack(VideoStreamTrack):
         Returns:
             av.VideoFrame
         """
-        try:
-            # DisplayCaptureから新しいフレームを取得（タイムアウト付き）
-            frame_data = await asyncio.wait_for(
-                self.display_capture.get_frame(),
-                timeout=self.frame_interval
-            )
-            
-            # 新しいフレームが来た場合のみ更新
-            if frame_data is not None:
-                self.last_frame = frame_data
-            
-        except asyncio.TimeoutError:
-            # タイムアウト：新しいフレームがない
-            pass
-        
-        # 新しいフレームがない場合は最後のフレームを使用
-        if frame_data is None:
-            frame_data = self.last_frame
-        
-        # フレームデータがない場合は黒画面
+        await self._pace()
+        self._recv_started = time.perf_counter()
+        self._check_resolution_change()
+        
+        if self.frame_count == 0:
+            # 最初のフレームは変換済みスナップショットがあればそのまま送る
+            frame = self._snapshot_frame()
+            if frame is not None:
+                return self._finish_frame(frame, "snapshot")
+        
+        # DisplayCaptureから前回以降の新しいフレームをプールへ直接コピー
+        frame, self._frame_seq = self.display_capture.read_frame_into(
+            self.frame_pool.acquire, self._frame_seq
+        )
+        
         source = "new"
-        if frame_data is None:
-            # 警告を削除（頻繁すぎるため）
+        if frame is not None:
+            self.last_frame = frame
+        elif self.last_frame is not None:
+            # 新しいフレームがない場合は最後のフレームを再送
+            frame = self.last_frame
+            source = "cached"
+        else:
+            # フレームデータがない場合は黒画面
             width = self.display_capture.width or 1280
             height = self.display_capture.height or 800
-            # 最新フレームがある場合は即時に使う
-            latest = await self.display_capture.get_latest_frame_copy()
-            if latest is not None:
-                frame_data = latest
-                self.last_frame = latest
-                source = "latest"
-            else:
-                import numpy as np
-                frame_data = np.zeros((height, width, 3), dtype=np.uint8)
-                source = "black"
-        elif frame_data is self.last_frame:
-            source = "cached"
+            frame = self.frame_pool.black_frame(width, height)
+            source = "black"
         
-        # パフォーマンス改善：解像度を1/2にダウンサンプリング（高速）
-        # 環境変数で無効化可能: QEMU_WEBRTC_DOWNSAMPLE=0
-        if os.environ.get("QEMU_WEBRTC_DOWNSAMPLE", "0") != "0":
-            frame_data = frame_data[::2, ::2]
+        if self._resize_pending:
+            self._record_resize_latency(frame)
         
-        # av.VideoFrameに変換
-        frame = VideoFrame.from_ndarray(frame_data, format='rgb24')
+        # 表示サイズ・出力スケールに合わせて縮小し、yuv420pに変換（swscale 1パス）
+        out_width, out_height = fit_size(
+            frame.width, frame.height,
+            self.viewport_width, self.viewport_height,
+            self.scale,
+        )
+        frame = self.scaler.scale(frame, out_width, out_height)
         
+        if source == "new":
+            # 新しいフレームは後から参加する視聴者と共有
+            if self.snapshots is not None:
+                self.snapshots.put(self._frame_seq, frame)
+            if self.latency is not None:
+                self.latency.on_frame_read(self._frame_seq, self.pts, self.sender)
+        
+        return self._finish_frame(frame, source)
+    
+    def _snapshot_frame(self) -> Optional[VideoFrame]:
+        """現在のフレーム・出力サイズに一致するスナップショットを取得"""
+        capture = self.display_capture
+        if self.snapshots is None or not capture.width or not capture.height:
+            return None
+        out_width, out_height = fit_size(
+            capture.width, capture.height,
+            self.viewport_width, self.viewport_height,
+            self.scale,
+        )
+        # _frame_seqは進めない（次のrecvで再送用のフレームをプールへコピーする）
+        return self.snapshots.get(capture.frame_seq, out_width, out_height)
+    
+    def _finish_frame(self, frame: VideoFrame, source: str) -> VideoFrame:
+        """タイムスタンプを設定し、最初のフレームまでの時間を記録"""
         # タイムスタンプ設定
         frame.pts = self.pts
         frame.time_base = self.time_base
@@ -110,20 +235,73 @@ class QEMUVideoTrack(VideoStreamTrack):
         # 次のフレーム用にPTSを更新
         self.pts += self.pts_increment
         self.frame_count += 1
+        self.fps_meter.tick()
+        if tracing.TRACER.enabled:
+            self._trace_frame(frame, source)
 
         if not self._first_frame_logged:
-            elapsed_ms = (time.time() - self.start_time) * 1000
-            logger.info(f"First frame sent after {elapsed_ms:.1f}ms (source={source})")
+            self.first_frame_ms = (time.time() - self.start_time) * 1000
+            self.first_frame_source = source
+            logger.info(f"First frame sent after {self.first_frame_ms:.1f}ms (source={source})")
             self._first_frame_logged = True
         
         # ログ削除（パフォーマンス改善）
         
         return frame
     
+    def _trace_frame(self, frame: VideoFrame, source: str):
+        """recvの区間を記録（新しいフレームはframe_publishから、エンコードへ続くフローを付ける）"""
+        console = getattr(self.display_capture, "primary", self.display_capture)
+        console_id = getattr(console, "console_id", None)
+        flow_in = None
+        if source == "new":
+            flow_in = (tracing.FLOW_FRAME, tracing.flow_id(id(console), self._frame_seq))
+        tracing.TRACER.span(
+            "track.recv", self._recv_started,
+            flow_in=flow_in, flow_out=(tracing.FLOW_ENCODE, tracing.flow_id(id(frame), frame.pts)),
+            console=console_id, seq=self._frame_seq, pts=frame.pts, source=source,
+        )
+    
     def stop(self):
         """トラック停止"""
         super().stop()
-        logger.info(f"QEMUVideoTrack stopped: {self.frame_count} frames sent")
+        logger.info(f"QEMUVideoTrack stopped: {self.frame_count} frames sent, "
+                    f"frame pool {self.frame_pool.stats()}")
+
+
+class ConnectionTrack(MediaStreamTrack):
+    """
+    RTCRtpSenderに渡す接続ごとのトラック
+    
+    aiortcは接続が切れるとRTP送信タスクの終了時に送信中のトラックを停止し、
+    エンコーダを解放する。QEMUVideoTrackとエンコーダを再接続後の接続に
+    引き継げるよう、送信側にはこの薄いトラックを渡し、エンコーダの参照も保持する。
+    """
+    
+    kind = "video"
+    
+    def __init__(self, source: QEMUVideoTrack):
+        """
+        Args:
+            source: フレームの取得元（セッションが保持するQEMUVideoTrack）
+        """
+        super().__init__()
+        self.source = source
+        self.encoder = None  # 送信側が生成したエンコーダ
+    
+    async def recv(self) -> VideoFrame:
+        # 送信側は前のフレームのRTPパケットを送り終えてから次のフレームを要求する
+        encoded_at = getattr(self.encoder, "encoded_at", None)
+        if encoded_at is not None:
+            self.encoder.encoded_at = None
+            ended = metrics.SEND.observe_since(encoded_at)
+            tracing.TRACER.span("send", encoded_at, ended)
+        if self.encoder is None and self.source.sender is not None:
+            self.encoder = getattr(self.source.sender, "_RTCRtpSender__encoder", None)
+            if self.encoder is not None and hasattr(self.encoder, "encoded_at"):
+                # 再接続前の接続でエンコードした時刻は含めない
+                self.encoder.encoded_at = None
+        return await self.source.recv()
 
 
 class MockVideoTrack(VideoStreamTrack):
@@ -0,0 +1,162 @@
+"""
+Warm Startup
+
+起動時にEGLコンテキスト生成・エンコーダ構築・DTLS証明書生成・コンソール検出を並行実行し、
+最初の視聴者がこれらのコストを払わないようにする
+
+各ステップの所要時間は /ready で確認できる（準備完了までは503）。
+"""
+
+import asyncio
+import fractions
+import logging
+import time
+from typing import Optional
+
+import numpy as np
+from aiohttp import web
+from av import VideoFrame
+
+logger = logging.getLogger(__name__)
+
+# エンコーダのウォームアップに使うフレームサイズ
+WARMUP_FRAME_SIZE = (1280, 720)
+
+
+def warm_egl() -> bool:
+    """
+    EGLディスプレイ・コンテキストを生成（スレッドにはバインドしない）
+
+    コンテキストは最初のScanoutDMABUFを処理するD-Busスレッドでバインドされる。
+    """
+    from dbus import dmabuf_gl
+    if dmabuf_gl.egl_lib is None:
+        logger.info("EGL warm-up skipped: libEGL not available")
+        return False
+    return dmabuf_gl.get_renderer().initialize(make_current=False)
+
+
+def warm_encoder(profile, mime_types) -> int:
+    """
+    エンコーダを構築してダミーフレームを1枚エンコード
+
+    コーデックライブラリのロード・初回オープンのコストを起動時に払う。
+
+    Args:
+        profile: EncoderProfile
+        mime_types: ウォームアップするコーデックのMIMEタイプ
+
+    Returns:
+        エンコードしたバイト数
+    """
+    from aiortc.rtcrtpparameters import RTCRtpCodecParameters
+    from .encoder_profiles import create_encoder
+
+    width, height = WARMUP_FRAME_SIZE
+    total = 0
+    for mime_type in mime_types:
+        codec = RTCRtpCodecParameters(mimeType=mime_type, clockRate=90000, payloadType=96)
+        encoder = create_encoder(codec, profile)
+        frame = VideoFrame.from_ndarray(np.zeros((height, width, 3), dtype=np.uint8), format="rgb24")
+        frame.pts = 0
+        frame.time_base = fractions.Fraction(1, 90000)
+        payloads, _ = encoder.encode(frame, True)
+        total += sum(len(p) for p in payloads)
+    return total
+
+
+def warm_certificate(pool) -> int:
+    """
+    DTLS証明書プールを満たす（暗号ライブラリの初期化も起動時に済ませる）
+
+    Args:
+        pool: CertificatePool
+
+    Returns:
+        生成した証明書の数
+    """
+    return pool.fill()
+
+
+class WarmStartup:
+    """起動フェーズの計測と準備完了状態"""
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.steps = {}  # name -> ms
+        self.errors = {}  # name -> message
+        self.ready = False
+        self.ready_ms: Optional[float] = None
+
+    def _record(self, name: str, started: float, error: Optional[Exception] = None):
+        self.steps[name] = round((time.monotonic() - started) * 1000, 1)
+        if error is not None:
+            self.errors[name] = str(error)
+            logger.error(f"Warm-up step '{name}' failed after {self.steps[name]}ms: {error}")
+        else:
+            logger.info(f"✓ Warm-up step '{name}': {self.steps[name]}ms")
+
+    async def step(self, name: str, awaitable):
+        """
+        asyncio側のステップを計測して実行（例外は記録して再送出）
+
+        connect()のように失敗をFalseで返すステップもあるため、
+        偽の結果も失敗として記録し、準備完了を取り消す。
+        """
+        started = time.monotonic()
+        try:
+            result = await awaitable
+        except Exception as e:
+            self._record(name, started, e)
+            self.ready = False
+            raise
+        if not result:
+            self._record(name, started, RuntimeError(f"step returned {result!r}"))
+            self.ready = False
+            return result
+        self._record(name, started)
+        return result
+
+    def run_in_thread(self, name: str, func, *args) -> asyncio.Task:
+        """
+        ブロッキングなステップをスレッドで開始
+
+        所要時間はスレッド内で計測する（イベントループが他のステップで
+        ブロックされていても正確になるように）。失敗しても起動は続行する。
+        """
+        def run():
+            started = time.monotonic()
+            try:
+                result = func(*args)
+            except Exception as e:
+                self._record(name, started, e)
+                return None
+            self._record(name, started)
+            return result
+
+        return asyncio.ensure_future(asyncio.to_thread(run))
+
+    def mark_ready(self):
+        """準備完了"""
+        self.ready = True
+        self.ready_ms = round((time.monotonic() - self.started_at) * 1000, 1)
+        breakdown = ", ".join(f"{name}={ms}ms" for name, ms in self.steps.items())
+        logger.info(f"✓ Server ready after {self.ready_ms}ms ({breakdown})")
+
+    def report(self) -> dict:
+        """起動時間の内訳"""
+        return {
+            "ready": self.ready,
+            "readyMs": self.ready_ms,
+            "steps": dict(self.steps),
+            "errors": dict(self.errors),
+        }
+
+    async def handle_ready(self, request: web.Request) -> web.Response:
+        """
+        準備完了状態を返す（ロードバランサ等のヘルスチェック用）
+
+        Returns:
+            準備完了なら200、起動中は503
+        """
+        return web.json_response(self.report(), status=200 if self.ready else 503)
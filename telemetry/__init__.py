@@ -0,0 +1,10 @@
+"""
+Telemetry Package
+
+キャプチャ（dbus）と配信（server）の両方から使う計測
+"""
+
+from .metrics import REGISTRY, handle_metrics
+from .tracing import TRACER, handle_trace
+
+__all__ = ['REGISTRY', 'handle_metrics', 'TRACER', 'handle_trace']
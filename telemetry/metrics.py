@@ -0,0 +1,357 @@
+"""
+Pipeline Metrics
+
+パイプラインの段階ごとの所要時間（ヒストグラム）とカウンターを集計し、
+/metrics でPrometheusのテキスト形式（?format=json でパーセンタイルの概算をJSON）で返す
+
+段階（qemu_webrtc_stage_seconds{stage=...}）:
+    dbus_receive    Listener呼び出しの受信 → ディスパッチスレッドで処理開始（アンパック・キュー待ち）
+    conversion      Pixman / Fourcc → RGBの画素変換（CPU）
+    egl_readback    DMA-BUFのEGL描画と読み出し
+    frame_publish   Listenerの処理完了 → フレームバッファへの反映
+    encode          エンコード（executorのスレッド）
+    send            エンコード完了 → RTPパケットの送出完了（送信側が次のフレームを要求するまで）
+    input_receive   入力メッセージの受信 → 送信キューへの投入
+    input_dispatch  D-Busへの入力送信（呼び出し元のブロック時間）
+    input_queue     入力専用接続のキュー投入 → ソケット書き込み
+
+計測はtime.perf_counter()の差分をバケットに数えるだけで、ログもメモリ確保もしない。
+キューの深さ・セッションごとのfpsなど現在値はスクレイプ時にコレクターから読む。
+ワーカープロセス（QEMU_WEBRTC_WORKERS）の値は定期的に届くスナップショットを
+workerラベル付きで合わせて出力する。
+"""
+
+import bisect
+import logging
+import math
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# バケットの上限（秒）。フレーム間隔（10〜30fps）の前後を細かく取る
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# コレクターが返す現在値: (メトリクス名, ラベル, 値)
+Sample = Tuple[str, dict, float]
+
+
+class Histogram:
+    """固定バケットのヒストグラム（秒）"""
+
+    def __init__(self, buckets: tuple = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 最後は+Inf
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+        # ディスパッチスレッド・executor・asyncioループから同時に呼ばれる
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += seconds
+            self.count += 1
+            if seconds > self.max:
+                self.max = seconds
+
+    def observe_since(self, started: float) -> float:
+        """
+        started（time.perf_counter()）からの経過時間を記録
+
+        Returns:
+            現在のtime.perf_counter()（次の段階の開始時刻に使える）
+        """
+        now = time.perf_counter()
+        self.observe(now - started)
+        return now
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"counts": list(self.counts), "sum": self.sum, "count": self.count, "max": self.max}
+
+
+class Counter:
+    """単調増加のカウンター"""
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: int = 1):
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self) -> int:
+        return self.value
+
+
+class RateMeter:
+    """直近window秒のイベント数から1秒あたりの回数を求める（セッションごとのfps）"""
+
+    def __init__(self, window: float = 2.0):
+        self.window = window
+        self._times = deque()
+
+    def _trim(self, now: float):
+        times = self._times
+        while times and times[0] < now - self.window:
+            times.popleft()
+
+    def tick(self):
+        now = time.monotonic()
+        self._times.append(now)
+        self._trim(now)
+
+    def rate(self) -> float:
+        self._trim(time.monotonic())
+        return len(self._times) / self.window
+
+
+class _Family:
+    """同じ名前・型のメトリクス（ラベルの組ごとの系列）"""
+
+    def __init__(self, name: str, kind: str, help_text: str):
+        self.name = name
+        self.kind = kind  # histogram / counter / gauge
+        self.help = help_text
+        self.series = {}  # ラベルのタプル -> Histogram / Counter
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(pairs) -> str:
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    if isinstance(value, float) and not value.is_integer():
+        return repr(value)
+    return str(int(value))
+
+
+def percentile(values, fraction: float) -> Optional[float]:
+    """
+    ソート済みの値のパーセンタイル（nearest-rank法）
+
+    Args:
+        values: 昇順にソートした値
+        fraction: 0〜1（p99なら0.99）
+
+    Returns:
+        ceil(fraction * 件数)番目の値（空ならNone）
+    """
+    if not values:
+        return None
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+def _summarize(snapshot: dict, buckets: tuple) -> dict:
+    """ヒストグラムの件数・平均・パーセンタイル（バケット上限による概算、ms）"""
+    count = snapshot["count"]
+    if not count:
+        return {"count": 0}
+
+    def percentile(fraction: float) -> Optional[float]:
+        target = count * fraction
+        cumulative = 0
+        for index, bucket_count in enumerate(snapshot["counts"]):
+            cumulative += bucket_count
+            if cumulative >= target:
+                upper = buckets[index] if index < len(buckets) else snapshot["max"]
+                return round(min(upper, snapshot["max"]) * 1000, 3)
+        return None
+
+    return {
+        "count": count,
+        "meanMs": round(snapshot["sum"] / count * 1000, 3),
+        "p50Ms": percentile(0.5),
+        "p90Ms": percentile(0.9),
+        "p99Ms": percentile(0.99),
+        "maxMs": round(snapshot["max"] * 1000, 3),
+    }
+
+
+class MetricsRegistry:
+    """プロセス内のメトリクスとスクレイプ時のコレクター"""
+
+    def __init__(self):
+        self.families: Dict[str, _Family] = {}
+        self._collectors = []  # () -> Iterable[Sample]
+        self._remotes = []  # () -> Iterable[(追加ラベル, snapshot())]
+        self._lock = threading.Lock()
+
+    def _family(self, name: str, kind: str, help_text: str) -> _Family:
+        family = self.families.get(name)
+        if family is None:
+            family = self.families[name] = _Family(name, kind, help_text)
+        elif family.kind != kind:
+            raise ValueError(f"metric {name} is already registered as {family.kind}")
+        return family
+
+    def _series(self, name: str, kind: str, help_text: str, factory, labels: dict):
+        with self._lock:
+            family = self._family(name, kind, help_text)
+            key = _label_key(labels)
+            metric = family.series.get(key)
+            if metric is None:
+                metric = family.series[key] = factory()
+            return metric
+
+    def histogram(self, name: str, help_text: str, **labels) -> Histogram:
+        return self._series(name, "histogram", help_text, Histogram, labels)
+
+    def counter(self, name: str, help_text: str, **labels) -> Counter:
+        return self._series(name, "counter", help_text, Counter, labels)
+
+    def gauge(self, name: str, help_text: str):
+        """現在値（コレクターが返す）のメトリクス名を登録"""
+        with self._lock:
+            self._family(name, "gauge", help_text)
+
+    def add_collector(self, collect: Callable[[], Iterable[Sample]]):
+        self._collectors.append(collect)
+
+    def remove_collector(self, collect: Callable[[], Iterable[Sample]]):
+        if collect in self._collectors:
+            self._collectors.remove(collect)
+
+    def add_remote(self, collect: Callable[[], Iterable[Tuple[dict, dict]]]):
+        """別プロセスのsnapshot()を追加ラベル付きで出力に含める"""
+        self._remotes.append(collect)
+
+    def snapshot(self) -> dict:
+        """
+        ヒストグラムとカウンターの現在値（ワーカープロセスから配信プロセスへ送る）
+
+        Returns:
+            {メトリクス名: [(ラベルのタプル, 値)]}（pickle可能）
+        """
+        with self._lock:
+            families = [(family.name, list(family.series.items()))
+                        for family in self.families.values() if family.series]
+        return {name: [(key, metric.snapshot()) for key, metric in series]
+                for name, series in families}
+
+    def _collect(self) -> Dict[str, list]:
+        """全系列を {メトリクス名: [(ラベルのタプル, 値)]} に集める"""
+        collected = self.snapshot()
+        for collect in list(self._remotes):
+            try:
+                for extra, snapshot in collect():
+                    for name, values in snapshot.items():
+                        if name not in self.families:
+                            continue
+                        collected.setdefault(name, []).extend(
+                            (_label_key({**dict(key), **extra}), value) for key, value in values
+                        )
+            except Exception as e:
+                logger.error(f"Remote metrics collection failed: {e}")
+        for collect in list(self._collectors):
+            try:
+                for name, labels, value in collect():
+                    if name in self.families and value is not None:
+                        collected.setdefault(name, []).append((_label_key(labels), value))
+            except Exception as e:
+                logger.error(f"Metrics collector failed: {e}")
+        return collected
+
+    def render(self) -> str:
+        """Prometheusのテキスト形式"""
+        collected = self._collect()
+        lines = []
+        for family in self.families.values():
+            values = collected.get(family.name)
+            if not values:
+                continue
+            lines.append(f"# HELP {family.name} {family.help}")
+            lines.append(f"# TYPE {family.name} {family.kind}")
+            for key, value in values:
+                if family.kind != "histogram":
+                    lines.append(f"{family.name}{_format_labels(key)} {_format_value(value)}")
+                    continue
+                cumulative = 0
+                for bound, bucket_count in zip(BUCKETS + (float("inf"),), value["counts"]):
+                    cumulative += bucket_count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{family.name}_bucket{_format_labels(key + (('le', le),))} {cumulative}")
+                lines.append(f"{family.name}_sum{_format_labels(key)} {repr(value['sum'])}")
+                lines.append(f"{family.name}_count{_format_labels(key)} {value['count']}")
+        return "\n".join(lines) + "\n"
+
+    def to_json(self) -> dict:
+        """メトリクス名ごとの系列（ヒストグラムは件数・パーセンタイルの概算）"""
+        collected = self._collect()
+        result = {}
+        for family in self.families.values():
+            values = collected.get(family.name)
+            if not values:
+                continue
+            result[family.name] = [
+                {"labels": dict(key),
+                 **(_summarize(value, BUCKETS) if family.kind == "histogram" else {"value": value})}
+                for key, value in values
+            ]
+        return result
+
+
+REGISTRY = MetricsRegistry()
+
+
+def _stage(name: str) -> Histogram:
+    return REGISTRY.histogram("qemu_webrtc_stage_seconds", "Time spent in each pipeline stage", stage=name)
+
+
+def _dropped(reason: str) -> Counter:
+    return REGISTRY.counter("qemu_webrtc_frames_dropped_total", "Frames dropped before reaching a viewer",
+                            reason=reason)
+
+
+DBUS_RECEIVE = _stage("dbus_receive")
+CONVERSION = _stage("conversion")
+EGL_READBACK = _stage("egl_readback")
+FRAME_PUBLISH = _stage("frame_publish")
+ENCODE = _stage("encode")
+SEND = _stage("send")
+INPUT_RECEIVE = _stage("input_receive")
+INPUT_DISPATCH = _stage("input_dispatch")
+INPUT_QUEUE = _stage("input_queue")
+
+# 解像度変更前にキューされた旧サイズのフレーム
+DROPPED_STALE = _dropped("stale")
+# 送信側の要求が遅れてフレーム間隔を飛ばした（エンコード・送信が間に合わない）
+DROPPED_LATE = _dropped("late")
+# ワーカーの共有メモリリングに空きがなかった
+DROPPED_RING_FULL = _dropped("ring_full")
+
+REGISTRY.gauge("qemu_webrtc_queue_depth", "Items waiting in a queue")
+REGISTRY.gauge("qemu_webrtc_session_fps", "Frames per second sent to a session (last 2s)")
+REGISTRY.gauge("qemu_webrtc_shm_ring_used_bytes", "Unread bytes in a worker shared memory ring")
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    """
+    パイプラインのメトリクス
+
+    Prometheusのテキスト形式、?format=json の場合は系列ごとの件数・平均・パーセンタイル（ms）
+    """
+    if request.query.get("format") == "json":
+        return web.json_response(REGISTRY.to_json())
+    return web.Response(
+        body=REGISTRY.render().encode(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
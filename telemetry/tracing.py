@@ -0,0 +1,173 @@
+"""
+Frame Lifecycle Tracing
+
+フレームごとの処理区間（スパン）をリングバッファに記録し、
+/trace でChrome trace形式（chrome://tracing・Perfettoで開けるJSON）で返す
+
+QEMU_WEBRTC_TRACE=1 の場合のみ記録する（平均では見えない一時的な停止の調査用）。
+記録する区間とスレッド:
+    dbus.<メソッド>   GDBusワーカースレッド（メッセージフィルターでの受信・アンパック）
+    listener.<メソッド> コンソールのディスパッチスレッド（DisplayListenerの処理全体）
+    conversion / egl_readback  同上（画素変換・DMA-BUFの読み出し）
+    frame_publish     asyncioループ（Update系はディスパッチスレッド）でのフレームバッファへの反映
+    track.recv        asyncioループでの取得・縮小・yuv420p変換
+    encode            executorのスレッドでのエンコード
+    send              エンコード完了 → 送信側が次のフレームを要求するまで
+同じメッセージ・フレームの区間はフロー（矢印）でつなぐ。
+
+時刻はtime.perf_counter()（LinuxではCLOCK_MONOTONIC）なので、
+ワーカープロセスから届いた区間もそのまま同じ時間軸に並ぶ。
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Optional
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# フローの種類（Chrome traceのフローはidとcatの組で対応づけられる）
+FLOW_MESSAGE = "message"  # D-Busメッセージ → ディスパッチ → フレームバッファへの反映
+FLOW_FRAME = "frame"  # フレームバッファへの反映 → track.recv
+FLOW_ENCODE = "encode"  # track.recv → エンコード
+
+
+def flow_id(*parts) -> int:
+    """
+    フローのID（両端で同じ値から求める）
+
+    フローは1プロセス内で閉じるため、ワーカープロセスから届いた区間と
+    衝突しないようにpidを含める。
+    """
+    return hash((TRACER.pid, parts)) & 0x7FFFFFFFFFFFFFFF
+
+
+class Tracer:
+    """スパンのリングバッファ"""
+
+    def __init__(self, capacity: int = 50000, enabled: bool = False):
+        """
+        Args:
+            capacity: 保持するイベント数（古いものから捨てる）
+            enabled: 記録するか
+        """
+        self.enabled = enabled
+        self.capacity = capacity
+        # deque.appendはスレッドセーフなので記録時にロックを取らない
+        self.events = deque(maxlen=capacity)
+        self.process_name = "qemu-webrtc"
+        self.pid = os.getpid()
+        self.recorded = 0
+
+    def span(self, name: str, started: float, ended: Optional[float] = None, cat: str = "frame",
+             flow_in=None, flow_out=None, **args) -> Optional[float]:
+        """
+        started〜ended（time.perf_counter()、省略時は現在）の区間を記録
+
+        Args:
+            name: 区間の名前
+            started: 開始時刻
+            ended: 終了時刻
+            cat: カテゴリ
+            flow_in: この区間で終わるフロー（(種類, id)）
+            flow_out: この区間から始まるフロー（(種類, id)）
+            args: トレースビューアに表示する値（コンソール・frame_seq・ptsなど）
+
+        Returns:
+            終了時刻（記録しない場合はended）
+        """
+        if not self.enabled:
+            return ended
+        if ended is None:
+            ended = time.perf_counter()
+        thread = threading.current_thread()
+        self.events.append((name, cat, started, ended, self.pid, self.process_name,
+                            threading.get_native_id(), thread.name, flow_in, flow_out, args))
+        self.recorded += 1
+        return ended
+
+    def drain(self) -> list:
+        """記録済みのイベントを取り出す（ワーカープロセスから配信プロセスへ送る）"""
+        events = []
+        while True:
+            try:
+                events.append(self.events.popleft())
+            except IndexError:
+                return events
+
+    def extend(self, events: list):
+        """別プロセスで記録したイベントを追加"""
+        self.events.extend(events)
+
+    def clear(self):
+        self.events.clear()
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "events": len(self.events),
+            "capacity": self.capacity,
+            "recorded": self.recorded,
+        }
+
+    def to_chrome(self) -> dict:
+        """
+        Chrome trace形式（Trace Event Format）
+
+        区間は完了イベント（ph=X、時刻はµs）、フローはs/fイベントとして出力し、
+        プロセス名・スレッド名をメタデータ（ph=M）で付ける。
+        """
+        trace_events = []
+        processes = {}
+        threads = {}
+        for (name, cat, started, ended, pid, process_name, tid, thread_name,
+             flow_in, flow_out, args) in list(self.events):
+            ts = started * 1e6
+            dur = (ended - started) * 1e6
+            processes[pid] = process_name
+            threads[(pid, tid)] = thread_name
+            trace_events.append({"name": name, "cat": cat, "ph": "X", "ts": ts, "dur": dur,
+                                 "pid": pid, "tid": tid, "args": args})
+            if flow_in is not None:
+                # 区間の開始時刻を含む区間（この区間）に結びつける
+                trace_events.append({"name": flow_in[0], "cat": flow_in[0], "ph": "f", "bp": "e",
+                                     "id": flow_in[1], "ts": ts, "pid": pid, "tid": tid})
+            if flow_out is not None:
+                trace_events.append({"name": flow_out[0], "cat": flow_out[0], "ph": "s",
+                                     "id": flow_out[1], "ts": ts + dur / 2, "pid": pid, "tid": tid})
+        for pid, process_name in processes.items():
+            trace_events.append({"name": "process_name", "ph": "M", "pid": pid,
+                                 "args": {"name": process_name}})
+        for (pid, tid), thread_name in threads.items():
+            trace_events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+                                 "args": {"name": thread_name}})
+        return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+
+TRACER = Tracer(
+    capacity=int(os.environ.get("QEMU_WEBRTC_TRACE_EVENTS", "50000")),
+    enabled=os.environ.get("QEMU_WEBRTC_TRACE", "0") != "0",
+)
+
+
+async def handle_trace(request: web.Request) -> web.Response:
+    """
+    記録済みのトレースをChrome trace形式でダウンロード
+
+    ?clear=1 の場合は返した後にリングバッファを空にする。
+    トレースが無効な場合は409を返す。
+    """
+    if not TRACER.enabled:
+        return web.json_response({"error": "tracing is disabled (set QEMU_WEBRTC_TRACE=1)"}, status=409)
+    trace = TRACER.to_chrome()
+    if request.query.get("clear") == "1":
+        TRACER.clear()
+    logger.info(f"Trace exported: {len(trace['traceEvents'])} events")
+    return web.json_response(
+        trace,
+        headers={"Content-Disposition": 'attachment; filename="qemu-webrtc-trace.json"'},
+    )
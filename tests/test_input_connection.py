@@ -0,0 +1,122 @@
+"""
+dbus/input_connection.py のD-Busメッセージ組み立て・アドレス解析・SASL認証
+
+期待値のバイト列はjeepney（独立したD-Bus実装）で同じヘッダーフィールド順の
+メッセージをシリアライズしたもの。パディング・エンディアンのずれがあると
+すべての入力がQEMUに届かなくなるため、バイト単位で比較する。
+"""
+
+import os
+import socket
+import threading
+
+import pytest
+
+from dbus.input_connection import (
+    KEYBOARD_INTERFACE, MOUSE_INTERFACE, InputConnection, marshal_method_call, parse_unix_address,
+)
+
+CONSOLE_PATH = "/org/qemu/Display1/Console_0"
+
+SET_ABS_POSITION = bytes.fromhex(
+    "6c01010108000000010000008000000001016f001c0000002f6f72672f71656d752f446973706c6179"
+    "312f436f6e736f6c655f300000000002017300170000006f72672e71656d752e446973706c6179312e"
+    "4d6f75736500030173000e000000536574416273506f736974696f6e000006017300080000006f7267"
+    "2e71656d750000000000000000080167000275750080020000e0010000"
+)
+
+REL_MOTION = bytes.fromhex(
+    "6c01010108000000020000008000000001016f001c0000002f6f72672f71656d752f446973706c6179"
+    "312f436f6e736f6c655f300000000002017300170000006f72672e71656d752e446973706c6179312e"
+    "4d6f75736500030173000900000052656c4d6f74696f6e0000000000000006017300080000006f7267"
+    "2e71656d7500000000000000000801670002696900fbffffff07000000"
+)
+
+KEY_PRESS = bytes.fromhex(
+    "6c01010104000000030000007f00000001016f001c0000002f6f72672f71656d752f446973706c6179"
+    "312f436f6e736f6c655f3000000000020173001a0000006f72672e71656d752e446973706c6179312e"
+    "4b6579626f6172640000000000000301730005000000507265737300000006017300080000006f7267"
+    "2e71656d75000000000000000008016700017500001e000000"
+)
+
+
+@pytest.mark.parametrize("serial, interface, member, signature, args, expected", [
+    (1, MOUSE_INTERFACE, "SetAbsPosition", "uu", (640, 480), SET_ABS_POSITION),
+    (2, MOUSE_INTERFACE, "RelMotion", "ii", (-5, 7), REL_MOTION),
+    (3, KEYBOARD_INTERFACE, "Press", "u", (30,), KEY_PRESS),
+])
+def test_marshal_method_call(serial, interface, member, signature, args, expected):
+    blob = marshal_method_call(serial, "org.qemu", CONSOLE_PATH, interface, member, signature, args)
+    assert blob == expected
+
+
+def test_marshal_method_call_header_padding():
+    # ヘッダー（フィールド配列を含む）は8バイト境界まで埋めてから本体が続く
+    blob = marshal_method_call(1, "org.qemu", CONSOLE_PATH, KEYBOARD_INTERFACE, "Press", "u", (30,))
+    body_length = int.from_bytes(blob[4:8], "little")
+    fields_length = int.from_bytes(blob[12:16], "little")
+    header_length = 16 + fields_length + (-(16 + fields_length) % 8)
+    assert len(blob) == header_length + body_length
+    assert blob[header_length:] == (30).to_bytes(4, "little")
+
+
+def test_marshal_method_call_rejects_unsupported_type():
+    with pytest.raises(ValueError):
+        marshal_method_call(1, "org.qemu", CONSOLE_PATH, MOUSE_INTERFACE, "Foo", "s", ("x",))
+
+
+@pytest.mark.parametrize("address, expected", [
+    ("unix:path=/run/user/1000/bus", "/run/user/1000/bus"),
+    ("unix:abstract=/tmp/dbus-abc,guid=0123", "\0/tmp/dbus-abc"),
+    ("tcp:host=localhost,port=1234;unix:path=/tmp/bus", "/tmp/bus"),
+    ("tcp:host=localhost,port=1234", None),
+    ("unix:tmpdir=/tmp", None),
+])
+def test_parse_unix_address(address, expected):
+    assert parse_unix_address(address) == expected
+
+
+def _serve_auth(server: socket.socket, reply: bytes, received: list):
+    conn, _ = server.accept()
+    with conn:
+        data = b""
+        while not data.endswith(b"\r\n"):
+            data += conn.recv(256)
+        received.append(data)
+        conn.sendall(reply)
+        if reply.startswith(b"OK"):
+            received.append(conn.recv(256))
+
+
+@pytest.mark.parametrize("reply, accepted", [
+    (b"OK 0123456789abcdef\r\n", True),
+    (b"REJECTED EXTERNAL\r\n", False),
+])
+def test_connect_sasl_external(tmp_path, reply, accepted):
+    path = str(tmp_path / "bus")
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+    received = []
+    thread = threading.Thread(target=_serve_auth, args=(server, reply, received))
+    thread.start()
+    try:
+        if accepted:
+            sock = InputConnection._connect(f"unix:path={path}")
+            sock.close()
+        else:
+            with pytest.raises(ConnectionError):
+                InputConnection._connect(f"unix:path={path}")
+    finally:
+        thread.join(timeout=5)
+        server.close()
+
+    uid_hex = str(os.getuid()).encode().hex().encode()
+    assert received[0] == b"\0AUTH EXTERNAL " + uid_hex + b"\r\n"
+    if accepted:
+        assert received[1] == b"BEGIN\r\n"
+
+
+def test_connect_unsupported_address():
+    with pytest.raises(ValueError):
+        InputConnection._connect("tcp:host=localhost,port=1234")